@@ -0,0 +1,92 @@
+'''
+Compare describing instances via boto3 resource collections and via senza.ec2 (client paginator + projection)
+
+Runs offline against a synthetic account (stubbed "DescribeInstances" pages):
+
+    PYTHONPATH=. python benchmarks/ec2_data_access.py [NUMBER_OF_INSTANCES]
+'''
+import datetime
+import gc
+import sys
+import time
+import tracemalloc
+
+import boto3
+from botocore.stub import Stubber
+
+from senza.aws import get_tag
+from senza.ec2 import describe_instances
+
+PAGE_SIZE = 1000
+
+
+def get_pages(count: int) -> list:
+    pages = []
+    for start in range(0, count, PAGE_SIZE):
+        instances = [{'InstanceId': 'i-{:017x}'.format(i),
+                      'ImageId': 'ami-{:08x}'.format(i % 50),
+                      'InstanceType': 't2.micro',
+                      'State': {'Code': 16, 'Name': 'running'},
+                      'PrivateIpAddress': '10.0.{}.{}'.format(i // 256 % 256, i % 256),
+                      'LaunchTime': datetime.datetime(2016, 1, 1),
+                      'SubnetId': 'subnet-123',
+                      'VpcId': 'vpc-123',
+                      'SecurityGroups': [{'GroupId': 'sg-123', 'GroupName': 'app-myapp'}],
+                      'Tags': [{'Key': 'aws:cloudformation:stack-name', 'Value': 'myapp-{}'.format(i % 100)},
+                               {'Key': 'aws:cloudformation:logical-id', 'Value': 'AppServer'},
+                               {'Key': 'StackName', 'Value': 'myapp'},
+                               {'Key': 'StackVersion', 'Value': str(i % 100)}]}
+                     for i in range(start, min(start + PAGE_SIZE, count))]
+        page = {'Reservations': [{'ReservationId': 'r-{}'.format(start), 'Instances': instances}]}
+        if start + PAGE_SIZE < count:
+            page['NextToken'] = str(start + PAGE_SIZE)
+        pages.append(page)
+    return pages
+
+
+def read_resources(pages: list) -> list:
+    '''The old data path: keep the resource objects and read the attributes senza uses'''
+    ec2 = boto3.resource('ec2', 'eu-west-1')
+    with Stubber(ec2.meta.client) as stubber:
+        for page in pages:
+            stubber.add_response('describe_instances', page)
+        instances = list(ec2.instances.filter(Filters=[]))
+        for instance in instances:
+            instance.state['Name'], get_tag(instance.tags, 'aws:cloudformation:stack-name')
+        return instances
+
+
+def read_client(pages: list) -> list:
+    ec2 = boto3.client('ec2', 'eu-west-1')
+    with Stubber(ec2) as stubber:
+        for page in pages:
+            stubber.add_response('describe_instances', page)
+        instances = list(describe_instances(ec2))
+        for instance in instances:
+            instance.state, instance.tags.get('aws:cloudformation:stack-name')
+        return instances
+
+
+def measure(func, pages: list):
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = func(pages)
+    duration = time.perf_counter() - started
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return duration, current, peak, result
+
+
+def main(count: int):
+    pages = get_pages(count)
+    for label, func in ('resource collection', read_resources), ('client paginator', read_client):
+        # load the service models before measuring
+        func(get_pages(1))
+        duration, current, peak, _ = measure(func, pages)
+        print('{:20} {:8.2f}s  {:8.0f} bytes/instance retained  {:8.1f} MiB peak'.format(
+            label, duration, current / count, peak / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
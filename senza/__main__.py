@@ -1,4 +1,4 @@
-import senza.cli
+import senza.completion
 
 if __name__ == '__main__':
-    senza.cli.main()
+    senza.completion.main()
@@ -1,11 +1,37 @@
+import calendar
 import collections
 import datetime
 import functools
+import re
+import threading
 import time
 import boto3
 import base64
 from botocore.exceptions import ClientError
 
+from . import inventory
+from .inventory import StackInventory
+from .parallel import parallel_map
+
+
+class AccountSession:
+    '''boto3 session of a named AWS profile (or of the default credentials if profile is None)
+
+    Low-level clients are created once per service and region and can be shared between threads.'''
+
+    def __init__(self, profile: str=None):
+        self.profile = profile
+        self.session = boto3.session.Session(profile_name=profile) if profile else None
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def client(self, service: str, region: str=None):
+        with self.lock:
+            key = (service, region)
+            if key not in self.clients:
+                self.clients[key] = (self.session or boto3).client(service, region)
+            return self.clients[key]
+
 
 def get_security_group(region: str, sg_name: str):
     ec2 = boto3.resource('ec2', region)
@@ -166,40 +192,70 @@ class SenzaStackSummary:
         return self.stack['StackName'] == other.stack['StackName']
 
 
-def get_stacks(stack_refs: list, region, all=False):
+ACTIVE_STACK_STATUSES = [
+    "CREATE_IN_PROGRESS",
+    "CREATE_FAILED",
+    "CREATE_COMPLETE",
+    "ROLLBACK_IN_PROGRESS",
+    "ROLLBACK_FAILED",
+    "ROLLBACK_COMPLETE",
+    "DELETE_IN_PROGRESS",
+    "DELETE_FAILED",
+    # "DELETE_COMPLETE",
+    "UPDATE_IN_PROGRESS",
+    "UPDATE_COMPLETE_CLEANUP_IN_PROGRESS",
+    "UPDATE_COMPLETE",
+    "UPDATE_ROLLBACK_IN_PROGRESS",
+    "UPDATE_ROLLBACK_FAILED",
+    "UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS",
+    "UPDATE_ROLLBACK_COMPLETE"
+]
+
+STACK_INVENTORIES = {}
+
+
+def get_stack_inventory(region: str, session: AccountSession=None) -> StackInventory:
+    key = (getattr(session, 'profile', None), region)
+    if key not in STACK_INVENTORIES:
+        STACK_INVENTORIES[key] = StackInventory.open(get_account_id(session), region, ACTIVE_STACK_STATUSES,
+                                                     session)
+    return STACK_INVENTORIES[key]
+
+
+def list_stack_summaries(region, all=False, session: AccountSession=None):
     # boto3.resource('cf')-stacks.filter() doesn't support status_filter, only StackName
-    cf = boto3.client('cloudformation', region)
+    cf = (session or boto3).client('cloudformation', region)
     if all:
         status_filter = []
     else:
         # status_filter = [st for st in cf.valid_states if st != 'DELETE_COMPLETE']
-        status_filter = [
-            "CREATE_IN_PROGRESS",
-            "CREATE_FAILED",
-            "CREATE_COMPLETE",
-            "ROLLBACK_IN_PROGRESS",
-            "ROLLBACK_FAILED",
-            "ROLLBACK_COMPLETE",
-            "DELETE_IN_PROGRESS",
-            "DELETE_FAILED",
-            # "DELETE_COMPLETE",
-            "UPDATE_IN_PROGRESS",
-            "UPDATE_COMPLETE_CLEANUP_IN_PROGRESS",
-            "UPDATE_COMPLETE",
-            "UPDATE_ROLLBACK_IN_PROGRESS",
-            "UPDATE_ROLLBACK_FAILED",
-            "UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS",
-            "UPDATE_ROLLBACK_COMPLETE"
-        ]
+        status_filter = ACTIVE_STACK_STATUSES
     kwargs = {'StackStatusFilter': status_filter}
     while 'NextToken' not in kwargs or kwargs['NextToken']:
         results = cf.list_stacks(**kwargs)
-        for stack in results['StackSummaries']:
-            if not stack_refs or matches_any(stack['StackName'], stack_refs):
-                yield SenzaStackSummary(stack)
+        yield from results['StackSummaries']
         kwargs['NextToken'] = results.get('NextToken')
 
 
+def get_stacks(stack_refs: list, region, all=False, max_age=None, session: AccountSession=None):
+    '''Yield all matching stacks, served from the local inventory if enabled
+
+    max_age overrides the inventory's freshness bound (in seconds)'''
+    if inventory.is_enabled():
+        summaries = get_stack_inventory(region, session).get_stack_summaries(all=all, max_age=max_age)
+    else:
+        summaries = list_stack_summaries(region, all=all, session=session)
+    for stack in summaries:
+        if not stack_refs or matches_any(stack['StackName'], stack_refs):
+            yield SenzaStackSummary(stack)
+
+
+def invalidate_stacks(region):
+    '''Make the next get_stacks() call see stack changes we just triggered'''
+    if inventory.is_enabled():
+        get_stack_inventory(region).invalidate()
+
+
 def matches_any(cf_stack_name: str, stack_refs: list):
     '''
     >>> matches_any(None, [StackReference(name='foobar', version=None)])
@@ -225,6 +281,48 @@ def matches_any(cf_stack_name: str, stack_refs: list):
     return False
 
 
+def get_event_time(event: dict) -> int:
+    '''
+    >>> get_event_time({'Timestamp': datetime.datetime(2016, 5, 1, tzinfo=datetime.timezone.utc)})
+    1462060800
+    '''
+    return calendar.timegm(event['Timestamp'].utctimetuple())
+
+
+def get_stack_events(cf, stack_id: str, since: float=None):
+    '''Yield the events of a stack newest first, fetching further pages only when needed
+
+    Stops at the first event older than since (UNIX timestamp).'''
+    kwargs = {'StackName': stack_id}
+    while True:
+        result = cf.describe_stack_events(**kwargs)
+        for event in result['StackEvents']:
+            if since and get_event_time(event) < since:
+                return
+            yield event
+        kwargs['NextToken'] = result.get('NextToken')
+        if not kwargs['NextToken']:
+            return
+
+
+def get_new_stack_events(cf, stack_id: str, last_event_id: str=None) -> list:
+    '''Return the stack events which happened after the given event ID (oldest first)
+
+    Cloud Formation returns the newest events first, so pages are only fetched until the last seen event.
+    Without a last seen event only the first page is returned.'''
+    events = []
+    kwargs = {'StackName': stack_id}
+    while True:
+        result = cf.describe_stack_events(**kwargs)
+        for event in result['StackEvents']:
+            if event['EventId'] == last_event_id:
+                return events[::-1]
+            events.append(event)
+        kwargs['NextToken'] = result.get('NextToken')
+        if not last_event_id or not kwargs['NextToken']:
+            return events[::-1]
+
+
 def get_tag(tags: list, key: str, default=None):
     '''
     >>> tags = [{'Key': 'aws:cloudformation:stack-id',
@@ -247,8 +345,108 @@ def get_tag(tags: list, key: str, default=None):
     return default
 
 
-def get_account_id():
-    conn = boto3.client('iam')
+# Cloud Formation resource types which the Resource Groups Tagging API can find by their stack name tag
+TAGGABLE_RESOURCE_TYPES = {
+    'AWS::AutoScaling::AutoScalingGroup': 'autoscaling:autoScalingGroup',
+    'AWS::ElasticLoadBalancing::LoadBalancer': 'elasticloadbalancing:loadbalancer',
+}
+
+# maximum number of values in a single tag filter of "GetResources"
+MAX_TAG_FILTER_VALUES = 20
+
+
+def parse_tagged_resource(mapping: dict) -> dict:
+    '''Convert a Resource Groups Tagging API mapping to a stack resource summary
+
+    >>> res = parse_tagged_resource({'ResourceARN': 'arn:aws:autoscaling:eu-west-1:123:autoScalingGroup:1a2b:'
+    ...                                             'autoScalingGroupName/myapp-1-AppServer-XYZ',
+    ...                              'Tags': [{'Key': 'aws:cloudformation:stack-name', 'Value': 'myapp-1'},
+    ...                                       {'Key': 'aws:cloudformation:logical-id', 'Value': 'AppServer'}]})
+    >>> res['ResourceType'], res['PhysicalResourceId'], res['LogicalResourceId'], res['StackName']
+    ('AWS::AutoScaling::AutoScalingGroup', 'myapp-1-AppServer-XYZ', 'AppServer', 'myapp-1')
+
+    >>> parse_tagged_resource({'ResourceARN': 'arn:aws:elasticloadbalancing:eu-west-1:123:loadbalancer/myapp-1',
+    ...                        'Tags': []})['ResourceType']
+    'AWS::ElasticLoadBalancing::LoadBalancer'
+
+    >>> parse_tagged_resource({'ResourceARN': 'arn:aws:elasticloadbalancing:eu-west-1:123:loadbalancer/app/a/1',
+    ...                        'Tags': []})['ResourceType'] is None
+    True
+    '''
+    parts = mapping['ResourceARN'].split(':', 5)
+    service, resource = parts[2], parts[5]
+    physical_id = resource.split('/', 1)[-1]
+    type_filter = '{}:{}'.format(service, re.split('[:/]', resource)[0])
+    resource_type = None
+    # application load balancers ("loadbalancer/app/<name>/<id>") share the type filter of classic ELBs
+    if '/' not in physical_id:
+        for cf_type, tagging_type in TAGGABLE_RESOURCE_TYPES.items():
+            if tagging_type == type_filter:
+                resource_type = cf_type
+    return {'StackName': get_tag(mapping['Tags'], 'aws:cloudformation:stack-name'),
+            'LogicalResourceId': get_tag(mapping['Tags'], 'aws:cloudformation:logical-id'),
+            'PhysicalResourceId': physical_id,
+            'ResourceType': resource_type}
+
+
+def get_tagged_stack_resources(stack_names: list, resource_types: list, region: str,
+                               session: AccountSession=None) -> dict:
+    '''Find the taggable resources of all given stacks with a few "GetResources" calls'''
+    client = (session or boto3).client('resourcegroupstaggingapi', region)
+    paginator = client.get_paginator('get_resources')
+    resources = collections.defaultdict(list)
+    for i in range(0, len(stack_names), MAX_TAG_FILTER_VALUES):
+        pages = paginator.paginate(TagFilters=[{'Key': 'aws:cloudformation:stack-name',
+                                                'Values': stack_names[i:i + MAX_TAG_FILTER_VALUES]}],
+                                   ResourceTypeFilters=[TAGGABLE_RESOURCE_TYPES[t] for t in resource_types])
+        for page in pages:
+            for mapping in page['ResourceTagMappingList']:
+                resource = parse_tagged_resource(mapping)
+                if resource['ResourceType'] in resource_types:
+                    resources[resource['StackName']].append(resource)
+    return dict(resources)
+
+
+def list_stack_resources(cf, stack_name: str):
+    for page in cf.get_paginator('list_stack_resources').paginate(StackName=stack_name):
+        yield from page['StackResourceSummaries']
+
+
+def list_existing_stack_resources(cf, stack_name: str) -> list:
+    try:
+        return list(list_stack_resources(cf, stack_name))
+    except ClientError as e:
+        # the stack was deleted in the meantime
+        if e.response['Error']['Code'] != 'ValidationError':
+            raise
+        return []
+
+
+def get_stack_resources(stack_names: list, region: str, resource_types: list,
+                        session: AccountSession=None) -> dict:
+    '''Return the resources of the given types as {stack name: [resource summary]}
+
+    Taggable resources of all stacks are discovered in bulk via the Resource Groups Tagging API.
+    Stacks are only queried one by one (concurrently) for other resource types, for stacks without tagged
+    resources (tags are propagated asynchronously) or if the Tagging API cannot be used.'''
+    resources = {}
+    if stack_names and all(t in TAGGABLE_RESOURCE_TYPES for t in resource_types):
+        try:
+            resources = get_tagged_stack_resources(stack_names, resource_types, region, session)
+        except ClientError:
+            # e.g. missing "tag:GetResources" permission
+            pass
+
+    missing = [name for name in stack_names if name not in resources]
+    # clients are thread-safe, but must be created in the main thread
+    cf = (session or boto3).client('cloudformation', region)
+    for name, summaries in zip(missing, parallel_map(lambda name: list_existing_stack_resources(cf, name), missing)):
+        resources[name] = [res for res in summaries if res['ResourceType'] in resource_types]
+    return resources
+
+
+def get_account_id(session: AccountSession=None):
+    conn = (session or boto3).client('iam')
     try:
         own_user = conn.get_user()['User']
     except:
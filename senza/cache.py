@@ -0,0 +1,70 @@
+'''
+Thread-safe in-memory cache with expiring entries
+'''
+import threading
+import time
+
+
+class TTLCache:
+    '''Cache whose entries expire ttl seconds after they were loaded
+
+    Values are loaded by the function passed to get(). Every key has its own lock, so concurrent callers of the
+    same key load it only once while other keys stay available. Hits and misses are counted.
+
+    >>> cache = TTLCache(60)
+    >>> cache.get('a', lambda: 1), cache.get('a', lambda: 2)
+    (1, 1)
+    >>> cache.invalidate(lambda key: key == 'a')
+    >>> cache.get('a', lambda: 2), cache.stats()
+    (2, {'hits': 1, 'misses': 2, 'size': 1})
+    '''
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        # key => (expiry timestamp, value)
+        self.entries = {}
+        self.key_locks = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        '''Return the (not yet expired) entry of the key or None, counting a hit'''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                self.hits += 1
+                return entry
+            return None
+
+    def get(self, key, load):
+        '''Return the cached value of the key, calling load() to (re)load it if it is missing or expired'''
+        entry = self.lookup(key)
+        if entry is not None:
+            return entry[1]
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            # another thread might have loaded it meanwhile
+            entry = self.lookup(key)
+            if entry is not None:
+                return entry[1]
+            with self.lock:
+                self.misses += 1
+            value = load()
+            self.put(key, value)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl, value)
+
+    def invalidate(self, predicate=None):
+        '''Drop all entries whose key matches the predicate (all entries if there is none)'''
+        with self.lock:
+            for key in [key for key in self.entries if predicate is None or predicate(key)]:
+                del self.entries[key]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
@@ -1,31 +1,32 @@
 #!/usr/bin/env python3
 import calendar
 import collections
-import configparser
 import datetime
 import functools
 import importlib
+import itertools
 import ipaddress
 import os
 import re
 import sys
+import threading
 import json
 from urllib.error import URLError
-import dns.resolver
 import time
-from subprocess import call
+from subprocess import call, check_output, CalledProcessError, DEVNULL, STDOUT
 
 import click
 from clickclick import AliasedGroup, Action, choice, info, FloatRange, OutputFormat, error, fatal_error, ok
-from clickclick.console import print_table
-import requests
+from clickclick.console import print_table, format as format_column
 import yaml
 import base64
 import boto3
 from botocore.exceptions import NoCredentialsError, ClientError
 
 from .aws import parse_time, get_required_capabilities, resolve_topic_arn, get_stacks, StackReference, matches_any, \
-    get_account_id, get_account_alias, get_tag
+    get_account_id, get_account_alias, invalidate_stacks, AccountSession, \
+    get_stack_resources, get_new_stack_events, get_stack_events
+from . import inventory
 from .components import get_component, evaluate_template
 from .components.stups_auto_configuration import find_taupage_image
 from .patch import patch_auto_scaling_group
@@ -33,8 +34,15 @@ from .respawn import get_auto_scaling_group, respawn_auto_scaling_group
 import senza
 from urllib.request import urlopen
 from urllib.parse import quote
-from .traffic import change_version_traffic, print_version_traffic, get_records, get_zone
-from .utils import named_value, camel_case_to_underscore, pystache_render, ensure_keys
+from .traffic import change_version_traffic, print_version_traffic, get_record_index, get_zone
+from .utils import named_value, camel_case_to_underscore, pystache_render, ensure_keys, get_default_region, \
+    get_cache_dir, chunked
+from .ec2 import describe_image_chunks, describe_instance_images, get_console_output, get_instance_filters, \
+    get_instance_index, STACK_NAME_TAG, STACK_ID_TAG
+from .parallel import parallel_map, stream_map, DEFAULT_CONCURRENCY, MAX_FAN_OUT
+from .watch import WatchScreen, StackResults
+from .probes import get_prober, UNKNOWN
+from .polling import PollingScheduler, call_with_backoff, is_throttling_error, record_throttling
 from pprint import pformat
 
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
@@ -66,6 +74,7 @@ STYLES = {
     'OUT_OF_SERVICE': {'fg': 'red'},
     'OK': {'fg': 'green'},
     'ERROR': {'fg': 'red'},
+    'UNKNOWN': {'fg': 'yellow'},
 }
 
 
@@ -89,9 +98,14 @@ TITLES = {
     'main_dns': 'Main DNS',
     'id': 'ID',
     'ImageId': 'Image ID',
-    'OwnerId': 'Owner'
+    'OwnerId': 'Owner',
+    'region': 'Region',
+    'account': 'Account'
 }
 
+# identifies the rows of per-stack tables when redrawing them in watch mode
+STACK_ROW_KEY = ['account', 'region', 'stack_name', 'version']
+
 MAX_COLUMN_WIDTHS = {
     'description': 50,
     'stacks': 20,
@@ -148,27 +162,76 @@ class KeyValParamType(click.ParamType):
         return key_val
 
 
+class TimeParamType(click.ParamType):
+    '''Absolute (UTC) or relative time, converted to a UNIX timestamp
+
+    >>> TimeParamType().convert('2016-05-01T10:00', None, None)
+    1462096800
+    >>> TimeParamType().convert('2016-05-01', None, None)
+    1462060800
+    >>> time.time() - TimeParamType().convert('2h', None, None) >= 7200
+    True
+    '''
+    name = 'time'
+
+    UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+    def convert(self, value, param, ctx):
+        if isinstance(value, (int, float)):
+            return value
+        if value and value[-1] in self.UNITS and value[:-1].isdigit():
+            return int(time.time()) - int(value[:-1]) * self.UNITS[value[-1]]
+        for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+            try:
+                return calendar.timegm(time.strptime(value, fmt))
+            except ValueError:
+                pass
+        self.fail('invalid time "{}" (must be relative like "30m", "2h", "7d" or YYYY-MM-DD[THH:MM[:SS]])'.format(
+                  value), param, ctx)
+
+
 region_option = click.option('--region', envvar='AWS_DEFAULT_REGION', metavar='AWS_REGION_ID',
                              help='AWS region ID (e.g. eu-west-1)')
+regions_option = click.option('--region', envvar='AWS_DEFAULT_REGION', metavar='AWS_REGION_IDS',
+                              help='AWS region ID(s), comma separated or "all-enabled" (e.g. eu-west-1,eu-central-1)')
+profiles_option = click.option('-P', '--profile', 'profiles', multiple=True, metavar='AWS_PROFILE',
+                               help='AWS profile(s) to query, can be given multiple times or comma separated')
 output_option = click.option('-o', '--output', type=click.Choice(['text', 'json', 'tsv']), default='text',
                              help='Use alternative output format')
+stream_output_option = click.option('-o', '--output', type=click.Choice(['text', 'json', 'tsv', 'ndjson']),
+                                    default='text',
+                                    help='Use alternative output format ("ndjson" streams one JSON row per line)')
 json_output_option = click.option('-o', '--output', type=click.Choice(['json', 'yaml']), default='json',
                                   help='Use alternative output format')
+concurrency_option = click.option('--concurrency', type=click.IntRange(1, MAX_FAN_OUT), default=DEFAULT_CONCURRENCY,
+                                  metavar='N', help='Number of stacks to query in parallel')
 watch_option = click.option('-W', is_flag=True, help='Auto update the screen every 2 seconds')
 watchrefresh_option = click.option('-w', '--watch', type=click.IntRange(1, 300), metavar='SECS',
                                    help='Auto update the screen every X seconds')
 
 
-def watching(w: bool, watch: int):
+# maximum factor by which the watch interval grows
+WATCH_BACKOFF = 8
+
+
+def watching(w: bool, watch: int, screen: WatchScreen=None):
+    '''Yield once or (when watching) forever, tables printed via the given screen take care of clearing
+
+    The refresh interval backs off up to WATCH_BACKOFF times the requested one while the screen does not change
+    or the API throttles us.'''
     if w and not watch:
         watch = 2
-    if watch:
+    if watch and not screen:
         click.clear()
     yield 0
     if watch:
+        scheduler = PollingScheduler(watch, watch * WATCH_BACKOFF)
         while True:
-            time.sleep(watch)
-            click.clear()
+            scheduler.sleep(screen.changed if screen else None)
+            if screen:
+                screen.status = scheduler.describe()
+            else:
+                click.clear()
             yield 0
 
 # from AWS docs:
@@ -188,6 +251,8 @@ DEFINITION = DefinitionParamType()
 
 KEY_VAL = KeyValParamType()
 
+TIME = TimeParamType()
+
 BASE_TEMPLATE = {
     'AWSTemplateFormatVersion': '2010-09-09'
 }
@@ -277,8 +342,11 @@ def is_credentials_expired_error(e: ClientError) -> bool:
 @click.group(cls=AliasedGroup, context_settings=CONTEXT_SETTINGS)
 @click.option('-V', '--version', is_flag=True, callback=print_version, expose_value=False, is_eager=True,
               help='Print the current version number and exit.')
-def cli():
-    pass
+@click.option('--inventory-max-age', type=click.IntRange(0, 86400), metavar='SECS', envvar='SENZA_INVENTORY_MAX_AGE',
+              help='Serve stack lists from a local inventory, refreshed when older than SECS seconds')
+def cli(inventory_max_age):
+    if inventory_max_age is not None:
+        inventory.configure(inventory_max_age)
 
 
 class TemplateArguments:
@@ -443,13 +511,7 @@ def parse_args(input, region, version, parameter, account_info):
 
 def get_region(region):
     if not region:
-        config = configparser.ConfigParser()
-        try:
-            config.read(os.path.expanduser('~/.aws/config'))
-            if 'default' in config:
-                region = config['default']['region']
-        except:
-            pass
+        region = get_default_region()
 
     if not region:
         raise click.UsageError('Please specify the AWS region on the command line (--region) or in ~/.aws/config')
@@ -460,8 +522,81 @@ def get_region(region):
     return region
 
 
-def check_credentials(region):
-    iam = boto3.client('iam')
+def get_regions(region, session: AccountSession=None):
+    '''Resolve the --region option (comma separated region IDs or "all-enabled") to a list of regions'''
+    if region == 'all-enabled':
+        ec2 = (session or boto3).client('ec2', get_default_region() or 'us-east-1')
+        return sorted(r['RegionName'] for r in ec2.describe_regions()['Regions'])
+    return [get_region(r.strip()) for r in (region or '').split(',')]
+
+
+def get_sessions(profiles: list):
+    '''Return one AccountSession per AWS profile (option can be repeated and/or comma separated)
+
+    >>> [s.profile for s in get_sessions([])]
+    [None]
+    '''
+    names = [name.strip() for value in profiles for name in value.split(',') if name.strip()]
+    return [AccountSession(name) for name in names] or [AccountSession()]
+
+
+def get_fan_out_targets(profiles: list, region):
+    '''Resolve the --profile and --region options and check the credentials of every profile'''
+    sessions = get_sessions(profiles)
+    regions = get_regions(region, sessions[0])
+    parallel_map(lambda session: check_credentials(regions[0], session), sessions, max_workers=MAX_FAN_OUT)
+    return sessions, regions
+
+
+def get_target_rows(session, region: str, func, *args, **kwargs):
+    '''Yield the rows of func(session, region, *args, **kwargs) with an "account" (AWS profile name)
+    and a "region" column'''
+    for row in func(session, region, *args, **kwargs):
+        row['account'] = session.profile or ''
+        row['region'] = region
+        yield row
+
+
+def get_fan_out_rows(sessions: list, regions: list, func, *args, **kwargs):
+    '''Call func(session, region, *args, **kwargs) for all accounts and regions concurrently
+    and merge the returned rows'''
+    targets = [(session, region) for session in sessions for region in regions]
+    results = parallel_map(lambda target: list(get_target_rows(target[0], target[1], func, *args, **kwargs)), targets,
+                           max_workers=MAX_FAN_OUT)
+    return [row for rows in results for row in rows]
+
+
+def stream_fan_out_rows(sessions: list, regions: list, func, *args, **kwargs):
+    '''Like get_fan_out_rows, but yield the rows as soon as they are produced (in no particular order)'''
+    targets = [(session, region) for session in sessions for region in regions]
+    return stream_map(lambda target: get_target_rows(target[0], target[1], func, *args, **kwargs), targets,
+                      max_workers=MAX_FAN_OUT)
+
+
+def print_ndjson_row(cols: list, row: dict):
+    '''Print a single row as JSON line (for "-o ndjson")'''
+    click.echo(json.dumps({col: row.get(col) for col in cols}, sort_keys=True))
+
+
+def get_fan_out_columns(sessions: list, regions: list, columns: str):
+    '''
+    >>> get_fan_out_columns([None], ['eu-west-1'], 'a b')
+    ['a', 'b']
+    >>> get_fan_out_columns([None], ['eu-west-1', 'eu-central-1'], 'a b')
+    ['region', 'a', 'b']
+    >>> get_fan_out_columns([None, None], ['eu-west-1'], 'a b')
+    ['account', 'a', 'b']
+    '''
+    columns = columns.split()
+    if len(regions) > 1:
+        columns.insert(0, 'region')
+    if len(sessions) > 1:
+        columns.insert(0, 'account')
+    return columns
+
+
+def check_credentials(region, session: AccountSession=None):
+    iam = (session or boto3).client('iam')
     return iam.list_account_aliases()
 
 
@@ -526,34 +661,43 @@ def all_with_version(stack_refs: list):
     return True
 
 
+def get_stack_rows(session, region, stack_refs, all):
+    for stack in get_stacks(stack_refs, region, all=all, session=session):
+        yield {'stack_name': stack.name,
+               'version': stack.version,
+               'status': stack.StackStatus,
+               'creation_time': calendar.timegm(stack.CreationTime.timetuple()),
+               'description': stack.TemplateDescription}
+
+
 @cli.command('list')
-@region_option
-@output_option
+@regions_option
+@profiles_option
+@stream_output_option
 @watch_option
 @watchrefresh_option
 @click.option('--all', is_flag=True, help='Show all stacks, including deleted ones')
 @click.argument('stack_ref', nargs=-1)
-def list_stacks(region, stack_ref, all, output, w, watch):
+def list_stacks(region, profiles, stack_ref, all, output, w, watch):
     '''List Cloud Formation stacks'''
-    region = get_region(region)
-    check_credentials(region)
+    sessions, regions = get_fan_out_targets(profiles, region)
 
     stack_refs = get_stack_refs(stack_ref)
+    cols = get_fan_out_columns(sessions, regions, 'stack_name version status creation_time description')
 
-    for _ in watching(w, watch):
-        rows = []
-        for stack in get_stacks(stack_refs, region, all=all):
-            rows.append({'stack_name': stack.name,
-                         'version': stack.version,
-                         'status': stack.StackStatus,
-                         'creation_time': calendar.timegm(stack.CreationTime.timetuple()),
-                         'description': stack.TemplateDescription})
+    screen = WatchScreen(w or watch)
+    for _ in watching(w, watch, screen):
+        if output == 'ndjson':
+            for row in stream_fan_out_rows(sessions, regions, get_stack_rows, stack_refs, all):
+                print_ndjson_row(cols, row)
+            continue
+
+        rows = get_fan_out_rows(sessions, regions, get_stack_rows, stack_refs, all)
 
-        rows.sort(key=lambda x: (x['stack_name'], x['version']))
+        rows.sort(key=lambda x: (x['stack_name'], x['version'], x['account'], x['region']))
 
         with OutputFormat(output):
-            print_table('stack_name version status creation_time description'.split(), rows,
-                        styles=STYLES, titles=TITLES)
+            screen.print_table(cols, rows, key=STACK_ROW_KEY, styles=STYLES, titles=TITLES)
 
 
 @cli.command()
@@ -586,6 +730,7 @@ def create(definition, region, version, parameter, disable_rollback, dry_run, fo
                 info(' Tags: {}'.format(data['Tags']))
             else:
                 cf.create_stack(DisableRollback=disable_rollback, **data)
+                invalidate_stacks(get_region(region))
         except ClientError as e:
             if e.response['Error']['Code'] == 'AlreadyExistsException':
                 act.fatal_error('Stack {} already exists. Please choose another version.'.format(data['StackName']))
@@ -613,6 +758,7 @@ def update(definition, region, version, parameter, disable_rollback, dry_run, fo
             else:
                 del(data['Tags'])
                 cf.update_stack(**data)
+                invalidate_stacks(get_region(region))
         except ClientError as e:
             act.fatal_error('ClientError: {}'.format(pformat(e.response)))
 
@@ -710,6 +856,7 @@ def delete(stack_ref, region, dry_run, force):
         with Action('Deleting Cloud Formation stack {}..'.format(stack.StackName)):
             if not dry_run:
                 cf.delete_stack(StackName=stack.StackName)
+                invalidate_stacks(region)
 
 
 def format_resource_type(resource_type):
@@ -723,32 +870,113 @@ def format_resource_type(resource_type):
 @region_option
 @watch_option
 @watchrefresh_option
-@output_option
-def resources(stack_ref, region, w, watch, output):
+@stream_output_option
+@concurrency_option
+def resources(stack_ref, region, w, watch, output, concurrency):
     '''Show all resources of a single Cloud Formation stack'''
     stack_refs = get_stack_refs(stack_ref)
     region = get_region(region)
     check_credentials(region)
     cf = boto3.client('cloudformation', region)
 
-    for _ in watching(w, watch):
-        rows = []
-        for stack in get_stacks(stack_refs, region):
-            resources = cf.describe_stack_resources(StackName=stack.StackName)['StackResources']
+    def get_resources(stack):
+        return call_with_backoff(cf.describe_stack_resources, StackName=stack.StackName)['StackResources']
 
-            for resource in resources:
-                d = resource.copy()
-                d['stack_name'] = stack.name
-                d['version'] = stack.version
-                d['resource_type'] = format_resource_type(d['ResourceType'])
-                d['creation_time'] = calendar.timegm(resource['Timestamp'].timetuple())
-                rows.append(d)
+    def get_rows(stack):
+        rows = []
+        for resource in stack_resources.get(stack, get_resources):
+            d = resource.copy()
+            d['stack_name'] = stack.name
+            d['version'] = stack.version
+            d['resource_type'] = format_resource_type(d['ResourceType'])
+            d['creation_time'] = calendar.timegm(resource['Timestamp'].timetuple())
+            rows.append(d)
+        return rows
+
+    cols = ['stack_name', 'version', 'LogicalResourceId', 'resource_type', 'ResourceStatus', 'creation_time']
+    screen = WatchScreen(w or watch)
+    stack_resources = StackResults()
+    for _ in watching(w, watch, screen):
+        stacks = list(get_stacks(stack_refs, region))
+        if output == 'ndjson':
+            for row in stream_map(get_rows, stacks, concurrency):
+                print_ndjson_row(cols, row)
+            continue
 
+        rows = [row for stack_rows in parallel_map(get_rows, stacks, concurrency) for row in stack_rows]
         rows.sort(key=lambda x: (x['stack_name'], x['version'], x['LogicalResourceId']))
 
         with OutputFormat(output):
-            print_table('stack_name version LogicalResourceId resource_type ResourceStatus creation_time'.split(),
-                        rows, styles=STYLES, titles=TITLES)
+            screen.print_table(cols, rows, key=['stack_name', 'version', 'LogicalResourceId'], styles=STYLES,
+                               titles=TITLES)
+
+
+EVENT_COLUMNS = ['stack_name', 'version', 'resource_type', 'LogicalResourceId', 'ResourceStatus',
+                 'ResourceStatusReason', 'event_time']
+
+
+def get_event_row(stack, event: dict) -> dict:
+    d = event.copy()
+    d['stack_name'] = stack.name
+    d['version'] = stack.version
+    d['resource_type'] = format_resource_type(d['ResourceType'])
+    d['event_time'] = calendar.timegm(event['Timestamp'].timetuple())
+    return d
+
+
+def print_event_row(row: dict, output: str):
+    '''Print a single event line (for "events --follow")'''
+    if output in ('json', 'ndjson'):
+        print_ndjson_row(EVENT_COLUMNS, row)
+    elif output == 'tsv':
+        click.echo('\t'.join(format_column(col, row.get(col)) for col in EVENT_COLUMNS))
+    else:
+        click.echo(time.strftime('%Y-%m-%d %H:%M:%S ', time.localtime(row['event_time'])), nl=False)
+        click.echo('{stack_name} {version} {resource_type} {LogicalResourceId} '.format(**row), nl=False)
+        click.secho(row['ResourceStatus'], nl=False, **STYLES.get(row['ResourceStatus'], {}))
+        click.echo(' {}'.format(row.get('ResourceStatusReason') or ''))
+
+
+def get_event_rows(cf, stack, since: int=None, limit: int=None) -> list:
+    '''Return the rows of the newest stack events (at most limit and not older than since)'''
+    events = itertools.islice(get_stack_events(cf, stack.StackId, since), limit)
+    return [get_event_row(stack, event) for event in events]
+
+
+def follow_events(stack_refs: list, region: str, output: str, interval: int, since: int=None, limit: int=None):
+    '''Stream new stack events as they appear (like "tail -f")'''
+    cf = boto3.client('cloudformation', region)
+    scheduler = PollingScheduler(interval, interval * WATCH_BACKOFF)
+    # stack ID => (stack, last seen event ID)
+    known = {}
+    first_poll = True
+    if output == 'tsv':
+        click.echo('\t'.join(EVENT_COLUMNS))
+    while True:
+        listed = {stack.StackId: stack for stack in get_stacks(stack_refs, region, max_age=0)}
+        rows = []
+        # stacks which vanished from the list (i.e. were deleted) are polled a last time
+        for stack_id in set(known) | set(listed):
+            stack, last_event_id = known.get(stack_id, (listed.get(stack_id), None))
+            if not last_event_id and (since or limit):
+                stack_rows = get_event_rows(cf, stack, since, limit)[::-1]
+            else:
+                stack_rows = [get_event_row(stack, event)
+                              for event in get_new_stack_events(cf, stack_id, last_event_id)]
+            if stack_rows:
+                last_event_id = stack_rows[-1]['EventId']
+            if stack_id in listed:
+                known[stack_id] = (listed[stack_id], last_event_id)
+            else:
+                del known[stack_id]
+            rows.extend(stack_rows)
+        rows.sort(key=lambda x: x['event_time'])
+        if limit and first_poll:
+            rows = rows[-limit:]
+        for row in rows:
+            print_event_row(row, output)
+        first_poll = False
+        scheduler.sleep(bool(rows))
 
 
 @cli.command()
@@ -756,33 +984,53 @@ def resources(stack_ref, region, w, watch, output):
 @region_option
 @watch_option
 @watchrefresh_option
-@output_option
-def events(stack_ref, region, w, watch, output):
+@stream_output_option
+@click.option('-f', '--follow', is_flag=True, help='Stream new events as they appear (like "tail -f")')
+@click.option('--since', type=TIME, metavar='TIME',
+              help='Only show events since TIME (e.g. "2h", "7d" or "2016-05-01T10:00" in UTC)')
+@click.option('-l', '--limit', type=click.IntRange(1, None), metavar='N', help='Only show the N latest events')
+@concurrency_option
+def events(stack_ref, region, w, watch, output, follow, since, limit, concurrency):
     '''Show all Cloud Formation events for a single stack'''
     stack_refs = get_stack_refs(stack_ref)
     region = get_region(region)
     check_credentials(region)
     cf = boto3.client('cloudformation', region)
 
-    for _ in watching(w, watch):
-        rows = []
-        for stack in get_stacks(stack_refs, region):
-            events = cf.describe_stack_events(StackName=stack.StackId)['StackEvents']
+    if follow:
+        follow_events(stack_refs, region, output, watch or 2, since, limit)
+        return
+
+    def get_rows(stack):
+        return call_with_backoff(get_event_rows, cf, stack, since, limit)
+
+    screen = WatchScreen(w or watch)
+    stack_events = StackResults()
+    for _ in watching(w, watch, screen):
+        stacks = list(get_stacks(stack_refs, region))
+        if output == 'ndjson' and not limit:
+            for row in stream_map(lambda stack: stack_events.get(stack, get_rows), stacks, concurrency):
+                print_ndjson_row(EVENT_COLUMNS, row)
+            continue
 
-            for event in events:
-                d = event.copy()
-                d['stack_name'] = stack.name
-                d['version'] = stack.version
-                d['resource_type'] = format_resource_type(d['ResourceType'])
-                d['event_time'] = calendar.timegm(event['Timestamp'].timetuple())
-                rows.append(d)
+        rows = []
+        # the newest N events of all stacks are among the newest N events of each stack
+        for stack_rows in parallel_map(lambda stack: stack_events.get(stack, get_rows), stacks, concurrency):
+            rows.extend(stack_rows)
 
         rows.sort(key=lambda x: x['event_time'])
+        if limit:
+            rows = rows[-limit:]
+
+        if output == 'ndjson':
+            # the latest events are only known after querying all stacks
+            for row in rows:
+                print_ndjson_row(EVENT_COLUMNS, row)
+            continue
 
         with OutputFormat(output):
-            print_table(('stack_name version resource_type LogicalResourceId ' +
-                        'ResourceStatus ResourceStatusReason event_time').split(),
-                        rows, styles=STYLES, titles=TITLES, max_column_widths=MAX_COLUMN_WIDTHS)
+            screen.print_table(EVENT_COLUMNS, rows, key=['EventId'], styles=STYLES, titles=TITLES,
+                               max_column_widths=MAX_COLUMN_WIDTHS)
 
 
 def get_template_description(template: str):
@@ -822,26 +1070,49 @@ def init(definition_file, region, template, user_variable):
         definition_file.write(definition)
 
 
-def get_instance_health(elb, stack_name: str) -> dict:
-    if stack_name is None:
+def get_instance_health(elb, lb_name: str) -> dict:
+    if lb_name is None:
         return {}
     instance_health = {}
     try:
-        instance_states = elb.describe_instance_health(LoadBalancerName=stack_name)['InstanceStates']
+        instance_states = elb.describe_instance_health(LoadBalancerName=lb_name)['InstanceStates']
         for istate in instance_states:
             instance_health[istate['InstanceId']] = camel_case_to_underscore(istate['State']).upper()
     except ClientError as e:
         # ignore non existing ELBs
         # ignore ValidationError "LoadBalancer name cannot be longer than 32 characters"
-        # ignore rate limit exceeded errors
-        if e.response['Error']['Code'] not in ('LoadBalancerNotFound', 'ValidationError', 'Throttling'):
+        # ignore rate limit exceeded errors (but let polling loops back off)
+        if is_throttling_error(e):
+            record_throttling()
+        elif e.response['Error']['Code'] not in ('LoadBalancerNotFound', 'ValidationError'):
             raise
     return instance_health
 
 
-def get_instance_user_data(instance) -> dict:
+def get_stacks_instance_health(session, region: str, stack_names: list) -> dict:
+    '''Return the ELB health of all instances as {stack name: {instance ID: state}}
+
+    The stacks' actual load balancers are resolved and queried once each (concurrently).'''
+    elb = session.client('elb', region)
+    resources = get_stack_resources(stack_names, region, ['AWS::ElasticLoadBalancing::LoadBalancer'], session)
+    lb_names = sorted({res['PhysicalResourceId'] for stack_resources in resources.values()
+                       for res in stack_resources if res.get('PhysicalResourceId')})
+    lb_health = dict(zip(lb_names, parallel_map(lambda lb_name: get_instance_health(elb, lb_name), lb_names)))
+    instance_health = {}
+    for stack_name, stack_resources in resources.items():
+        instance_health[stack_name] = {}
+        for res in stack_resources:
+            instance_health[stack_name].update(lb_health.get(res.get('PhysicalResourceId'), {}))
+    return instance_health
+
+
+# number of stacks whose rows are resolved at once by the streaming row generators
+ROWS_CHUNK_SIZE = 20
+
+
+def get_instance_user_data(ec2, instance_id: str) -> dict:
     try:
-        attrs = instance.describe_attribute(Attribute='userData')
+        attrs = call_with_backoff(ec2.describe_instance_attribute, InstanceId=instance_id, Attribute='userData')
         data_b64 = attrs['UserData']['Value']
         data_yaml = base64.b64decode(data_b64)
         data_dict = yaml.load(data_yaml)
@@ -852,8 +1123,141 @@ def get_instance_user_data(instance) -> dict:
     return {}
 
 
-def get_instance_docker_image_source(instance) -> str:
-    return get_instance_user_data(instance).get('source', '')
+# docker image sources by instance ID, loaded from disk on first use
+DOCKER_IMAGE_SOURCES = None
+# seconds after which cached sources are dropped from disk
+DOCKER_IMAGE_SOURCES_MAX_AGE = 30 * 24 * 3600
+docker_image_sources_lock = threading.Lock()
+
+
+def get_docker_image_sources_path():
+    return os.path.join(get_cache_dir(), 'docker-image-sources.json')
+
+
+def load_docker_image_sources() -> dict:
+    global DOCKER_IMAGE_SOURCES
+    if DOCKER_IMAGE_SOURCES is None:
+        try:
+            with open(get_docker_image_sources_path()) as fd:
+                data = json.load(fd)
+        except (OSError, ValueError):
+            data = {}
+        cutoff = time.time() - DOCKER_IMAGE_SOURCES_MAX_AGE
+        DOCKER_IMAGE_SOURCES = {instance_id: entry for instance_id, entry in data.items() if entry[1] > cutoff}
+    return DOCKER_IMAGE_SOURCES
+
+
+def save_docker_image_sources(sources: dict):
+    path = get_docker_image_sources_path()
+    tmp_path = '{}.{}'.format(path, os.getpid())
+    with open(tmp_path, 'w') as fd:
+        json.dump(sources, fd)
+    os.replace(tmp_path, path)
+
+
+def get_docker_image_sources(session, region: str, instance_ids: list) -> dict:
+    '''Return the docker image source of all instances as {instance ID: source}
+
+    User data cannot change during an instance's lifetime, so only the sources of unknown instances are
+    queried (concurrently). Only the sources are cached (in memory and on disk), never the user data itself.'''
+    ec2 = session.client('ec2', region)
+    with docker_image_sources_lock:
+        sources = load_docker_image_sources()
+        missing = [instance_id for instance_id in instance_ids if instance_id not in sources]
+
+    if missing:
+        user_data = parallel_map(lambda instance_id: get_instance_user_data(ec2, instance_id), missing)
+        now = time.time()
+        with docker_image_sources_lock:
+            for instance_id, data in zip(missing, user_data):
+                # do not cache failures, they might be temporary
+                if data:
+                    sources[instance_id] = (data.get('source', '') if isinstance(data, dict) else '', now)
+            save_docker_image_sources(sources)
+    return {instance_id: sources.get(instance_id, ('', None))[0] for instance_id in instance_ids}
+
+
+def get_instance_rows(session, region, stack_refs, all, terminated, docker_image):
+    '''Yield the instance rows, ROWS_CHUNK_SIZE stacks at a time (their ELB health and docker sources are
+    only resolved when the rows are built)'''
+    ec2 = session.client('ec2', region)
+
+    index = get_instance_index(ec2, get_stack_name_filter_values(stack_refs) if stack_refs else None, terminated)
+    cf_stack_names = sorted(name for name in index.get_stack_names() if not stack_refs or matches_any(name, stack_refs))
+    chunks = list(chunked(cf_stack_names, ROWS_CHUNK_SIZE))
+    if all and not stack_refs:
+        # instances not part of any stack
+        chunks.append([None])
+
+    for chunk in chunks:
+        instances = [instance for name in chunk for instance in index.get_stack_instances(name)]
+        health_by_stack = get_stacks_instance_health(session, region, [name for name in chunk if name])
+        if docker_image:
+            docker_sources = get_docker_image_sources(session, region, [instance.id for instance in instances])
+
+        for instance in instances:
+            cf_stack_name = instance.tags.get(STACK_NAME_TAG)
+            stack_name = instance.tags.get('StackName')
+            stack_version = instance.tags.get('StackVersion')
+            instance_health = health_by_stack.get(cf_stack_name, {})
+
+            docker_source = docker_sources[instance.id] if docker_image else ''
+
+            yield {'stack_name': stack_name or '',
+                   'version': stack_version or '',
+                   'resource_id': instance.tags.get('aws:cloudformation:logical-id'),
+                   'instance_id': instance.id,
+                   'public_ip': instance.public_ip_address,
+                   'private_ip': instance.private_ip_address,
+                   'state': instance.state.upper().replace('-', '_'),
+                   'lb_status': instance_health.get(instance.id),
+                   'docker_source': docker_source,
+                   'launch_time': instance.launch_time.timestamp()}
+
+
+def run_piu_request_access(ip: str, reason: str, odd_host: str=None, interactive: bool=False,
+                           err: bool=False) -> tuple:
+    '''Run "piu request-access" for a single IP address and return its exit code and (combined) output
+
+    An interactive request runs on the terminal (its output is not captured), so piu can prompt.'''
+    cmd = ['piu', 'request-access', ip, '{} via senza'.format(reason)]
+    if odd_host is not None:
+        cmd.extend(['-O', odd_host])
+    try:
+        if interactive:
+            return call(cmd, stdout=sys.stderr if err else None), ''
+        # concurrent requests cannot prompt on the same terminal
+        return 0, check_output(cmd, stdin=DEVNULL, stderr=STDOUT, universal_newlines=True)
+    except CalledProcessError as e:
+        return e.returncode, e.output
+    except OSError as e:
+        return None, str(e)
+
+
+def request_piu_access(ips: list, reason: str, odd_host: str=None, concurrency: int=DEFAULT_CONCURRENCY,
+                       err: bool=False):
+    '''Request access to all IP addresses, print the output per instance and a summary
+
+    The first request runs on the terminal, so piu can prompt once (e.g. for the token password or the bastion
+    host), all others run concurrently.'''
+    if not ips:
+        return
+    click.secho('==> {} <=='.format(ips[0]), bold=True, err=err)
+    first = run_piu_request_access(ips[0], reason, odd_host, interactive=True, err=err)
+    results = parallel_map(lambda ip: run_piu_request_access(ip, reason, odd_host), ips[1:], concurrency)
+    failed = []
+    for i, (ip, (returncode, output)) in enumerate(zip(ips, [first] + list(results))):
+        if i > 0:
+            click.secho('==> {} <=='.format(ip), bold=True, err=err)
+        if output.strip():
+            click.echo(output.rstrip(), err=err)
+        if returncode != 0:
+            failed.append(ip)
+    message = 'Requested access to {} of {} instances'.format(len(ips) - len(failed), len(ips))
+    if failed:
+        error('{}, failed: {}'.format(message, ', '.join(failed)), err=err)
+    else:
+        ok(message, err=err)
 
 
 @cli.command()
@@ -863,177 +1267,188 @@ def get_instance_docker_image_source(instance) -> str:
 @click.option('-d', '--docker-image', is_flag=True, help='Show docker image source for every instance listed')
 @click.option('-p', '--piu', metavar='REASON', help='execute PIU request-access command')
 @click.option('-O', '--odd-host', help='Odd SSH bastion hostname', envvar='ODD_HOST', metavar='HOSTNAME')
-@region_option
-@output_option
+@click.option('--piu-concurrency', type=click.IntRange(1, MAX_FAN_OUT), default=DEFAULT_CONCURRENCY, metavar='N',
+              help='Number of PIU access requests to run in parallel')
+@regions_option
+@profiles_option
+@stream_output_option
 @watch_option
 @watchrefresh_option
-def instances(stack_ref, all, terminated, docker_image, piu, odd_host, region, output, w, watch):
+def instances(stack_ref, all, terminated, docker_image, piu, odd_host, piu_concurrency, region, profiles, output, w,
+              watch):
     '''List the stack's EC2 instances'''
     stack_refs = get_stack_refs(stack_ref)
-    region = get_region(region)
-    check_credentials(region)
+    sessions, regions = get_fan_out_targets(profiles, region)
 
-    ec2 = boto3.resource('ec2', region)
-    elb = boto3.client('elb', region)
+    opt_docker_column = ' docker_source' if docker_image else ''
+    cols = get_fan_out_columns(sessions, regions, 'stack_name version resource_id instance_id ' +
+                               'public_ip private_ip state lb_status{} launch_time'.format(opt_docker_column))
 
-    if all:
-        filters = []
-    else:
-        # filter out instances not part of any stack
-        filters = [{'Name': 'tag-key', 'Values': ['aws:cloudformation:stack-name']}]
+    # private IPs access was already requested for (in previous watch ticks)
+    requested = set()
 
-    opt_docker_column = ' docker_source' if docker_image else ''
+    def request_access(rows):
+        if piu is not None:
+            ips = sorted({row['private_ip'] for row in rows if row['private_ip'] is not None} - requested)
+            requested.update(ips)
+            # keep the NDJSON output parseable
+            request_piu_access(ips, piu, odd_host, piu_concurrency, err=output == 'ndjson')
+
+    # the piu output below the table cannot be redrawn
+    screen = WatchScreen(w or watch, differential=piu is None)
+    for _ in watching(w, watch, screen):
+        if output == 'ndjson':
+            # rows are only kept to request access for them
+            rows = []
+            for row in stream_fan_out_rows(sessions, regions, get_instance_rows, stack_refs, all, terminated,
+                                           docker_image):
+                print_ndjson_row(cols, row)
+                if piu is not None:
+                    rows.append(row)
+            request_access(rows)
+            continue
 
-    for _ in watching(w, watch):
-        rows = []
+        rows = get_fan_out_rows(sessions, regions, get_instance_rows, stack_refs, all, terminated, docker_image)
 
-        for instance in ec2.instances.filter(Filters=filters):
-            cf_stack_name = get_tag(instance.tags, 'aws:cloudformation:stack-name')
-            stack_name = get_tag(instance.tags, 'StackName')
-            stack_version = get_tag(instance.tags, 'StackVersion')
-            if not stack_refs or matches_any(cf_stack_name, stack_refs):
-                instance_health = get_instance_health(elb, cf_stack_name)
-                if instance.state['Name'].upper() != 'TERMINATED' or terminated:
-
-                    docker_source = get_instance_docker_image_source(instance) if docker_image else ''
-
-                    rows.append({'stack_name': stack_name or '',
-                                 'version': stack_version or '',
-                                 'resource_id': get_tag(instance.tags, 'aws:cloudformation:logical-id'),
-                                 'instance_id': instance.id,
-                                 'public_ip': instance.public_ip_address,
-                                 'private_ip': instance.private_ip_address,
-                                 'state': instance.state['Name'].upper().replace('-', '_'),
-                                 'lb_status': instance_health.get(instance.id),
-                                 'docker_source': docker_source,
-                                 'launch_time': instance.launch_time.timestamp()})
-
-        rows.sort(key=lambda r: (r['stack_name'], r['version'], r['instance_id']))
+        rows.sort(key=lambda r: (r['stack_name'], r['version'], r['account'], r['region'], r['instance_id']))
 
         with OutputFormat(output):
-            print_table(('stack_name version resource_id instance_id public_ip ' +
-                         'private_ip state lb_status{} launch_time'.format(opt_docker_column)).split(),
-                        rows, styles=STYLES, titles=TITLES)
+            screen.print_table(cols, rows, key=['instance_id'], styles=STYLES, titles=TITLES)
 
-        if piu is not None:
-            for row in rows:
-                if row['private_ip'] is not None:
-                    cmd = ['piu', 'request-access', row['private_ip'], '{} via senza'.format(piu)]
-                    if odd_host is not None:
-                        cmd.extend(['-O', odd_host])
-                    call(cmd)
+        request_access(rows)
+
+
+def get_status_rows(session, region, stack_refs):
+    ec2 = session.client('ec2', region)
+    elb = session.client('elb', region)
+
+    stacks = sorted(get_stacks(stack_refs, region, session=session))
+    resources = get_stack_resources([stack.StackName for stack in stacks], region, ['AWS::Route53::RecordSet'],
+                                    session)
+
+    prober = get_prober()
+    probes = []
+    for stack in stacks:
+        for res in resources[stack.StackName]:
+            name = res.get('PhysicalResourceId')
+            if not name:
+                # physical resource ID will be empty during stack creation
+                continue
+            if 'version' in res['LogicalResourceId'].lower():
+                probes.append((stack.StackName, prober.get_http_status, name))
+            else:
+                probes.append((stack.StackName, prober.get_cname_targets, name))
+    results = prober.run([(func, name) for stack_name, func, name in probes])
+
+    http_status = {}
+    main_dns_resolves = collections.defaultdict(bool)
+    for (stack_name, func, name), result in zip(probes, results):
+        if func == prober.get_http_status:
+            http_status[stack_name] = result
+        elif result == UNKNOWN:
+            main_dns_resolves[stack_name] = main_dns_resolves[stack_name] or UNKNOWN
+        elif any(target.startswith('{}-'.format(stack_name)) for target in result):
+            main_dns_resolves[stack_name] = True
+
+    # terminated instances count as well (until EC2 forgets them), but not those of a deleted stack with the same name
+    index = get_instance_index(ec2, [stack.StackId for stack in stacks], terminated=True, stack_tag=STACK_ID_TAG)
+    rows = []
+    for stack in stacks:
+        instance_health = get_instance_health(elb, stack.StackName)
+
+        instances = index.get_stack_instances(stack.StackId)
+        rows.append({'stack_name': stack.name,
+                     'version': stack.version,
+                     'status': stack.StackStatus,
+                     'total_instances': len(instances),
+                     'running_instances': len([i for i in instances if i.state == 'running']),
+                     'healthy_instances': len([i for i in instance_health.values() if i == 'IN_SERVICE']),
+                     'lb_status': ','.join(set(instance_health.values())),
+                     'main_dns': main_dns_resolves[stack.StackName],
+                     'http_status': http_status.get(stack.StackName)
+                     })
+    return rows
 
 
 @cli.command()
 @click.argument('stack_ref', nargs=-1)
-@region_option
+@regions_option
+@profiles_option
 @output_option
 @watch_option
 @watchrefresh_option
-def status(stack_ref, region, output, w, watch):
+def status(stack_ref, region, profiles, output, w, watch):
     '''Show stack status information'''
     stack_refs = get_stack_refs(stack_ref)
-    region = get_region(region)
-    check_credentials(region)
-
-    ec2 = boto3.resource('ec2', region)
-    elb = boto3.client('elb', region)
-    cf = boto3.resource('cloudformation', region)
+    sessions, regions = get_fan_out_targets(profiles, region)
 
-    for _ in watching(w, watch):
-        rows = []
-        for stack in sorted(get_stacks(stack_refs, region)):
-            instance_health = get_instance_health(elb, stack.StackName)
-
-            main_dns_resolves = False
-            http_status = None
-            for res in cf.Stack(stack.StackId).resource_summaries.all():
-                if res.resource_type == 'AWS::Route53::RecordSet':
-                    name = res.physical_resource_id
-                    if not name:
-                        # physical resource ID will be empty during stack creation
-                        continue
-                    if 'version' in res.logical_id.lower():
-                        try:
-                            requests.get('https://{}/'.format(name), timeout=2)
-                            http_status = 'OK'
-                        except:
-                            http_status = 'ERROR'
-                    else:
-                        try:
-                            answers = dns.resolver.query(name, 'CNAME')
-                        except:
-                            answers = []
-                        for answer in answers:
-                            if answer.target.to_text().startswith('{}-'.format(stack.StackName)):
-                                main_dns_resolves = True
-
-            instances = list(ec2.instances.filter(Filters=[{'Name': 'tag:aws:cloudformation:stack-id',
-                                                            'Values': [stack.StackId]}]))
-            rows.append({'stack_name': stack.name,
-                         'version': stack.version,
-                         'status': stack.StackStatus,
-                         'total_instances': len(instances),
-                         'running_instances': len([i for i in instances if i.state['Name'] == 'running']),
-                         'healthy_instances': len([i for i in instance_health.values() if i == 'IN_SERVICE']),
-                         'lb_status': ','.join(set(instance_health.values())),
-                         'main_dns': main_dns_resolves,
-                         'http_status': http_status
-                         })
+    screen = WatchScreen(w or watch)
+    for _ in watching(w, watch, screen):
+        rows = get_fan_out_rows(sessions, regions, get_status_rows, stack_refs)
+        rows.sort(key=lambda x: (x['stack_name'], x['version'], x['account'], x['region']))
 
         with OutputFormat(output):
-            print_table(('stack_name version status total_instances running_instances healthy_instances ' +
-                         'lb_status http_status main_dns').split(), rows, styles=STYLES, titles=TITLES)
+            screen.print_table(get_fan_out_columns(sessions, regions,
+                                                   'stack_name version status total_instances running_instances ' +
+                                                   'healthy_instances lb_status http_status main_dns'),
+                               rows, key=STACK_ROW_KEY, styles=STYLES, titles=TITLES)
+
+
+def get_domain_rows(session, region, stack_refs):
+    '''Yield the domain rows while the stacks are listed, ROWS_CHUNK_SIZE stacks at a time'''
+    # performance optimization: do not call the Cloud Formation API for "dead" stacks
+    stacks = (stack for stack in get_stacks(stack_refs, region, session=session)
+              if stack.StackStatus != 'ROLLBACK_COMPLETE')
+    for chunk in chunked(stacks, ROWS_CHUNK_SIZE):
+        resources = get_stack_resources([stack.StackName for stack in chunk], region, ['AWS::Route53::RecordSet'],
+                                        session)
+        for stack in chunk:
+            for res in resources[stack.StackName]:
+                name = res['PhysicalResourceId']
+                record = None
+                index = get_record_index(name.split('.', 1)[1], session=session)
+                for record_sets in index.get(name.rstrip('.'), {}).values():
+                    record = record or record_sets.get(stack.StackName) or record_sets.get(None)
+                row = {'stack_name': stack.name,
+                       'version': stack.version,
+                       'resource_id': res['LogicalResourceId'],
+                       'domain': name,
+                       'weight': None,
+                       'type': None,
+                       'value': None,
+                       'create_time': calendar.timegm(res['LastUpdatedTimestamp'].timetuple())}
+                if record:
+                    row.update({'weight': str(record.get('Weight', '')),
+                                'type': record.get('Type'),
+                                'value': ','.join([r['Value'] for r in record.get('ResourceRecords')])})
+                yield row
 
 
 @cli.command()
 @click.argument('stack_ref', nargs=-1)
-@region_option
-@output_option
+@regions_option
+@profiles_option
+@stream_output_option
 @watch_option
 @watchrefresh_option
-def domains(stack_ref, region, output, w, watch):
+def domains(stack_ref, region, profiles, output, w, watch):
     '''List the stack's Route53 domains'''
     stack_refs = get_stack_refs(stack_ref)
-    region = get_region(region)
-    check_credentials(region)
+    sessions, regions = get_fan_out_targets(profiles, region)
 
-    cf = boto3.resource('cloudformation', region)
+    cols = get_fan_out_columns(sessions, regions, 'stack_name version resource_id domain weight type value create_time')
 
-    records_by_name = {}
-
-    for _ in watching(w, watch):
-        rows = []
-        for stack in get_stacks(stack_refs, region):
-            if stack.StackStatus == 'ROLLBACK_COMPLETE':
-                # performance optimization: do not call EC2 API for "dead" stacks
-                continue
+    screen = WatchScreen(w or watch)
+    for _ in watching(w, watch, screen):
+        if output == 'ndjson':
+            for row in stream_fan_out_rows(sessions, regions, get_domain_rows, stack_refs):
+                print_ndjson_row(cols, row)
+            continue
 
-            for res in cf.Stack(stack.StackId).resource_summaries.all():
-                if res.resource_type == 'AWS::Route53::RecordSet':
-                    name = res.physical_resource_id
-                    if name not in records_by_name:
-                        zone_name = name.split('.', 1)[1]
-                        for rec in get_records(zone_name):
-                            records_by_name[(rec['Name'].rstrip('.'), rec.get('SetIdentifier'))] = rec
-                    record = records_by_name.get((name, stack.StackName)) or records_by_name.get((name, None))
-                    row = {'stack_name': stack.name,
-                           'version': stack.version,
-                           'resource_id': res.logical_id,
-                           'domain': res.physical_resource_id,
-                           'weight': None,
-                           'type': None,
-                           'value': None,
-                           'create_time': calendar.timegm(res.last_updated_timestamp.timetuple())}
-                    if record:
-                        row.update({'weight': str(record.get('Weight', '')),
-                                    'type': record.get('Type'),
-                                    'value': ','.join([r['Value'] for r in record.get('ResourceRecords')])})
-                    rows.append(row)
+        rows = get_fan_out_rows(sessions, regions, get_domain_rows, stack_refs)
 
         with OutputFormat(output):
-            print_table('stack_name version resource_id domain weight type value create_time'.split(),
-                        rows, styles=STYLES, titles=TITLES)
+            screen.print_table(cols, rows, key=STACK_ROW_KEY + ['resource_id'], styles=STYLES, titles=TITLES)
 
 
 @cli.command()
@@ -1056,64 +1471,90 @@ def traffic(stack_name, stack_version, percentage, region, output):
                 change_version_traffic(ref, percentage, region)
 
 
-@cli.command()
-@click.argument('stack_ref', nargs=-1)
-@click.option('--hide-older-than', help='Hide images older than X days (default: 21)',
-              type=int, default=21, metavar='DAYS')
-@click.option('--show-instances', is_flag=True, help='Show EC2 instance IDs')
-@region_option
-@output_option
-def images(stack_ref, region, output, hide_older_than, show_instances):
-    '''Show all used AMIs and available Taupage AMIs'''
-    stack_refs = get_stack_refs(stack_ref)
-    region = get_region(region)
-    check_credentials(region)
+def get_stack_name_filter_values(stack_refs: list) -> list:
+    '''
+    >>> get_stack_name_filter_values([StackReference('foo', None), StackReference('bar', '1')])
+    ['foo-*', 'bar-1']
+    '''
+    return [ref.cf_stack_name() if ref.version else '{}-*'.format(ref.name) for ref in stack_refs]
 
-    ec2 = boto3.resource('ec2', region)
 
-    instances_by_image = collections.defaultdict(list)
-    for inst in ec2.instances.all():
-        if inst.state['Name'] == 'terminated':
-            # do not count TERMINATED EC2 instances
-            continue
-        stack_name = get_tag(inst.tags, 'aws:cloudformation:stack-name')
-        if not stack_refs or matches_any(stack_name, stack_refs):
-            instances_by_image[inst.image_id].append(inst)
+def get_image_usage(ec2, stack_refs: list) -> dict:
+    '''Return {image ID: ([instance ID], {stack name})} of all non-terminated instances (of the given stacks)
+
+    Instances are filtered by EC2 (stack name tag and instance state) and only their ID, image ID and stack name
+    are kept.'''
+    filters = get_instance_filters(get_stack_name_filter_values(stack_refs) if stack_refs else None)
+    usage = {}
+    seen = set()
+    for chunk_filters in filters:
+        for instance_id, image_id, stack_name in describe_instance_images(ec2, chunk_filters):
+            # the tag filter's wildcards also match other stacks ("foo-*" matches "foo-bar-1")
+            if instance_id in seen or (stack_refs and not matches_any(stack_name, stack_refs)):
+                continue
+            seen.add(instance_id)
+            instance_ids, stacks = usage.setdefault(image_id, ([], set()))
+            instance_ids.append(instance_id)
+            # EC2 instance might not be part of a CF stack
+            if stack_name:
+                stacks.add(stack_name)
+    return usage
+
+
+def get_image_rows(session, region, stack_refs, hide_older_than):
+    '''Yield the rows of the used images as soon as their chunk is described, then the unused Taupage images'''
+    ec2 = session.client('ec2', region)
 
-    images = {}
-    for image in ec2.images.filter(ImageIds=list(instances_by_image.keys())):
-        images[image.id] = image
+    usage = get_image_usage(ec2, stack_refs)
+    images = describe_image_chunks(ec2, sorted(usage))
     if not stack_refs:
         filters = [{'Name': 'name', 'Values': ['*Taupage-*']},
                    {'Name': 'state', 'Values': ['available']}]
-        for image in ec2.images.filter(Filters=filters):
-            images[image.id] = image
-    rows = []
+        images = itertools.chain(images, (image for image in ec2.describe_images(Filters=filters)['Images']
+                                          if image['ImageId'] not in usage))
     cutoff = datetime.datetime.now() - datetime.timedelta(days=hide_older_than)
-    for image in images.values():
-        row = image.meta.data.copy()
-        creation_time = parse_time(image.creation_date)
+    for image in images:
+        row = image.copy()
+        creation_time = parse_time(image['CreationDate'])
+        instance_ids, stacks = usage.get(image['ImageId'], ([], set()))
         row['creation_time'] = creation_time
-        row['instances'] = ', '.join(sorted(i.id for i in instances_by_image[image.id]))
-        row['total_instances'] = len(instances_by_image[image.id])
-        stacks = set()
-        for instance in instances_by_image[image.id]:
-            stack_name = get_tag(instance.tags, 'aws:cloudformation:stack-name')
-            # EC2 instance might not be part of a CF stack
-            if stack_name:
-                stacks.add(stack_name)
+        row['instances'] = ', '.join(sorted(instance_ids))
+        row['total_instances'] = len(instance_ids)
         row['stacks'] = ', '.join(sorted(stacks))
 
         #
         if creation_time > cutoff.timestamp() or row['total_instances']:
-            rows.append(row)
+            yield row
+
 
-    rows.sort(key=lambda x: x.get('Name'))
+@cli.command()
+@click.argument('stack_ref', nargs=-1)
+@click.option('--hide-older-than', help='Hide images older than X days (default: 21)',
+              type=int, default=21, metavar='DAYS')
+@click.option('--show-instances', is_flag=True, help='Show EC2 instance IDs')
+@regions_option
+@profiles_option
+@stream_output_option
+def images(stack_ref, region, profiles, output, hide_older_than, show_instances):
+    '''Show all used AMIs and available Taupage AMIs'''
+    stack_refs = get_stack_refs(stack_ref)
+    sessions, regions = get_fan_out_targets(profiles, region)
+
+    cols = 'ImageId Name OwnerId Description stacks total_instances creation_time'
+    if show_instances:
+        cols = cols.replace('total_instances', 'instances')
+    cols = get_fan_out_columns(sessions, regions, cols)
+
+    if output == 'ndjson':
+        for row in stream_fan_out_rows(sessions, regions, get_image_rows, stack_refs, hide_older_than):
+            print_ndjson_row(cols, row)
+        return
+
+    rows = get_fan_out_rows(sessions, regions, get_image_rows, stack_refs, hide_older_than)
+
+    rows.sort(key=lambda x: (x.get('Name'), x['account'], x['region']))
     with OutputFormat(output):
-        cols = 'ImageId Name OwnerId Description stacks total_instances creation_time'
-        if show_instances:
-            cols = cols.replace('total_instances', 'instances')
-        print_table(cols.split(), rows, titles=TITLES, max_column_widths=MAX_COLUMN_WIDTHS)
+        print_table(cols, rows, titles=TITLES, max_column_widths=MAX_COLUMN_WIDTHS)
 
 
 def is_ip_address(x: str):
@@ -1166,14 +1607,73 @@ def print_console(line: str):
     click.secho(line, **style)
 
 
+# seconds the instances of "console --follow" are reused before EC2 is scanned again
+CONSOLE_INSTANCES_MAX_AGE = 30
+
+# number of trailing console lines identifying the position up to which the output was printed
+CONSOLE_FINGERPRINT_LINES = 3
+
+
+def get_new_console_lines(lines: list, last_lines: list) -> list:
+    '''Return the lines following the last occurrence of last_lines (all lines if they are not found)
+
+    >>> get_new_console_lines(['a', 'b', 'c', 'b', 'c', 'd'], ['b', 'c'])
+    ['d']
+    >>> get_new_console_lines(['x', 'y'], ['b', 'c'])
+    ['x', 'y']
+    '''
+    n = len(last_lines)
+    if n:
+        for i in range(len(lines) - n, -1, -1):
+            if lines[i:i + n] == last_lines:
+                return lines[i + n:]
+    return lines
+
+
+def get_console_label(instance) -> str:
+    cf_stack_name = instance.tags.get(STACK_NAME_TAG)
+    return '{}/{}'.format(cf_stack_name, instance.private_ip_address or instance.id)
+
+
+def follow_console(ec2, get_instances, limit: int, interval: int, concurrency: int):
+    '''Print new console lines of all instances as they appear (like "tail -f")'''
+    scheduler = PollingScheduler(interval, interval * WATCH_BACKOFF)
+    # instance ID => (output timestamp, last printed lines)
+    known = {}
+    last_label = None
+    while True:
+        instances = get_instances()
+        changed = False
+        outputs = parallel_map(lambda instance: get_console_output(ec2, instance.id), instances, concurrency)
+        for instance, output in zip(instances, outputs):
+            timestamp, last_lines = known.get(instance.id, (None, None))
+            if last_lines is not None and output.get('Timestamp') == timestamp:
+                continue
+            # the last line might still be incomplete
+            lines = (output.get('Output') or '').split('\n')[:-1]
+            new_lines = lines[-limit:] if last_lines is None else get_new_console_lines(lines, last_lines)
+            if new_lines:
+                label = get_console_label(instance)
+                if label != last_label:
+                    click.secho('==> {} <=='.format(label), bold=True)
+                    last_label = label
+                for line in new_lines:
+                    print_console(line)
+                changed = True
+            known[instance.id] = (output.get('Timestamp'), lines[-CONSOLE_FINGERPRINT_LINES:] or last_lines or [])
+        scheduler.sleep(changed)
+
+
 @cli.command()
 @click.argument('instance_or_stack_ref', nargs=-1)
 @click.option('-l', '--limit', help='Show last N lines of console output (default: 25)',
               type=int, default=25, metavar='N')
+@click.option('-f', '--follow', is_flag=True, help='Print new console lines as they appear (like "tail -f")')
 @region_option
 @watch_option
 @watchrefresh_option
-def console(instance_or_stack_ref, limit, region, w, watch):
+@concurrency_option
+def console(instance_or_stack_ref, limit, follow, region, w, watch, concurrency):
     '''Print EC2 instance console output.
 
     INSTANCE_OR_STACK_REF can be an instance ID, private IP address or stack name/version.'''
@@ -1186,38 +1686,43 @@ def console(instance_or_stack_ref, limit, region, w, watch):
         filters = [{'Name': 'private-ip-address', 'Values': list(instance_or_stack_ref)}]
     else:
         stack_refs = get_stack_refs(instance_or_stack_ref)
-        # filter out instances not part of any stack
-        filters = [{'Name': 'tag-key', 'Values': ['aws:cloudformation:stack-name']}]
+        filters = None
 
     region = get_region(region)
     check_credentials(region)
 
-    ec2 = boto3.resource('ec2', region)
+    ec2 = boto3.client('ec2', region)
 
-    for _ in watching(w, watch):
+    def get_instances():
+        # the instances change less often than their console output while following
+        max_age = CONSOLE_INSTANCES_MAX_AGE if follow else 0
+        if stack_refs is None:
+            # instances asked for by ID or IP are shown even if they are terminated
+            return list(get_instance_index(ec2, terminated=True, max_age=max_age, filters=filters).instances.values())
+        index = get_instance_index(ec2, get_stack_name_filter_values(stack_refs) if stack_refs else None,
+                                   max_age=max_age)
+        return [instance for name in index.get_stack_names() if not stack_refs or matches_any(name, stack_refs)
+                for instance in index.get_stack_instances(name)]
+
+    if follow:
+        follow_console(ec2, get_instances, limit, watch or 2, concurrency)
 
-        for instance in ec2.instances.filter(Filters=filters):
-            cf_stack_name = get_tag(instance.tags, 'aws:cloudformation:stack-name')
-            if not stack_refs or matches_any(cf_stack_name, stack_refs):
-                output = {}
-                try:
-                    output = instance.console_output()
-                except:
-                    pass
-                click.secho('Showing last {} lines of {}/{}..'.format(limit,
-                                                                      cf_stack_name,
-                                                                      instance.private_ip_address or instance.id),
-                            bold=True)
-                if isinstance(output, dict) and output.get('Output'):
-                    for line in output['Output'].split('\n')[-limit:]:
-                        print_console(line)
+    for _ in watching(w, watch):
+        instances = get_instances()
+        outputs = parallel_map(lambda instance: get_console_output(ec2, instance.id), instances, concurrency)
+        for instance, output in zip(instances, outputs):
+            click.secho('Showing last {} lines of {}..'.format(limit, get_console_label(instance)), bold=True)
+            if output.get('Output'):
+                for line in output['Output'].split('\n')[-limit:]:
+                    print_console(line)
 
 
 @cli.command()
 @click.argument('stack_ref', nargs=-1)
 @region_option
 @json_output_option
-def dump(stack_ref, region, output):
+@concurrency_option
+def dump(stack_ref, region, output, concurrency):
     '''Dump Cloud Formation template of existing stack'''
     stack_refs = get_stack_refs(stack_ref)
     region = get_region(region)
@@ -1225,21 +1730,22 @@ def dump(stack_ref, region, output):
 
     cf = boto3.client('cloudformation', region)
 
-    for stack in get_stacks(stack_refs, region):
-        data = cf.get_template(StackName=stack.StackName)['TemplateBody']
+    def get_template(stack):
+        return call_with_backoff(cf.get_template, StackName=stack.StackName)['TemplateBody']
+
+    for data in parallel_map(get_template, get_stacks(stack_refs, region), concurrency):
         cfjson = json.dumps(data, sort_keys=True, indent=4)
         print_json(cfjson, output)
 
 
 def get_auto_scaling_groups(stack_refs, region):
-    cf = boto3.client('cloudformation', region)
-    for stack in get_stacks(stack_refs, region):
-        resources = cf.describe_stack_resources(StackName=stack.StackName)['StackResources']
-
-        for resource in resources:
-            if resource['ResourceType'] == 'AWS::AutoScaling::AutoScalingGroup':
-                asg_name = resource['PhysicalResourceId']
-                yield asg_name
+    stacks = list(get_stacks(stack_refs, region))
+    resources = get_stack_resources([stack.StackName for stack in stacks], region,
+                                    ['AWS::AutoScaling::AutoScalingGroup'])
+    for stack in stacks:
+        for resource in resources[stack.StackName]:
+            asg_name = resource['PhysicalResourceId']
+            yield asg_name
 
 
 @cli.command()
@@ -1340,6 +1846,11 @@ def failure_event(event: dict):
     return bool(event.get('ResourceStatusReason') and ('FAIL' in status or 'ROLLBACK' in status))
 
 
+# polling interval bounds of "wait" (in seconds)
+WAIT_MIN_INTERVAL = 3
+WAIT_MAX_INTERVAL = 30
+
+
 @cli.command()
 @click.argument('stack_ref', nargs=-1)
 @click.option('-d', '--deletion', is_flag=True, help='Wait for deletion instead of CREATE_COMPLETE')
@@ -1358,15 +1869,22 @@ def wait(stack_ref, region, deletion, timeout):
     cutoff = time.time() + timeout
     target_status = 'DELETE_COMPLETE' if deletion else 'CREATE_COMPLETE'
 
+    scheduler = PollingScheduler(WAIT_MIN_INTERVAL, WAIT_MAX_INTERVAL)
+    last_stacks_nok = None
     while time.time() < cutoff:
         stacks_ok = set()
         stacks_nok = set()
-        for stack in get_stacks(stack_refs, region, all=True):
+        # always refresh the inventory (if enabled) as we are waiting for status changes
+        for stack in get_stacks(stack_refs, region, all=True, max_age=0):
             if stack.StackStatus == target_status:
                 stacks_ok.add((stack.name, stack.version))
             elif stack.StackStatus.endswith('_FAILED') or stack.StackStatus.endswith('_COMPLETE'):
-                # output event messages for troubleshooting
-                events = cf.describe_stack_events(StackName=stack.StackId)['StackEvents']
+                # output event messages of the last stack operation for troubleshooting
+                # (a rolled back stack has a DeletionTime from after the resource failure which caused the rollback)
+                keys = ('CreationTime', 'LastUpdatedTime') + (('DeletionTime',) if deletion else ())
+                operation_start = max([calendar.timegm(stack.stack[key].utctimetuple())
+                                       for key in keys if stack.stack.get(key)], default=None)
+                events = get_stack_events(cf, stack.StackId, since=operation_start)
 
                 for event in sorted(events, key=lambda x: x['Timestamp']):
                     if failure_event(event):
@@ -1376,9 +1894,10 @@ def wait(stack_ref, region, deletion, timeout):
                 stacks_nok.add((stack.name, stack.version, stack.StackStatus))
 
         if stacks_nok:
-            info('Waiting up to {:.0f} more secs for stack{} {}..'.format(cutoff - time.time(),
+            info('Waiting up to {:.0f} more secs for stack{} {}.. ({})'.format(cutoff - time.time(),
                  's' if len(stacks_nok) > 1 else '',
-                 ', '.join(['{}-{} ({})'.format(*x) for x in sorted(stacks_nok)])))
+                 ', '.join(['{}-{} ({})'.format(*x) for x in sorted(stacks_nok)]),
+                 scheduler.describe().lower()))
         elif stacks_ok:
             ok('OK: Stack(s) {} {} successfully.'.format(
                ', '.join(['{}-{}'.format(*x) for x in sorted(stacks_ok)]),
@@ -1386,7 +1905,10 @@ def wait(stack_ref, region, deletion, timeout):
             return
         else:
             raise click.UsageError('No matching stack for "{}" found'.format(' '.join(stack_ref)))
-        time.sleep(5)
+        # do not sleep past the timeout
+        scheduler.sleep(last_stacks_nok is None or stacks_nok != last_stacks_nok,
+                        max_seconds=max(0, cutoff - time.time()))
+        last_stacks_nok = stacks_nok
     raise click.Abort()
 
 
@@ -0,0 +1,207 @@
+'''
+Shell completion of stack names and versions
+
+Completion is answered from a locally cached stack index which is refreshed in a background process,
+i.e. completing never waits for AWS and never imports boto3 (or the full CLI).
+'''
+import json
+import os
+import subprocess
+import sys
+import time
+
+from .utils import get_cache_dir, get_default_region
+
+COMPLETE_VAR = '_SENZA_COMPLETE'
+
+# seconds after which the stack index is refreshed in the background
+INDEX_TTL = 60
+
+COMMANDS = ('console', 'create', 'delete', 'domains', 'dump', 'events', 'images', 'init', 'instances', 'list',
+            'patch', 'print', 'resources', 'respawn-instances', 'scale', 'status', 'traffic', 'update', 'wait')
+
+# commands taking STACK_REF arguments
+STACK_REF_COMMANDS = ('console', 'delete', 'domains', 'dump', 'events', 'images', 'instances', 'list', 'patch',
+                      'resources', 'respawn-instances', 'scale', 'status', 'traffic', 'wait')
+
+# options taking a value (of any command)
+VALUE_OPTIONS = ('--concurrency', '--hide-older-than', '--image', '--instance-type', '--inventory-max-age', '--limit',
+                 '--odd-host', '--output', '--piu', '--piu-concurrency', '--profile', '--region', '--since', '--tag',
+                 '--template', '--timeout', '--user-data', '--user-variable', '--watch',
+                 '-O', '-P', '-l', '-o', '-p', '-t', '-v', '-w')
+
+COMPLETION_SCRIPT = '''
+_senza_completion() {
+    COMPREPLY=( $( env COMP_WORDS="${COMP_WORDS[*]}" \\
+                   COMP_CWORD=$COMP_CWORD \\
+                   _SENZA_COMPLETE=complete $1 ) )
+    return 0
+}
+
+complete -F _senza_completion -o default senza;
+'''
+
+
+def get_index_path(region: str):
+    return os.path.join(get_cache_dir(), 'stack-index-{}.json'.format(region))
+
+
+def read_index(region: str):
+    '''Return the cached stack index {"updated": .., "stacks": {name: [version, ..]}} or None'''
+    try:
+        with open(get_index_path(region)) as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return None
+
+
+def write_index(region: str, stacks: dict):
+    path = get_index_path(region)
+    tmp_path = '{}.{}'.format(path, os.getpid())
+    with open(tmp_path, 'w') as fd:
+        json.dump({'updated': time.time(), 'stacks': stacks}, fd)
+    os.replace(tmp_path, path)
+
+
+def refresh_index(region: str):
+    '''Rebuild the stack index of the given region (called in the background process)'''
+    # imported here to keep boto3 out of the completion process
+    from .aws import get_stacks
+    stacks = {}
+    for stack in get_stacks([], region):
+        stacks.setdefault(stack.name, []).append(stack.version)
+    write_index(region, {name: sorted(versions) for name, versions in stacks.items()})
+
+
+def schedule_refresh(region: str, index):
+    '''Start a background refresh of an outdated index (at most one every INDEX_TTL seconds)'''
+    if index and index.get('updated', 0) > time.time() - INDEX_TTL:
+        return
+    marker = get_index_path(region) + '.refresh'
+    try:
+        if os.path.getmtime(marker) > time.time() - INDEX_TTL:
+            return
+    except OSError:
+        pass
+    with open(marker, 'w'):
+        pass
+    subprocess.Popen([sys.executable, '-m', 'senza.completion', 'refresh', region],
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                     start_new_session=True)
+
+
+def join_word_breaks(words: list) -> list:
+    '''Join options bash split at its COMP_WORDBREAKS (e.g. "--region", "=", "eu-west-1")
+
+    >>> join_word_breaks(['list', '--region', '=', 'eu-west-1', 'foo'])
+    ['list', '--region=eu-west-1', 'foo']
+    >>> join_word_breaks(['list', '--region', '='])
+    ['list', '--region=']
+    '''
+    args = []
+    for word in words:
+        if args and args[-1].startswith('-') and (word == '=' or args[-1].endswith('=')):
+            args[-1] += word
+        else:
+            args.append(word)
+    return args
+
+
+def get_positional_args(args: list) -> list:
+    '''
+    >>> get_positional_args(['--region', 'eu-west-1', 'list', '-W', '-o', 'json', 'myapp', '--region=x', '1'])
+    ['list', 'myapp', '1']
+    '''
+    positional = []
+    skip = False
+    for arg in args:
+        if skip:
+            skip = False
+        elif arg.startswith('-'):
+            skip = arg in VALUE_OPTIONS
+        else:
+            positional.append(arg)
+    return positional
+
+
+def get_completion_region(args: list):
+    '''
+    >>> get_completion_region(['list', '--region=eu-central-1,eu-west-1'])
+    'eu-central-1'
+    >>> get_completion_region(['list', '--region', 'eu-central-1', 'foo'])
+    'eu-central-1'
+    >>> get_completion_region(['list', '--region', '=', 'eu-west-1', 'foo'])
+    'eu-west-1'
+    '''
+    args = join_word_breaks(args)
+    for i, arg in enumerate(args):
+        if arg.startswith('--region='):
+            return arg.split('=', 1)[1].split(',')[0]
+        elif arg == '--region' and i + 1 < len(args):
+            return args[i + 1].split(',')[0]
+    return os.environ.get('AWS_DEFAULT_REGION') or get_default_region()
+
+
+def get_choices(args: list, incomplete: str, index):
+    '''Return completion candidates for the given command line arguments
+
+    >>> index = {'stacks': {'myapp': ['v1', 'v2'], 'other': ['1']}}
+    >>> get_choices([], 'd', index)
+    ['delete', 'domains', 'dump']
+    >>> get_choices(['traffic'], 'm', index)
+    ['myapp']
+    >>> get_choices(['traffic', 'myapp'], '', index)
+    ['v1', 'v2', 'myapp', 'other']
+    >>> get_choices(['create'], '', index)
+    []
+    >>> get_choices(['traffic', '--region', '=', 'eu-west-1', 'myapp'], '', index)
+    ['v1', 'v2', 'myapp', 'other']
+    >>> get_choices(['traffic', '--region', '='], 'm', index)
+    []
+    '''
+    args = join_word_breaks(args)
+    if args and (args[-1] in VALUE_OPTIONS or (args[-1].startswith('-') and args[-1].endswith('='))):
+        # the option's value is being completed
+        return []
+    commands = get_positional_args(args)
+    if not commands:
+        choices = list(COMMANDS)
+    elif commands[0] not in STACK_REF_COMMANDS or incomplete.startswith('-'):
+        choices = []
+    else:
+        stacks = (index or {}).get('stacks', {})
+        choices = sorted(stacks)
+        if len(commands) > 1 and commands[-1] in stacks:
+            choices = stacks[commands[-1]] + choices
+    return [choice for choice in choices if choice.startswith(incomplete)]
+
+
+def complete():
+    words = os.environ.get('COMP_WORDS', '').split()
+    cword = int(os.environ.get('COMP_CWORD', 0))
+    args = words[1:cword]
+    incomplete = words[cword] if cword < len(words) else ''
+    index = None
+    region = get_completion_region(args)
+    if region:
+        index = read_index(region)
+        schedule_refresh(region, index)
+    for choice in get_choices(args, incomplete, index):
+        print(choice)
+
+
+def main():
+    '''Console script entry point, answering completion requests without loading the CLI'''
+    instruction = os.environ.get(COMPLETE_VAR)
+    if instruction == 'source':
+        print(COMPLETION_SCRIPT.strip())
+    elif instruction == 'complete':
+        complete()
+    else:
+        import senza.cli
+        senza.cli.main()
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['refresh']:
+        refresh_index(sys.argv[2])
@@ -3,22 +3,23 @@ import boto3
 from senza.components.configuration import component_configuration
 from senza.utils import ensure_keys
 from senza.aws import get_tag
+from senza.ec2 import describe_images
 
 
 def find_taupage_image(region: str):
     '''Find the latest Taupage AMI, first try private images, fallback to public'''
-    ec2 = boto3.resource('ec2', region)
+    ec2 = boto3.client('ec2', region)
     filters = [{'Name': 'name', 'Values': ['*Taupage-AMI-*']},
                {'Name': 'is-public', 'Values': ['false']},
                {'Name': 'state', 'Values': ['available']},
                {'Name': 'root-device-type', 'Values': ['ebs']}]
-    images = list(ec2.images.filter(Filters=filters))
+    images = describe_images(ec2, filters)
     if not images:
         public_filters = [{'Name': 'name', 'Values': ['*Taupage-Public-AMI-*']},
                           {'Name': 'is-public', 'Values': ['true']},
                           {'Name': 'state', 'Values': ['available']},
                           {'Name': 'root-device-type', 'Values': ['ebs']}]
-        images = list(ec2.images.filter(Filters=public_filters))
+        images = describe_images(ec2, public_filters)
     if not images:
         raise Exception('No Taupage AMI found')
     most_recent_image = sorted(images, key=lambda i: i.name)[-1]
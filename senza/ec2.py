@@ -0,0 +1,164 @@
+'''
+Lean EC2 data access on client paginators
+
+boto3 resource collections create a heavy object per item and lazily load attributes (often with one more API
+call per item), so instances and images are described with the client and projected into small named tuples.
+'''
+import collections
+import json
+import threading
+import time
+
+from .parallel import stream_map
+from .polling import call_with_backoff
+
+# instance states which count as existing (i.e. all but "terminated")
+LIVE_INSTANCE_STATES = ['pending', 'running', 'shutting-down', 'stopping', 'stopped']
+
+# instance attributes used by senza, named like the boto3 resource attributes
+Instance = collections.namedtuple('Instance', 'id image_id state private_ip_address public_ip_address launch_time tags')
+INSTANCE_PROJECTION = ('Reservations[].Instances[].[InstanceId, ImageId, State.Name, PrivateIpAddress, '
+                       'PublicIpAddress, LaunchTime, Tags]')
+
+STACK_NAME_TAG = 'aws:cloudformation:stack-name'
+STACK_ID_TAG = 'aws:cloudformation:stack-id'
+
+# only the attributes needed to count the usage of images
+InstanceImage = collections.namedtuple('InstanceImage', 'id image_id stack_name')
+INSTANCE_IMAGE_PROJECTION = ("Reservations[].Instances[].[InstanceId, ImageId, "
+                             "Tags[?Key=='aws:cloudformation:stack-name'].Value | [0]]")
+
+# maximum number of values in a single "DescribeInstances" filter
+MAX_INSTANCE_FILTER_VALUES = 200
+
+Image = collections.namedtuple('Image', 'id name')
+
+# number of images described per "DescribeImages" call
+IMAGE_CHUNK_SIZE = 100
+
+
+# scanned instance indexes: (EC2 client, stack tag, filters) => (scan timestamp, InstanceIndex)
+INSTANCE_INDEXES = {}
+INSTANCE_INDEXES_LOCK = threading.Lock()
+
+
+def get_tag_dict(tags: list) -> dict:
+    '''
+    >>> get_tag_dict([{'Key': 'StackVersion', 'Value': '1'}])
+    {'StackVersion': '1'}
+    >>> get_tag_dict(None)
+    {}
+    '''
+    return {tag['Key']: tag['Value'] for tag in tags or []}
+
+
+def describe_instances(ec2, filters: list=None):
+    '''Yield all instances matching the filters (with tags as dict), page by page'''
+    pages = ec2.get_paginator('describe_instances').paginate(Filters=filters or [])
+    for instance_id, image_id, state, private_ip, public_ip, launch_time, tags in pages.search(INSTANCE_PROJECTION):
+        yield Instance(instance_id, image_id, state, private_ip, public_ip, launch_time, get_tag_dict(tags))
+
+
+def describe_instance_images(ec2, filters: list=None):
+    '''Yield ID, image ID and stack name of all instances matching the filters'''
+    pages = ec2.get_paginator('describe_instances').paginate(Filters=filters or [])
+    for values in pages.search(INSTANCE_IMAGE_PROJECTION):
+        yield InstanceImage._make(values)
+
+
+class InstanceIndex:
+    '''Instances of one scan, indexed by instance ID and by CloudFormation stack name (or by the value of
+    another stack tag, e.g. the stack ID)
+
+    Instances which are not part of any stack are indexed with the stack name None.'''
+
+    def __init__(self, instances, stack_tag: str=STACK_NAME_TAG):
+        self.instances = collections.OrderedDict()
+        self.stacks = collections.OrderedDict()
+        for instance in instances:
+            if instance.id in self.instances:
+                # matched by the filters of more than one chunk
+                continue
+            self.instances[instance.id] = instance
+            self.stacks.setdefault(instance.tags.get(stack_tag), []).append(instance)
+
+    def get(self, instance_id: str):
+        return self.instances.get(instance_id)
+
+    def get_tags(self, instance_id: str) -> dict:
+        instance = self.instances.get(instance_id)
+        return instance.tags if instance else {}
+
+    def get_stack_names(self) -> list:
+        return [name for name in self.stacks if name is not None]
+
+    def get_stack_instances(self, stack_name: str) -> list:
+        return self.stacks.get(stack_name, [])
+
+
+def get_instance_filters(stack_names: list=None, terminated: bool=False, filters: list=None,
+                         stack_tag: str=STACK_NAME_TAG) -> list:
+    '''Return one list of "DescribeInstances" filters (plus the given ones) per chunk of stack names (or other
+    values of the stack tag)
+
+    >>> get_instance_filters()
+    [[{'Name': 'instance-state-name', 'Values': ['pending', 'running', 'shutting-down', 'stopping', 'stopped']}]]
+    >>> get_instance_filters(['foo-1'], terminated=True)
+    [[{'Name': 'tag:aws:cloudformation:stack-name', 'Values': ['foo-1']}]]
+    >>> get_instance_filters([])
+    []
+    >>> get_instance_filters(terminated=True, filters=[{'Name': 'instance-id', 'Values': ['i-123']}])
+    [[{'Name': 'instance-id', 'Values': ['i-123']}]]
+    >>> get_instance_filters(['arn:stack-1'], terminated=True, stack_tag=STACK_ID_TAG)
+    [[{'Name': 'tag:aws:cloudformation:stack-id', 'Values': ['arn:stack-1']}]]
+    '''
+    state_filters = [] if terminated else [{'Name': 'instance-state-name', 'Values': LIVE_INSTANCE_STATES}]
+    state_filters += filters or []
+    if stack_names is None:
+        return [state_filters]
+    return [[{'Name': 'tag:{}'.format(stack_tag), 'Values': stack_names[i:i + MAX_INSTANCE_FILTER_VALUES]}] +
+            state_filters for i in range(0, len(stack_names), MAX_INSTANCE_FILTER_VALUES)]
+
+
+def get_instance_index(ec2, stack_names: list=None, terminated: bool=False, max_age: float=0,
+                       filters: list=None, stack_tag: str=STACK_NAME_TAG) -> InstanceIndex:
+    '''Return the index of all (non-terminated) instances, or only of the given stack names (wildcards allowed)
+
+    EC2 is scanned in one paginated pass (per MAX_INSTANCE_FILTER_VALUES stack names), additional filters
+    (e.g. on the instance ID) are passed to EC2 as well. With stack_tag=STACK_ID_TAG, instances are selected and
+    indexed by stack ID instead. An index of the same scan which is younger than max_age seconds is reused (indexes
+    are only kept for callers passing a max_age).'''
+    filters = get_instance_filters(stack_names, terminated, filters, stack_tag)
+    key = (ec2, stack_tag, json.dumps(filters, sort_keys=True))
+    now = time.time()
+    with INSTANCE_INDEXES_LOCK:
+        scanned, index = INSTANCE_INDEXES.get(key, (None, None))
+    if index is not None and now - scanned < max_age:
+        return index
+    instances = (instance for chunk_filters in filters for instance in describe_instances(ec2, chunk_filters))
+    index = InstanceIndex(instances, stack_tag)
+    if max_age > 0:
+        with INSTANCE_INDEXES_LOCK:
+            INSTANCE_INDEXES[key] = (now, index)
+    return index
+
+
+def describe_images(ec2, filters: list) -> list:
+    return [Image(image['ImageId'], image.get('Name')) for image in ec2.describe_images(Filters=filters)['Images']]
+
+
+def describe_image_chunks(ec2, image_ids: list):
+    '''Yield the given images (all attributes) as soon as their chunk is described (chunks are described
+    concurrently), ignoring images which do not exist anymore'''
+    chunks = [image_ids[i:i + IMAGE_CHUNK_SIZE] for i in range(0, len(image_ids), IMAGE_CHUNK_SIZE)]
+    return stream_map(lambda chunk: call_with_backoff(ec2.describe_images,
+                                                      Filters=[{'Name': 'image-id', 'Values': chunk}])['Images'],
+                      chunks)
+
+
+def get_console_output(ec2, instance_id: str) -> dict:
+    '''Return the console output (already base64-decoded by botocore) or an empty dict if there is none'''
+    try:
+        return ec2.get_console_output(InstanceId=instance_id)
+    except Exception:
+        return {}
@@ -0,0 +1,185 @@
+'''
+Local SQLite inventory of Cloud Formation stack summaries (one database per account and region)
+'''
+import datetime
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import boto3
+
+from .utils import get_cache_dir
+
+# freshness bound in seconds, the inventory is disabled as long as this is None
+MAX_AGE = None
+
+# Cloud Formation keeps deleted stacks for 90 days
+DELETED_RETENTION = 90 * 24 * 3600
+# seconds after which the deleted stacks are listed again, stacks created and deleted between two refreshes
+# are only seen by that listing
+DELETED_MAX_AGE = 3600
+
+TIME_KEYS = ('CreationTime', 'LastUpdatedTime', 'DeletionTime')
+# JSON object key of encoded datetimes
+DATETIME_KEY = '$datetime'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS stacks (
+    stack_id TEXT PRIMARY KEY,
+    stack_name TEXT NOT NULL,
+    stack_status TEXT NOT NULL,
+    changed REAL NOT NULL,
+    summary TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS syncs (
+    name TEXT PRIMARY KEY,
+    synced REAL NOT NULL
+);
+'''
+
+
+def configure(max_age: int):
+    '''Enable the inventory, serving stack lists which are not older than max_age seconds'''
+    global MAX_AGE
+    MAX_AGE = max_age
+
+
+def is_enabled():
+    return MAX_AGE is not None
+
+
+def get_change_time(summary: dict) -> float:
+    '''
+    >>> get_change_time({'CreationTime': datetime.datetime(2015, 1, 1, tzinfo=datetime.timezone.utc)})
+    1420070400.0
+    >>> get_change_time({})
+    0
+    '''
+    return max([summary[key].timestamp() for key in TIME_KEYS if summary.get(key)] or [0])
+
+
+def encode_value(value):
+    if isinstance(value, datetime.datetime):
+        return {DATETIME_KEY: value.timestamp()}
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+
+def decode_object(data: dict):
+    if list(data) == [DATETIME_KEY]:
+        return datetime.datetime.fromtimestamp(data[DATETIME_KEY], datetime.timezone.utc)
+    return data
+
+
+def encode_summary(summary: dict) -> str:
+    '''Encode the summary as JSON, datetimes (at any level) become {"$datetime": timestamp}'''
+    return json.dumps(summary, sort_keys=True, default=encode_value)
+
+
+def decode_summary(text: str) -> dict:
+    '''
+    >>> decode_summary(encode_summary({'StackName': 'a-1', 'CreationTime': datetime.datetime(2015, 1, 1, \
+tzinfo=datetime.timezone.utc)}))['CreationTime'].year
+    2015
+    '''
+    data = json.loads(text, object_hook=decode_object)
+    # summaries written by older versions have plain timestamps
+    for key in TIME_KEYS:
+        if isinstance(data.get(key), (int, float)):
+            data[key] = datetime.datetime.fromtimestamp(data[key], datetime.timezone.utc)
+    return data
+
+
+class StackInventory:
+    '''Stack summaries of one account and region, refreshed incrementally from "ListStacks"
+
+    ListStacks has no "changed since" filter: a refresh only lists the active (non-deleted) stacks,
+    writes rows whose status or LastUpdatedTime/DeletionTime changed and marks vanished stacks as deleted.
+    Deleted stacks never change again, but stacks created and deleted between two refreshes are never seen
+    as active, so the deleted history is listed again once it is older than DELETED_MAX_AGE.'''
+
+    def __init__(self, path: str, region: str, active_statuses: list, session=None):
+        self.region = region
+        self.active_statuses = active_statuses
+        self.session = session
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+
+    @classmethod
+    def open(cls, account_id: str, region: str, active_statuses: list, session=None):
+        path = os.path.join(get_cache_dir(), 'inventory-{}-{}.sqlite'.format(account_id, region))
+        return cls(path, region, active_statuses, session)
+
+    def get_synced(self, name: str):
+        row = self.db.execute('SELECT synced FROM syncs WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    def is_stale(self, name: str, max_age: float) -> bool:
+        synced = self.get_synced(name)
+        return synced is None or synced < time.time() - max_age
+
+    def set_synced(self, name: str, synced: float):
+        self.db.execute('INSERT OR REPLACE INTO syncs (name, synced) VALUES (?, ?)', (name, synced))
+
+    def invalidate(self):
+        '''Force a refresh on the next lookup (e.g. after creating or deleting a stack)'''
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM syncs WHERE name = 'active'")
+
+    def upsert(self, summary: dict):
+        self.db.execute('INSERT OR REPLACE INTO stacks (stack_id, stack_name, stack_status, changed, summary) ' +
+                        'VALUES (?, ?, ?, ?, ?)',
+                        (summary['StackId'], summary['StackName'], summary['StackStatus'],
+                         get_change_time(summary), encode_summary(summary)))
+
+    def list_stacks(self, status_filter: list):
+        cf = (self.session or boto3).client('cloudformation', self.region)
+        kwargs = {'StackStatusFilter': status_filter}
+        while 'NextToken' not in kwargs or kwargs['NextToken']:
+            results = cf.list_stacks(**kwargs)
+            yield from results['StackSummaries']
+            kwargs['NextToken'] = results.get('NextToken')
+
+    def refresh(self, all=False):
+        now = time.time()
+        known = {}
+        for stack_id, status, changed in self.db.execute(
+                "SELECT stack_id, stack_status, changed FROM stacks WHERE stack_status != 'DELETE_COMPLETE'"):
+            known[stack_id] = (status, changed)
+
+        with self.db:
+            for summary in self.list_stacks(self.active_statuses):
+                state = known.pop(summary['StackId'], None)
+                if state != (summary['StackStatus'], get_change_time(summary)):
+                    self.upsert(summary)
+
+            # whatever left the active status filter since the last sync was deleted
+            for stack_id in known:
+                summary = decode_summary(self.db.execute('SELECT summary FROM stacks WHERE stack_id = ?',
+                                                         (stack_id,)).fetchone()[0])
+                summary['StackStatus'] = 'DELETE_COMPLETE'
+                summary['DeletionTime'] = datetime.datetime.fromtimestamp(now, datetime.timezone.utc)
+                self.upsert(summary)
+
+            if all and self.is_stale('deleted', DELETED_MAX_AGE):
+                for summary in self.list_stacks(['DELETE_COMPLETE']):
+                    self.upsert(summary)
+                self.set_synced('deleted', now)
+
+            self.db.execute("DELETE FROM stacks WHERE stack_status = 'DELETE_COMPLETE' AND changed < ?",
+                            (now - DELETED_RETENTION,))
+            self.set_synced('active', now)
+
+    def get_stack_summaries(self, all=False, max_age=None):
+        '''Return stack summaries which are at most max_age seconds old (default: configured MAX_AGE)'''
+        if max_age is None:
+            max_age = MAX_AGE or 0
+        with self.lock:
+            if self.is_stale('active', max_age) or (all and self.is_stale('deleted', DELETED_MAX_AGE)):
+                self.refresh(all=all)
+            query = 'SELECT summary FROM stacks'
+            if not all:
+                query += " WHERE stack_status != 'DELETE_COMPLETE'"
+            return [decode_summary(row[0]) for row in self.db.execute(query + ' ORDER BY stack_name')]
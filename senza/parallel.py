@@ -0,0 +1,82 @@
+'''
+Helpers to run independent AWS API calls concurrently
+'''
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_CONCURRENCY = 8
+
+# upper bound of workers when fanning out to many accounts and regions
+MAX_FAN_OUT = 32
+
+# maximum number of produced but not yet consumed values of stream_map
+STREAM_BUFFER_SIZE = 1000
+
+# marks the end of the values produced for one item
+DONE = object()
+
+
+def parallel_map(func, items, max_workers: int=DEFAULT_CONCURRENCY):
+    '''Call func for every item in a bounded thread pool and return the results in input order
+
+    >>> parallel_map(lambda x: x * 2, [3, 1, 2])
+    [6, 2, 4]
+    '''
+    items = list(items)
+    if len(items) <= 1 or max_workers <= 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(func, items))
+
+
+def stream_map(func, items, max_workers: int=DEFAULT_CONCURRENCY):
+    '''Call func (returning an iterable) for every item in a bounded thread pool and yield the values
+    as soon as they are produced, i.e. in no particular order
+
+    Producers block while STREAM_BUFFER_SIZE values are waiting to be consumed.
+
+    >>> sorted(stream_map(lambda x: [x] * x, [3, 1, 2]))
+    [1, 2, 2, 3, 3, 3]
+    '''
+    items = list(items)
+    if not items:
+        return
+    values = queue.Queue(maxsize=STREAM_BUFFER_SIZE)
+    cancelled = threading.Event()
+
+    def put(value):
+        while not cancelled.is_set():
+            try:
+                values.put(value, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def produce(item):
+        try:
+            for value in func(item):
+                if cancelled.is_set():
+                    return
+                put((value, None))
+        except Exception as e:
+            put((None, e))
+        finally:
+            put((DONE, None))
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(items)))) as executor:
+        try:
+            for item in items:
+                executor.submit(produce, item)
+            pending = len(items)
+            while pending:
+                value, error = values.get()
+                if error:
+                    raise error
+                elif value is DONE:
+                    pending -= 1
+                else:
+                    yield value
+        finally:
+            # let blocked producers finish when the consumer stopped early
+            cancelled.set()
@@ -0,0 +1,102 @@
+'''
+Adaptive polling intervals for watch and wait loops
+'''
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+THROTTLING_ERROR_CODES = frozenset(['Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+                                    'RequestThrottled', 'TooManyRequestsException'])
+
+# number of throttled API requests which were handled (i.e. not re-raised) so far
+THROTTLED_REQUESTS = 0
+
+# attempts and initial back-off (in seconds) of throttled calls
+MAX_ATTEMPTS = 6
+BACKOFF_BASE = 0.5
+
+lock = threading.Lock()
+
+
+def is_throttling_error(e: Exception) -> bool:
+    '''
+    >>> is_throttling_error(ClientError({'Error': {'Code': 'Throttling'}}, 'DescribeInstanceHealth'))
+    True
+    >>> is_throttling_error(ClientError({'Error': {'Code': 'ValidationError'}}, 'DescribeInstanceHealth'))
+    False
+    '''
+    return isinstance(e, ClientError) and e.response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES
+
+
+def record_throttling():
+    '''Count a handled throttling error, polling schedulers back off on their next tick'''
+    global THROTTLED_REQUESTS
+    with lock:
+        THROTTLED_REQUESTS += 1
+
+
+def call_with_backoff(func, *args, **kwargs):
+    '''Call func, retrying with exponential back-off (and full jitter) while the API throttles us'''
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            return func(*args, **kwargs)
+        except ClientError as e:
+            if not is_throttling_error(e) or attempt == MAX_ATTEMPTS - 1:
+                raise
+            record_throttling()
+            time.sleep(random.uniform(0, BACKOFF_BASE * 2 ** attempt))
+
+
+class PollingScheduler:
+    '''Polling interval between min_interval and max_interval
+
+    The interval is reset to min_interval as soon as a poll saw changes, grows by the backoff factor
+    for every poll without changes and doubles after throttling errors. Every sleep is jittered
+    to keep concurrent users of the same account from polling in lockstep.'''
+
+    def __init__(self, min_interval: float, max_interval: float, backoff: float=1.5, jitter: float=0.1):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.interval = min_interval
+        self.throttled_requests = THROTTLED_REQUESTS
+        self.throttled = False
+        self.polls = 0
+        self.started = time.time()
+
+    def update(self, changed: bool=None) -> float:
+        '''Adapt the interval to the last poll (changed is None if unknown)
+
+        >>> scheduler = PollingScheduler(2, 10)
+        >>> scheduler.update(False), scheduler.update(False), scheduler.update(True)
+        (3.0, 4.5, 2)
+        '''
+        self.throttled = THROTTLED_REQUESTS > self.throttled_requests
+        self.throttled_requests = THROTTLED_REQUESTS
+        if self.throttled:
+            self.interval = min(self.interval * 2, self.max_interval)
+        elif changed:
+            self.interval = self.min_interval
+        elif changed is not None:
+            self.interval = min(self.interval * self.backoff, self.max_interval)
+        return self.interval
+
+    def sleep(self, changed: bool=None, max_seconds: float=None):
+        '''Sleep for the (jittered) interval, but not longer than max_seconds (e.g. until a deadline)'''
+        self.update(changed)
+        self.polls += 1
+        seconds = self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+        time.sleep(seconds if max_seconds is None else min(seconds, max_seconds))
+
+    @property
+    def rate(self) -> float:
+        '''Effective number of polls per minute'''
+        elapsed = time.time() - self.started
+        return self.polls * 60 / elapsed if elapsed > 0 else 0
+
+    def describe(self) -> str:
+        return 'Polling every {:.1f}s ({:.1f}/min){}'.format(self.interval, self.rate,
+                                                             ', throttled' if self.throttled else '')
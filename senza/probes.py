@@ -0,0 +1,68 @@
+'''
+Concurrent HTTP and DNS health probes of "senza status"
+'''
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import dns.resolver
+import requests
+
+from .parallel import MAX_FAN_OUT
+
+# seconds a single probe may take
+PROBE_TIMEOUT = 2
+# seconds all probes of one status refresh may take
+PROBE_DEADLINE = 5
+
+# result of probes which did not finish before the deadline
+UNKNOWN = 'UNKNOWN'
+
+lock = threading.Lock()
+prober = None
+
+
+class Prober:
+    '''Runs probes in a thread pool, reusing HTTP connections and cached DNS answers across status refreshes'''
+
+    def __init__(self, timeout: float=PROBE_TIMEOUT, max_workers: int=MAX_FAN_OUT):
+        self.timeout = timeout
+        self.http = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.http.mount('https://', adapter)
+        self.resolver = dns.resolver.Resolver()
+        # answers are cached until their TTL expires
+        self.resolver.cache = dns.resolver.Cache()
+        self.resolver.lifetime = timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def get_http_status(self, name: str) -> str:
+        try:
+            self.http.get('https://{}/'.format(name), timeout=self.timeout)
+            return 'OK'
+        except Exception:
+            return 'ERROR'
+
+    def get_cname_targets(self, name: str) -> list:
+        try:
+            answers = self.resolver.query(name, 'CNAME')
+        except Exception:
+            answers = []
+        return [answer.target.to_text() for answer in answers]
+
+    def run(self, probes: list, deadline: float=PROBE_DEADLINE) -> list:
+        '''Run all (func, arg) probes concurrently, probes still running after the deadline return UNKNOWN
+
+        >>> Prober().run([(len, 'abc'), (str.upper, 'ok')])
+        [3, 'OK']
+        '''
+        futures = [self.executor.submit(func, arg) for func, arg in probes]
+        wait(futures, timeout=deadline)
+        return [future.result() if future.done() else UNKNOWN for future in futures]
+
+
+def get_prober() -> Prober:
+    global prober
+    with lock:
+        if prober is None:
+            prober = Prober()
+        return prober
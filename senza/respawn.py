@@ -1,8 +1,10 @@
 import boto3
-import time
 
+from botocore.exceptions import ClientError
 from clickclick import Action, info
 
+from .polling import PollingScheduler, is_throttling_error, record_throttling
+
 
 SCALING_PROCESSES_TO_SUSPEND = ['AZRebalance', 'AlarmNotification', 'ScheduledActions']
 RUNNING_LIFECYCLE_STATES = set(['Pending', 'InService', 'Rebooting'])
@@ -63,12 +65,22 @@ def scale_out(asg, asg_name, region: str, new_min_size, new_max_size, new_desire
                                       MinSize=new_min_size,
                                       MaxSize=new_max_size,
                                       DesiredCapacity=new_desired_capacity)
+        scheduler = PollingScheduler(2, 20)
+        last_instances_in_service = None
         while True:
-            current_group = get_auto_scaling_group(asg, asg_name)
-            instances_in_service = get_instances_in_service(current_group, region)
-            if len(instances_in_service) >= new_desired_capacity:
-                break
-            time.sleep(5)
+            try:
+                current_group = get_auto_scaling_group(asg, asg_name)
+                instances_in_service = get_instances_in_service(current_group, region)
+            except ClientError as e:
+                if not is_throttling_error(e):
+                    raise
+                record_throttling()
+                instances_in_service = last_instances_in_service
+            else:
+                if len(instances_in_service) >= new_desired_capacity:
+                    break
+            scheduler.sleep(instances_in_service != last_instances_in_service)
+            last_instances_in_service = instances_in_service
             act.progress()
     return current_group
 
@@ -78,11 +90,18 @@ def terminate_instance(asg, region: str, group, instance: str):
 
     with Action('Terminating old instance {}..'.format(instance)) as act:
         asg.terminate_instance_in_auto_scaling_group(InstanceId=instance, ShouldDecrementDesiredCapacity=False)
-        instances_in_service = get_instances_in_service(group, region)
+        scheduler = PollingScheduler(1, 10)
+        instances_in_service = last_instances_in_service = get_instances_in_service(group, region)
         while instance in instances_in_service:
-            time.sleep(2)
+            scheduler.sleep(instances_in_service != last_instances_in_service)
             act.progress()
-            instances_in_service = get_instances_in_service(group, region)
+            last_instances_in_service = instances_in_service
+            try:
+                instances_in_service = get_instances_in_service(group, region)
+            except ClientError as e:
+                if not is_throttling_error(e):
+                    raise
+                record_throttling()
 
 
 def do_respawn_auto_scaling_group(asg_name: str, group: dict, region: str,
@@ -2,14 +2,27 @@ from json import JSONEncoder
 import click
 from clickclick import warning, action, ok, print_table, Action
 import collections
-from .aws import get_stacks, StackReference, get_tag
+import functools
+from .aws import get_stacks, StackReference, get_tag, get_stack_resources
+from .cache import TTLCache
+from .parallel import parallel_map, MAX_FAN_OUT
+from .polling import call_with_backoff
 
 import boto3
 
 PERCENT_RESOLUTION = 2
 FULL_PERCENTAGE = PERCENT_RESOLUTION * 100
-DNS_RR_CACHE = {}
-DNS_ZONE_CACHE = {}
+# maximum number of names in a single "DescribeLoadBalancers" call
+MAX_LOAD_BALANCER_NAMES = 20
+# seconds hosted zones and record sets are cached (record sets we change are invalidated right away)
+DNS_ZONE_TTL = 300
+DNS_RECORD_TTL = 60
+# zones of the same name can be public and private (for different VPCs)
+MAX_ZONES_BY_NAME = '10'
+# caches are kept per AWS profile (i.e. account) and hosted zone ID (or domain name)
+DNS_ZONES = TTLCache(DNS_ZONE_TTL)
+DNS_RECORDS = TTLCache(DNS_RECORD_TTL)
+DNS_RECORD_INDEXES = TTLCache(DNS_RECORD_TTL)
 
 
 def get_weights(dns_names: list, identifier: str, all_identifiers) -> ({str: int}, int, int):
@@ -22,18 +35,17 @@ def get_weights(dns_names: list, identifier: str, all_identifiers) -> ({str: int
     partial_sum = 0
     known_record_weights = {}
     for dns_name in dns_names:
-        for r in get_records(dns_name.split('.', 1)[1]):
-            if r['Type'] == 'CNAME' and r['Name'] == dns_name:
-                if r['Weight']:
-                    w = int(r['Weight'])
-                else:
-                    w = 0
-                known_record_weights[r['SetIdentifier']] = w
-                if r['SetIdentifier'] != identifier and w > 0:
-                    # we should ignore all versions that do not get any traffic
-                    # not to put traffic on the disabled versions when redistributing traffic weights
-                    partial_sum += w
-                    partial_count += 1
+        for r in get_cname_records(dns_name):
+            if r['Weight']:
+                w = int(r['Weight'])
+            else:
+                w = 0
+            known_record_weights[r['SetIdentifier']] = w
+            if r['SetIdentifier'] != identifier and w > 0:
+                # we should ignore all versions that do not get any traffic
+                # not to put traffic on the disabled versions when redistributing traffic weights
+                partial_sum += w
+                partial_count += 1
     if identifier not in known_record_weights:
         known_record_weights[identifier] = 0
     for ident in all_identifiers:
@@ -113,23 +125,22 @@ def set_new_weights(dns_names: list, identifier, lb_dns_name: str, new_record_we
         domain = dns_name.split('.', 1)[1]
         zone = get_zone(domain)
         did_the_upsert = False
-        for r in get_records(domain):
-            if r['Type'] == 'CNAME' and r['Name'] == dns_name:
-                w = new_record_weights[r['SetIdentifier']]
-                if w:
-                    if int(r['Weight']) != w:
-                        r['Weight'] = w
-                        if dns_changes.get(zone['Id']) is None:
-                            dns_changes[zone['Id']] = []
-                        dns_changes[zone['Id']].append({'Action': 'UPSERT',
-                                                        'ResourceRecordSet': r})
-                    if identifier == r['SetIdentifier']:
-                        did_the_upsert = True
-                else:
+        for r in get_cname_records(dns_name):
+            w = new_record_weights[r['SetIdentifier']]
+            if w:
+                if int(r['Weight']) != w:
+                    r['Weight'] = w
                     if dns_changes.get(zone['Id']) is None:
                         dns_changes[zone['Id']] = []
-                    dns_changes[zone['Id']].append({'Action': 'DELETE',
-                                                    'ResourceRecordSet': r.copy()})
+                    dns_changes[zone['Id']].append({'Action': 'UPSERT',
+                                                    'ResourceRecordSet': r})
+                if identifier == r['SetIdentifier']:
+                    did_the_upsert = True
+            else:
+                if dns_changes.get(zone['Id']) is None:
+                    dns_changes[zone['Id']] = []
+                dns_changes[zone['Id']].append({'Action': 'DELETE',
+                                                'ResourceRecordSet': r.copy()})
         if new_record_weights[identifier] > 0 and not did_the_upsert:
             if dns_changes.get(zone['Id']) is None:
                 dns_changes[zone['Id']] = []
@@ -146,6 +157,7 @@ def set_new_weights(dns_names: list, identifier, lb_dns_name: str, new_record_we
             route53.change_resource_record_sets(HostedZoneId=hosted_zone_id,
                                                 ChangeBatch={'Comment': 'Weight change of {}'.format(hosted_zone_id),
                                                              'Changes': change})
+            invalidate_records(hosted_zone_id)
         if sum(new_record_weights.values()) == 0:
             ok(' DISABLED')
         else:
@@ -210,23 +222,37 @@ class StackVersion(collections.namedtuple('StackVersion', 'name version domain l
 
 
 def get_stack_versions(stack_name: str, region: str):
-    cf = boto3.resource('cloudformation', region)
-    for stack in get_stacks([StackReference(name=stack_name, version=None)], region):
-        if stack.StackStatus in ('ROLLBACK_COMPLETE', 'CREATE_FAILED'):
-            continue
-        details = cf.Stack(stack.StackId)
+    '''Yield a StackVersion for all (successfully created) stacks of the given name
+
+    The stack details and the DNS names of all load balancers (MAX_LOAD_BALANCER_NAMES per call) are described
+    concurrently.'''
+    cf = boto3.client('cloudformation', region)
+    elb = boto3.client('elb', region)
+    stacks = [stack for stack in get_stacks([StackReference(name=stack_name, version=None)], region)
+              if stack.StackStatus not in ('ROLLBACK_COMPLETE', 'CREATE_FAILED')]
+    resources = get_stack_resources([stack.StackName for stack in stacks], region,
+                                    ['AWS::ElasticLoadBalancing::LoadBalancer', 'AWS::Route53::RecordSet'])
+    lb_names = sorted({res['PhysicalResourceId'] for stack in stacks for res in resources[stack.StackName]
+                       if res['ResourceType'] == 'AWS::ElasticLoadBalancing::LoadBalancer'})
+    calls = [functools.partial(cf.describe_stacks, StackName=stack.StackId) for stack in stacks]
+    calls.extend(functools.partial(elb.describe_load_balancers,
+                                   LoadBalancerNames=lb_names[i:i + MAX_LOAD_BALANCER_NAMES])
+                 for i in range(0, len(lb_names), MAX_LOAD_BALANCER_NAMES))
+    results = parallel_map(call_with_backoff, calls, MAX_FAN_OUT)
+    lb_dns_names = {lb['LoadBalancerName']: lb['DNSName']
+                    for result in results[len(stacks):] for lb in result['LoadBalancerDescriptions']}
+    for stack, result in zip(stacks, results):
+        details = result['Stacks'][0]
         lb_dns_name = []
         domain = []
-        notification_arns = details.notification_arns
-        for res in details.resource_summaries.all():
-            if res.resource_type == 'AWS::ElasticLoadBalancing::LoadBalancer':
-                elb = boto3.client('elb', region)
-                lbs = elb.describe_load_balancers(LoadBalancerNames=[res.physical_resource_id])
-                lb_dns_name.append(lbs['LoadBalancerDescriptions'][0]['DNSName'])
-            elif res.resource_type == 'AWS::Route53::RecordSet':
-                if 'version' not in res.logical_id.lower():
-                    domain.append(res.physical_resource_id)
-        yield StackVersion(stack_name, get_tag(details.tags, 'StackVersion'), domain, lb_dns_name, notification_arns)
+        for res in resources[stack.StackName]:
+            if res['ResourceType'] == 'AWS::ElasticLoadBalancing::LoadBalancer':
+                lb_dns_name.append(lb_dns_names[res['PhysicalResourceId']])
+            elif res['ResourceType'] == 'AWS::Route53::RecordSet':
+                if 'version' not in res['LogicalResourceId'].lower():
+                    domain.append(res['PhysicalResourceId'])
+        yield StackVersion(stack_name, get_tag(details.get('Tags', []), 'StackVersion'), domain, lb_dns_name,
+                           details.get('NotificationARNs', []))
 
 
 def get_version(versions: list, version: str):
@@ -236,52 +262,173 @@ def get_version(versions: list, version: str):
     raise click.UsageError('Stack version {} not found'.format(version))
 
 
-def get_zone(domainname: str, *args, all=False):
-    if len(DNS_ZONE_CACHE) == 0:
-        route53 = boto3.client('route53')
-        result = route53.list_hosted_zones()
-        zones = result['HostedZones']
-        while result.get('IsTruncated', False):
-            recordfilter = {'Marker': result['NextMarker']}
-            result = route53.list_hosted_zones(**recordfilter)
-            zones.extend(result['HostedZones'])
-        if len(zones) == 0:
-            raise ValueError('No Zones are configured!')
+def select_zone(zones: list, private: bool=False) -> dict:
+    '''Select the zone of the wanted visibility among (public and private) zones of the same name
+
+    >>> select_zone([{'Id': '1', 'Config': {'PrivateZone': True}}, {'Id': '2'}])['Id']
+    '2'
+    '''
+    for zone in zones:
+        if zone.get('Config', {}).get('PrivateZone', False) == private:
+            return zone
+    return zones[0]
+
+
+class ZoneIndex:
+    '''Hosted zones in a trie of their reversed name labels for longest suffix matches
+
+    >>> index = ZoneIndex([{'Name': 'example.org.', 'Id': '1'}, {'Name': 'app.example.org.', 'Id': '2'}])
+    >>> index.find('db.example.org')['Id'], index.find('a.app.example.org.')['Id'], index.find('example.com')
+    ('1', '2', None)
+    '''
+
+    def __init__(self, zones: list):
+        self.root = {}
+        self.names = collections.OrderedDict()
         for zone in zones:
-            DNS_ZONE_CACHE[zone['Name']] = zone
-    if domainname is None and all:
-        return list(DNS_ZONE_CACHE.values())
-    elif domainname is not None:
-        domainname = '{}.'.format(domainname.rstrip('.'))
-        domainlevel = domainname.split('.')
-        for i in range(len(domainlevel)):
-            if DNS_ZONE_CACHE.get('.'.join(domainlevel[i:])):
-                if all:
-                    return [DNS_ZONE_CACHE.get('.'.join(domainlevel[i:]))]
-                return DNS_ZONE_CACHE.get('.'.join(domainlevel[i:]))
-        raise ValueError('Zone {} not found'.format(domainname))
+            node = self.root
+            for label in reversed(zone['Name'].rstrip('.').split('.')):
+                node = node.setdefault(label, {})
+            # labels are strings, None holds the zones of the name
+            node.setdefault(None, []).append(zone)
+            self.names.setdefault(zone['Name'], []).append(zone)
+
+    def find(self, domainname: str, private: bool=False):
+        '''Return the zone of the longest suffix of the domain name (or None)'''
+        node = self.root
+        zones = None
+        for label in reversed(domainname.rstrip('.').lower().split('.')):
+            node = node.get(label)
+            if node is None:
+                break
+            zones = node.get(None, zones)
+        return select_zone(zones, private) if zones else None
+
+    def get_zones(self, private: bool=False) -> list:
+        '''Return one zone per name'''
+        return [select_zone(zones, private) for zones in self.names.values()]
+
+
+def list_zones(session=None) -> ZoneIndex:
+    route53 = (session or boto3).client('route53')
+    result = route53.list_hosted_zones()
+    zones = result['HostedZones']
+    while result.get('IsTruncated', False):
+        recordfilter = {'Marker': result['NextMarker']}
+        result = route53.list_hosted_zones(**recordfilter)
+        zones.extend(result['HostedZones'])
+    if len(zones) == 0:
+        raise ValueError('No Zones are configured!')
+    return ZoneIndex(zones)
+
+
+def find_zone_by_name(domainname: str, private: bool=False, session=None):
+    '''Return the zone of the longest suffix of the domain name (or None), looking up one suffix after the other'''
+    route53 = (session or boto3).client('route53')
+    labels = domainname.rstrip('.').lower().split('.')
+    for i in range(len(labels)):
+        name = '{}.'.format('.'.join(labels[i:]))
+        # zones are listed in the order of their reversed labels, i.e. starting with the ones of the given name
+        result = route53.list_hosted_zones_by_name(DNSName=name, MaxItems=MAX_ZONES_BY_NAME)
+        zones = [zone for zone in result['HostedZones'] if zone['Name'] == name]
+        if zones:
+            return select_zone(zones, private)
     return None
 
 
-def get_records(domain: str):
-    domain = '{}.'.format(domain.rstrip('.'))
-    if DNS_RR_CACHE.get(domain) is None:
-        zone = get_zone(domain)
-        route53 = boto3.client('route53')
-        result = route53.list_resource_record_sets(HostedZoneId=zone['Id'])
-        records = result['ResourceRecordSets']
-        while result['IsTruncated']:
-            recordfilter = {'HostedZoneId': zone['Id'],
-                            'StartRecordName': result['NextRecordName'],
-                            'StartRecordType': result['NextRecordType']
-                            }
-            if result.get('NextRecordIdentifier'):
-                recordfilter['StartRecordIdentifier'] = result.get('NextRecordIdentifier')
-
-            result = route53.list_resource_record_sets(**recordfilter)
-            records.extend(result['ResourceRecordSets'])
-        DNS_RR_CACHE[domain] = records
-    return DNS_RR_CACHE[domain]
+def get_zone(domainname: str, *args, all=False, session=None, private=False):
+    '''Return the hosted zone of the domain name (or all zones if there is no domain name and all is set)
+
+    Zones are looked up by name unless all zones of the account were listed already. Caches are kept per AWS
+    profile (i.e. account).'''
+    profile = getattr(session, 'profile', None)
+    if domainname is None:
+        if all:
+            return DNS_ZONES.get((profile, None), lambda: list_zones(session)).get_zones(private)
+        return None
+    domainname = '{}.'.format(domainname.rstrip('.'))
+    entry = DNS_ZONES.lookup((profile, None))
+    if entry is not None:
+        zone = entry[1].find(domainname, private)
+    else:
+        zone = DNS_ZONES.get((profile, domainname.lower(), private),
+                             lambda: find_zone_by_name(domainname, private, session))
+    if zone is None:
+        raise ValueError('Zone {} not found'.format(domainname))
+    return [zone] if all else zone
+
+
+def list_records(hosted_zone_id: str, session=None, name: str=None, record_type: str=None) -> list:
+    '''List the record sets of the hosted zone, only the ones of the given name and type if there is a name
+
+    Record sets are ordered by name and type, so a name-scoped listing starts at the name and stops as soon as
+    another name (or type) follows.'''
+    route53 = (session or boto3).client('route53')
+    recordfilter = {'HostedZoneId': hosted_zone_id}
+    if name:
+        recordfilter.update(StartRecordName=name, StartRecordType=record_type)
+    records = []
+    while True:
+        result = route53.list_resource_record_sets(**recordfilter)
+        for record in result['ResourceRecordSets']:
+            if name and (record['Name'] != name or record['Type'] != record_type):
+                return records
+            records.append(record)
+        if not result['IsTruncated']:
+            return records
+        recordfilter = {'HostedZoneId': hosted_zone_id,
+                        'StartRecordName': result['NextRecordName'],
+                        'StartRecordType': result['NextRecordType']
+                        }
+        if result.get('NextRecordIdentifier'):
+            recordfilter['StartRecordIdentifier'] = result.get('NextRecordIdentifier')
+
+
+def get_records(domain: str, session=None, name: str=None, record_type: str='CNAME') -> list:
+    '''Return the record sets of the domain's hosted zone (cached per zone)
+
+    If a name is given, only the record sets of that name and type are fetched (and cached per name).'''
+    zone = get_zone(domain, session=session)
+    if name:
+        name = '{}.'.format(name.rstrip('.')).lower()
+        return DNS_RECORDS.get((getattr(session, 'profile', None), zone['Id'], name, record_type),
+                               lambda: list_records(zone['Id'], session, name, record_type))
+    return DNS_RECORDS.get((getattr(session, 'profile', None), zone['Id']),
+                           lambda: list_records(zone['Id'], session))
+
+
+def get_record_index(domain: str, session=None) -> dict:
+    '''Return the record sets of the domain's hosted zone as {name: {type: {set identifier: record set}}}
+
+    Names are without the trailing dot, the index is built once per zone and shared by all commands.'''
+    zone = get_zone(domain, session=session)
+
+    def build_index():
+        index = {}
+        for record in get_records(domain, session=session):
+            types = index.setdefault(record['Name'].rstrip('.'), {})
+            types.setdefault(record['Type'], {})[record.get('SetIdentifier')] = record
+        return index
+    return DNS_RECORD_INDEXES.get((getattr(session, 'profile', None), zone['Id']), build_index)
+
+
+def get_cname_records(dns_name: str, session=None) -> list:
+    '''Return the (weighted) CNAME record sets of the given name
+
+    Only the record sets of the name are fetched, unless the zone's record index is built already.'''
+    domain = dns_name.split('.', 1)[1]
+    zone = get_zone(domain, session=session)
+    entry = DNS_RECORD_INDEXES.lookup((getattr(session, 'profile', None), zone['Id']))
+    if entry is not None:
+        # Route53 returns the record names in lower case
+        return list(entry[1].get(dns_name.rstrip('.').lower(), {}).get('CNAME', {}).values())
+    return list(get_records(domain, session=session, name=dns_name, record_type='CNAME'))
+
+
+def invalidate_records(hosted_zone_id: str):
+    '''Forget the cached record sets of the hosted zone (e.g. after changing them)'''
+    for cache in DNS_RECORDS, DNS_RECORD_INDEXES:
+        cache.invalidate(lambda key: key[1] == hosted_zone_id)
 
 
 def print_version_traffic(stack_ref: StackReference, region):
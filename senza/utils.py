@@ -1,3 +1,6 @@
+import configparser
+import itertools
+import os
 import re
 import pystache
 
@@ -26,6 +29,38 @@ def camel_case_to_underscore(name):
     return re.sub('([a-z0-9])([A-Z])', r'\1_\2', s1).lower()
 
 
+def chunked(iterable, size: int):
+    '''Yield lists of up to size items of the iterable (consuming it lazily)
+
+    >>> list(chunked(range(5), 2))
+    [[0, 1], [2, 3], [4]]
+    '''
+    iterator = iter(iterable)
+    chunk = list(itertools.islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(iterator, size))
+
+
 def pystache_render(*args, **kwargs):
     render = pystache.Renderer(missing_tags='strict')
     return render.render(*args, **kwargs)
+
+
+def get_cache_dir():
+    '''Return (and create) the directory for Senza's local caches'''
+    path = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'senza')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def get_default_region():
+    '''Return the default region configured in ~/.aws/config (or None)'''
+    config = configparser.ConfigParser()
+    try:
+        config.read(os.path.expanduser('~/.aws/config'))
+        if 'default' in config:
+            return config['default']['region']
+    except:
+        pass
+    return None
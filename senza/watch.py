@@ -0,0 +1,108 @@
+'''
+Differential screen updates for the watch mode ("-W" and "--watch")
+'''
+import contextlib
+import io
+import shutil
+import sys
+
+import click
+from clickclick.console import print_table, is_text_output
+
+HIGHLIGHT = '\x1b[7m'
+RESET = '\x1b[0m'
+
+
+class TerminalBuffer(io.StringIO):
+    '''Captures click output without stripping ANSI styles'''
+
+    def isatty(self):
+        return True
+
+
+def render_table(cols: list, rows: list, **kwargs) -> list:
+    buf = TerminalBuffer()
+    with contextlib.redirect_stdout(buf):
+        print_table(cols, rows, **kwargs)
+    return buf.getvalue().splitlines()
+
+
+def highlight(line: str) -> str:
+    '''
+    >>> highlight('\x1b[32mOK\x1b[0m ')
+    '\\x1b[7m\\x1b[32mOK\\x1b[0m\\x1b[7m \\x1b[0m'
+    '''
+    return HIGHLIGHT + line.replace(RESET, RESET + HIGHLIGHT) + RESET
+
+
+class WatchScreen:
+    '''Prints tables of a watch loop, only redrawing the lines which changed since the last tick
+
+    Rows are identified by their key columns, rows with new or changed values are highlighted.
+    Falls back to clearing the screen if the output is no terminal or not a text table.'''
+
+    def __init__(self, watching: bool, differential: bool=True):
+        self.watching = watching
+        self.differential = differential
+        self.lines = None
+        self.values = None
+        # whether the last printed table differed from the one before
+        self.changed = None
+        # status line shown below the table (e.g. the polling rate)
+        self.status = None
+
+    def print_table(self, cols: list, rows: list, key: list, **kwargs):
+        if not self.watching:
+            print_table(cols, rows, **kwargs)
+            return
+
+        keys = [tuple(row.get(col) for col in key) for row in rows]
+        values = {k: tuple(row.get(col) for col in cols) for k, row in zip(keys, rows)}
+        self.changed = values != self.values
+        if not self.differential or not is_text_output() or not sys.stdout.isatty():
+            click.clear()
+            print_table(cols, rows, **kwargs)
+            if self.status and is_text_output():
+                click.secho(self.status, fg='blue')
+        else:
+            lines = render_table(cols, rows, **kwargs)
+            if self.values is not None:
+                for i, k in enumerate(keys):
+                    if self.values.get(k) != values[k]:
+                        # first line is the table header
+                        lines[i + 1] = highlight(lines[i + 1])
+            if self.status:
+                lines.append(click.style(self.status, fg='blue'))
+            self.draw(lines)
+        self.values = values
+
+    def draw(self, lines: list):
+        if self.lines is None or len(lines) != len(self.lines) or len(lines) >= shutil.get_terminal_size().lines:
+            click.clear()
+            click.echo('\n'.join(lines))
+        else:
+            for i, (old, new) in enumerate(zip(self.lines, lines)):
+                if old != new:
+                    # move the cursor to the (1-based) line and overwrite it
+                    click.echo('\x1b[{};1H\x1b[2K{}'.format(i + 1, new), nl=False)
+            click.echo('\x1b[{};1H'.format(len(lines) + 1), nl=False)
+        self.lines = lines
+
+
+class StackResults:
+    '''Per-stack API results of a watch loop
+
+    Stacks are only queried again if they are in progress or their status changed since the last tick,
+    e.g. resources and events of a stack in "CREATE_COMPLETE" cannot change.'''
+
+    def __init__(self):
+        self.results = {}
+
+    def get(self, stack, func):
+        state = (stack.StackStatus, stack.LastUpdatedTime, stack.DeletionTime)
+        cached = self.results.get(stack.StackName)
+        if cached and cached[0] == state and not (stack.StackStatus or '').endswith('_IN_PROGRESS'):
+            return cached[1]
+        result = func(stack)
+        self.results[stack.StackName] = (state, result)
+        return result
@@ -50,7 +50,7 @@ CLASSIFIERS = [
     'Programming Language :: Python :: Implementation :: CPython',
 ]
 
-CONSOLE_SCRIPTS = ['senza = senza.cli:main']
+CONSOLE_SCRIPTS = ['senza = senza.completion:main']
 
 
 class PyTest(TestCommand):
@@ -0,0 +1,11 @@
+import pytest
+
+from senza.cache import TTLCache
+
+
+@pytest.fixture
+def dns_caches(monkeypatch):
+    '''Empty Route53 zone and record caches (which would otherwise leak between tests)'''
+    monkeypatch.setattr('senza.traffic.DNS_ZONES', TTLCache(60))
+    monkeypatch.setattr('senza.traffic.DNS_RECORDS', TTLCache(60))
+    monkeypatch.setattr('senza.traffic.DNS_RECORD_INDEXES', TTLCache(60))
@@ -1,5 +1,7 @@
+import datetime
 from unittest.mock import MagicMock
-from senza.aws import resolve_topic_arn
+from senza.aws import resolve_topic_arn, get_stack_resources, get_new_stack_events, \
+    get_stack_events
 from senza.aws import get_security_group, resolve_security_groups, get_account_id, get_account_alias, list_kms_keys, encrypt, get_vpc_attribute
 
 
@@ -117,3 +119,72 @@ def test_get_account_alias(monkeypatch):
     monkeypatch.setattr('boto3.client', MagicMock(return_value=boto3))
 
     assert 'org-dummy' == get_account_alias()
+
+
+def test_get_stack_resources(monkeypatch):
+    def tagged(stack_name, asg_name):
+        arn = 'arn:aws:autoscaling:myregion:123:autoScalingGroup:1a2b:autoScalingGroupName/' + asg_name
+        return {'ResourceARN': arn,
+                'Tags': [{'Key': 'aws:cloudformation:stack-name', 'Value': stack_name},
+                         {'Key': 'aws:cloudformation:logical-id', 'Value': 'AppServer'}]}
+
+    tagging = MagicMock()
+    tagging.get_paginator.return_value.paginate.side_effect = lambda TagFilters, **kwargs: [
+        {'ResourceTagMappingList': [tagged(name, name + '-asg') for name in TagFilters[0]['Values']
+                                    if name != 'myapp-24']}]
+    cf = MagicMock()
+    cf.get_paginator.return_value.paginate.return_value = [{'StackResourceSummaries': [
+        {'ResourceType': 'AWS::AutoScaling::AutoScalingGroup', 'PhysicalResourceId': 'myapp-24-asg'},
+        {'ResourceType': 'AWS::Route53::RecordSet', 'PhysicalResourceId': 'myapp-24.example.org'}]}]
+    monkeypatch.setattr('boto3.client', lambda service, *args: tagging if service == 'resourcegroupstaggingapi' else cf)
+
+    stacks = ['myapp-{}'.format(i) for i in range(30)]
+    resources = get_stack_resources(stacks, 'myregion', ['AWS::AutoScaling::AutoScalingGroup'])
+    assert [r['PhysicalResourceId'] for r in resources['myapp-3']] == ['myapp-3-asg']
+    assert resources['myapp-24'] == [{'ResourceType': 'AWS::AutoScaling::AutoScalingGroup',
+                                      'PhysicalResourceId': 'myapp-24-asg'}]
+    # two bulk calls (at most 20 stack names each) and one fallback call for the stack without tagged resources
+    assert tagging.get_paginator.return_value.paginate.call_count == 2
+    cf.get_paginator.return_value.paginate.assert_called_once_with(StackName='myapp-24')
+
+    # record sets cannot be tagged
+    resources = get_stack_resources(stacks[:1], 'myregion', ['AWS::Route53::RecordSet'])
+    assert resources == {'myapp-0': [{'ResourceType': 'AWS::Route53::RecordSet',
+                                      'PhysicalResourceId': 'myapp-24.example.org'}]}
+    assert tagging.get_paginator.return_value.paginate.call_count == 2
+
+
+def test_get_new_stack_events():
+    pages = {None: {'StackEvents': [{'EventId': '5'}, {'EventId': '4'}], 'NextToken': 'a'},
+             'a': {'StackEvents': [{'EventId': '3'}, {'EventId': '2'}], 'NextToken': 'b'},
+             'b': {'StackEvents': [{'EventId': '1'}]}}
+    cf = MagicMock()
+    cf.describe_stack_events.side_effect = lambda StackName, NextToken=None: pages[NextToken]
+
+    assert [e['EventId'] for e in get_new_stack_events(cf, 'stack-id')] == ['4', '5']
+    assert cf.describe_stack_events.call_count == 1
+    assert [e['EventId'] for e in get_new_stack_events(cf, 'stack-id', '3')] == ['4', '5']
+    assert cf.describe_stack_events.call_count == 3
+    assert get_new_stack_events(cf, 'stack-id', '5') == []
+    assert [e['EventId'] for e in get_new_stack_events(cf, 'stack-id', 'unknown')] == ['1', '2', '3', '4', '5']
+
+
+def test_get_stack_events():
+    def event(event_id, day):
+        return {'EventId': event_id, 'Timestamp': datetime.datetime(2016, 5, day, tzinfo=datetime.timezone.utc)}
+    pages = {None: {'StackEvents': [event('5', 5), event('4', 4)], 'NextToken': 'a'},
+             'a': {'StackEvents': [event('3', 3), event('2', 2)], 'NextToken': 'b'},
+             'b': {'StackEvents': [event('1', 1)]}}
+    cf = MagicMock()
+    cf.describe_stack_events.side_effect = lambda StackName, NextToken=None: pages[NextToken]
+
+    events = get_stack_events(cf, 'stack-id')
+    assert next(events)['EventId'] == '5'
+    # pages are fetched lazily
+    assert cf.describe_stack_events.call_count == 1
+    assert [e['EventId'] for e in events] == ['4', '3', '2', '1']
+    assert cf.describe_stack_events.call_count == 3
+
+    since = datetime.datetime(2016, 5, 3, tzinfo=datetime.timezone.utc).timestamp()
+    assert [e['EventId'] for e in get_stack_events(cf, 'stack-id', since)] == ['5', '4', '3']
+    assert cf.describe_stack_events.call_count == 5
@@ -0,0 +1,36 @@
+import threading
+import time
+from senza.cache import TTLCache
+
+
+def test_expiry(monkeypatch):
+    now = [1000]
+    monkeypatch.setattr('time.time', lambda: now[0])
+    cache = TTLCache(60)
+    assert cache.get('zone', lambda: 'a') == 'a'
+    now[0] += 59
+    assert cache.get('zone', lambda: 'b') == 'a'
+    now[0] += 1
+    assert cache.get('zone', lambda: 'b') == 'b'
+    assert cache.stats() == {'hits': 1, 'misses': 2, 'size': 1}
+    cache.invalidate()
+    assert cache.stats()['size'] == 0
+
+
+def test_concurrent_load_once():
+    cache = TTLCache(60)
+    loads = []
+
+    def load():
+        loads.append(1)
+        time.sleep(0.1)
+        return 'records'
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get('zone', load))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == ['records'] * 5
+    assert len(loads) == 1
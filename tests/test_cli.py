@@ -1,14 +1,28 @@
+import base64
 import datetime
 import os
+import subprocess
 from click.testing import CliRunner
 import collections
 from unittest.mock import MagicMock
 import yaml
 import json
-from senza.cli import cli, handle_exceptions, AccountArguments
+from senza.cli import cli, handle_exceptions, AccountArguments, get_instance_rows
 import botocore.exceptions
+from senza.aws import SenzaStackSummary
 from senza.traffic import PERCENT_RESOLUTION, StackVersion
-import senza.traffic
+
+
+def instance_values(instance_id, tags, state='running', private_ip='10.0.0.1', public_ip=None):
+    '''Instance attributes as projected by senza.ec2.describe_instances'''
+    return [instance_id, 'ami-123', state, private_ip, public_ip, datetime.datetime.now(), tags]
+
+
+def mock_ec2_client(*instances):
+    ec2 = MagicMock()
+    ec2.get_paginator.return_value.paginate.return_value.search.return_value = list(instances)
+    ec2.describe_images.return_value = {'Images': [{'ImageId': 'ami-123', 'Name': 'Taupage-AMI-123'}]}
+    return ec2
 
 
 def test_invalid_definition():
@@ -225,9 +239,7 @@ def test_print_account_info_and_arguments_in_name(monkeypatch):
     assert 'AppImage-dummy-0123456789' in result.output
 
 
-def test_print_auto(monkeypatch):
-    senza.traffic.DNS_ZONE_CACHE = {}
-
+def test_print_auto(monkeypatch, dns_caches):
     def my_resource(rtype, *args):
         if rtype == 'ec2':
             ec2 = MagicMock()
@@ -265,7 +277,10 @@ def test_print_auto(monkeypatch):
                                                                        'ResourceRecordSetCount': 23}],
                                                       'IsTruncated': False,
                                                       'MaxItems': '100'}
+            route53.list_hosted_zones_by_name.return_value = route53.list_hosted_zones.return_value
             return route53
+        elif rtype == 'ec2':
+            return mock_ec2_client()
         return MagicMock()
 
     monkeypatch.setattr('boto3.client', my_client)
@@ -310,9 +325,7 @@ def test_print_auto(monkeypatch):
     assert 'ELB' == data['Resources']['AppServer']['Properties']['HealthCheckType']
 
 
-def test_print_default_value(monkeypatch):
-    senza.traffic.DNS_ZONE_CACHE = {}
-
+def test_print_default_value(monkeypatch, dns_caches):
     def my_resource(rtype, *args):
         if rtype == 'ec2':
             ec2 = MagicMock()
@@ -340,7 +353,10 @@ def test_print_default_value(monkeypatch):
                                                                        'ResourceRecordSetCount': 23}],
                                                       'IsTruncated': False,
                                                       'MaxItems': '100'}
+            route53.list_hosted_zones_by_name.return_value = route53.list_hosted_zones.return_value
             return route53
+        elif rtype == 'ec2':
+            return mock_ec2_client()
         return MagicMock()
 
     monkeypatch.setattr('boto3.client', my_client)
@@ -536,7 +552,7 @@ def test_init(monkeypatch):
             == '{{Arguments.ImageVersion}}')
 
 
-def test_init_opt2(monkeypatch):
+def test_init_opt2(monkeypatch, dns_caches):
     def my_resource(rtype, *args):
         if rtype == 'ec2':
             ec2 = MagicMock()
@@ -547,10 +563,11 @@ def test_init_opt2(monkeypatch):
         elif rtype == 'route53':
             route53 = MagicMock()
             route53.list_hosted_zones.return_value = {'HostedZones': [{'Name': 'example.org.', 'Id': '/hostedzone/123'}]}
+            route53.list_hosted_zones_by_name.return_value = route53.list_hosted_zones.return_value
             return route53
         return MagicMock()
 
-    monkeypatch.setattr('boto3.client', lambda *args: MagicMock())
+    monkeypatch.setattr('boto3.client', my_resource)
     monkeypatch.setattr('boto3.resource', my_resource)
 
     runner = CliRunner()
@@ -599,31 +616,22 @@ def test_init_opt5(monkeypatch):
 
 
 def test_instances(monkeypatch):
-    def my_resource(rtype, *args):
-        if rtype == 'ec2':
-            ec2 = MagicMock()
-            instance = MagicMock()
-            instance.id = 'inst-123'
-            instance.public_ip_address = '8.8.8.8'
-            instance.private_ip_address = '10.0.0.1'
-            instance.state = {'Name': 'Test-instance'}
-            instance.tags = [{'Key': 'aws:cloudformation:stack-name', 'Value': 'test-1'},
-                             {'Key': 'aws:cloudformation:logical-id', 'Value': 'local-id-123'},
-                             {'Key': 'StackName', 'Value': 'test'},
-                             {'Key': 'StackVersion', 'Value': '1'}]
-            instance.launch_time = datetime.datetime.now()
-            ec2.instances.filter.return_value = [instance]
-            return ec2
-        return MagicMock()
+    ec2 = mock_ec2_client(instance_values('inst-123', [{'Key': 'aws:cloudformation:stack-name', 'Value': 'test-1'},
+                                                       {'Key': 'aws:cloudformation:logical-id',
+                                                        'Value': 'local-id-123'},
+                                                       {'Key': 'StackName', 'Value': 'test'},
+                                                       {'Key': 'StackVersion', 'Value': '1'}],
+                                          state='Test-instance', public_ip='8.8.8.8'))
 
     def my_client(rtype, *args):
         if rtype == 'cloudformation':
             cf = MagicMock()
             cf.list_stacks.return_value = {'StackSummaries': [{'StackName': 'test-1'}]}
             return cf
+        elif rtype == 'ec2':
+            return ec2
         return MagicMock()
 
-    monkeypatch.setattr('boto3.resource', my_resource)
     monkeypatch.setattr('boto3.client', my_client)
 
     runner = CliRunner()
@@ -642,27 +650,119 @@ def test_instances(monkeypatch):
     assert 's ago \n' in result.output
 
 
+def test_instances_piu(monkeypatch):
+    tags = [{'Key': 'aws:cloudformation:stack-name', 'Value': 'test-1'}]
+    ec2 = mock_ec2_client(*[instance_values('i-{}'.format(i), tags, private_ip='10.0.0.{}'.format(i))
+                            for i in range(3)])
+    monkeypatch.setattr('boto3.client', lambda rtype, *args: ec2 if rtype == 'ec2' else MagicMock())
+
+    def check_output(cmd, **kwargs):
+        if cmd[2] == '10.0.0.1':
+            raise subprocess.CalledProcessError(1, cmd, 'Access denied')
+        return 'Access granted to {}'.format(cmd[2])
+    check_output = MagicMock(side_effect=check_output)
+    monkeypatch.setattr('senza.cli.check_output', check_output)
+    # the first request runs on the terminal (e.g. to prompt for the password)
+    call = MagicMock(return_value=0)
+    monkeypatch.setattr('senza.cli.call', call)
+
+    ticks = []
+
+    def sleep(seconds):
+        ticks.append(seconds)
+        if len(ticks) > 1:
+            raise KeyboardInterrupt()
+    monkeypatch.setattr('time.sleep', sleep)
+
+    runner = CliRunner()
+    result = runner.invoke(cli, ['instances', '--region=myregion', '--piu', 'debug', '-O', 'odd', '-W'],
+                           catch_exceptions=False)
+    assert '==> 10.0.0.0 <==\n==> 10.0.0.1 <==\nAccess denied' in result.output
+    assert '==> 10.0.0.2 <==\nAccess granted to 10.0.0.2' in result.output
+    assert 'Requested access to 2 of 3 instances, failed: 10.0.0.1' in result.output
+    # the instances of later watch ticks do not request access again
+    call.assert_called_once_with(['piu', 'request-access', '10.0.0.0', 'debug via senza', '-O', 'odd'], stdout=None)
+    assert check_output.call_count == 2
+    assert ['piu', 'request-access', '10.0.0.2', 'debug via senza', '-O', 'odd'] in [
+        c[0][0] for c in check_output.call_args_list]
+
+
+def test_instance_rows_stream_per_chunk(monkeypatch):
+    ec2 = mock_ec2_client(*[instance_values('i-{}'.format(i), [{'Key': 'aws:cloudformation:stack-name',
+                                                                'Value': 'app-{:02}'.format(i)}])
+                            for i in range(25)])
+    health = MagicMock(side_effect=lambda session, region, stack_names: {name: {} for name in stack_names})
+    monkeypatch.setattr('senza.cli.get_stacks_instance_health', health)
+    session = MagicMock()
+    session.client.return_value = ec2
+
+    rows = get_instance_rows(session, 'myregion', [], False, False, False)
+    assert next(rows)['instance_id'] == 'i-0'
+    # the health of the next chunk of stacks is not resolved yet
+    assert health.call_count == 1
+    assert len(list(rows)) == 24
+    assert [len(c[0][2]) for c in health.call_args_list] == [20, 5]
+
+
+def test_instances_health_per_load_balancer(monkeypatch):
+    tags = [{'Key': 'aws:cloudformation:stack-name', 'Value': 'test-1'},
+            {'Key': 'StackName', 'Value': 'test'},
+            {'Key': 'StackVersion', 'Value': '1'}]
+    ec2 = mock_ec2_client(*[instance_values('i-{}'.format(i), tags, private_ip='10.0.0.{}'.format(i))
+                            for i in range(30)])
+
+    client = MagicMock()
+    client.list_stacks.return_value = {'StackSummaries': [{'StackName': 'test-1'}]}
+    client.get_paginator.return_value.paginate.return_value = [{'ResourceTagMappingList': [
+        {'ResourceARN': 'arn:aws:elasticloadbalancing:myregion:123:loadbalancer/test-lb',
+         'Tags': [{'Key': 'aws:cloudformation:stack-name', 'Value': 'test-1'}]}]}]
+    client.describe_instance_health.return_value = {'InstanceStates': [{'InstanceId': 'i-3', 'State': 'InService'}]}
+    monkeypatch.setattr('boto3.client', lambda rtype, *args: ec2 if rtype == 'ec2' else client)
+
+    runner = CliRunner()
+    result = runner.invoke(cli, ['instances', 'test', '--region=myregion', '-o', 'json'], catch_exceptions=False)
+    rows = {row['instance_id']: row for row in json.loads(result.output)}
+    assert len(rows) == 30
+    assert rows['i-3']['lb_status'] == 'IN_SERVICE'
+    assert rows['i-4']['lb_status'] is None
+    # the load balancer is not named like the stack and only asked once
+    client.describe_instance_health.assert_called_once_with(LoadBalancerName='test-lb')
+
+
+def test_instances_docker_image_cached(monkeypatch, tmpdir):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir))
+    monkeypatch.setattr('senza.cli.DOCKER_IMAGE_SOURCES', None)
+    client = mock_ec2_client(instance_values('i-123', [{'Key': 'aws:cloudformation:stack-name', 'Value': 'test-1'}]))
+    client.list_stacks.return_value = {'StackSummaries': [{'StackName': 'test-1'}]}
+    user_data = base64.b64encode(b'source: pierone.example.org/foo/bar:1.0')
+    client.describe_instance_attribute.return_value = {'UserData': {'Value': user_data}}
+    monkeypatch.setattr('boto3.client', MagicMock(return_value=client))
+
+    runner = CliRunner()
+    result = runner.invoke(cli, ['instances', '--region=myregion', '-d', '-o', 'json'], catch_exceptions=False)
+    assert json.loads(result.output)[0]['docker_source'] == 'pierone.example.org/foo/bar:1.0'
+
+    # second run (e.g. a new process) reads the source from disk
+    monkeypatch.setattr('senza.cli.DOCKER_IMAGE_SOURCES', None)
+    result = runner.invoke(cli, ['instances', '--region=myregion', '-d', '-o', 'json'], catch_exceptions=False)
+    assert json.loads(result.output)[0]['docker_source'] == 'pierone.example.org/foo/bar:1.0'
+    client.describe_instance_attribute.assert_called_once_with(InstanceId='i-123', Attribute='userData')
+
+
 def test_console(monkeypatch):
-    def my_resource(rtype, *args):
-        if rtype == 'ec2':
-            ec2 = MagicMock()
-            instance = MagicMock()
-            instance.id = 'inst-123'
-            instance.private_ip_address = '10.0.0.1'
-            instance.tags = [{'Key': 'aws:cloudformation:stack-name', 'Value': 'test-1'}]
-            instance.console_output.return_value = {'Output': '**MAGIC-CONSOLE-OUTPUT**'}
-            ec2.instances.filter.return_value = [instance]
-            return ec2
-        return MagicMock()
+    ec2 = mock_ec2_client(instance_values('i-123', [{'Key': 'aws:cloudformation:stack-name', 'Value': 'test-1'}],
+                                          private_ip='172.31.1.2'))
+    ec2.get_console_output.return_value = {'Output': '**MAGIC-CONSOLE-OUTPUT**'}
 
     def my_client(rtype, *args, **kwargs):
         if rtype == 'cloudformation':
             cf = MagicMock()
             cf.list_stacks.return_value = {'StackSummaries': [{'StackName': 'test-1'}]}
             return cf
+        elif rtype == 'ec2':
+            return ec2
         return MagicMock()
 
-    monkeypatch.setattr('boto3.resource', my_resource)
     monkeypatch.setattr('boto3.client', my_client)
 
     runner = CliRunner()
@@ -674,50 +774,73 @@ def test_console(monkeypatch):
             yaml.dump(data, fd)
         result = runner.invoke(cli, ['console', 'myapp.yaml', '--region=myregion', '1'],
                                catch_exceptions=False)
-        assert 'Showing last 25 lines of test-1/10.0.0.1..' in result.output
+        assert 'Showing last 25 lines of test-1/172.31.1.2..' in result.output
         assert '**MAGIC-CONSOLE-OUTPUT**' in result.output
 
         result = runner.invoke(cli, ['console', 'foobar', '--region=myregion'],
                                catch_exceptions=False)
         assert '' == result.output
 
+        paginate = ec2.get_paginator.return_value.paginate
         result = runner.invoke(cli, ['console', '172.31.1.2', '--region=myregion'],
                                catch_exceptions=False)
-        assert 'Showing last 25 lines of test-1/10.0.0.1..' in result.output
+        assert 'Showing last 25 lines of test-1/172.31.1.2..' in result.output
         assert '**MAGIC-CONSOLE-OUTPUT**' in result.output
+        # EC2 filters the instances (of any state)
+        paginate.assert_called_with(Filters=[{'Name': 'private-ip-address', 'Values': ['172.31.1.2']}])
 
         result = runner.invoke(cli, ['console', 'i-123', '--region=myregion'],
                                catch_exceptions=False)
-        assert 'Showing last 25 lines of test-1/10.0.0.1..' in result.output
+        assert 'Showing last 25 lines of test-1/172.31.1.2..' in result.output
         assert '**MAGIC-CONSOLE-OUTPUT**' in result.output
+        paginate.assert_called_with(Filters=[{'Name': 'instance-id', 'Values': ['i-123']}])
+
+        paginate.return_value.search.return_value = []
+        result = runner.invoke(cli, ['console', 'i-456', '--region=myregion'],
+                               catch_exceptions=False)
+        assert '' == result.output
+
+
+def test_console_follow(monkeypatch):
+    outputs = [{'Timestamp': 1, 'Output': 'boot 1\nboot 2\nboot'},
+               {'Timestamp': 1, 'Output': 'boot 1\nboot 2\nboot'},
+               {'Timestamp': 2, 'Output': 'boot 1\nboot 2\nboot 3\nboot 4\n'}]
+    ec2 = mock_ec2_client(instance_values('i-123', [{'Key': 'aws:cloudformation:stack-name', 'Value': 'test-1'}]))
+    ec2.get_console_output.side_effect = outputs
+    monkeypatch.setattr('boto3.client', MagicMock(return_value=ec2))
+
+    def sleep(seconds):
+        if not outputs[ec2.get_console_output.call_count:]:
+            raise KeyboardInterrupt()
+    monkeypatch.setattr('time.sleep', sleep)
+
+    runner = CliRunner()
+    result = runner.invoke(cli, ['console', 'i-123', '--region=myregion', '-f'], catch_exceptions=False)
+    # the incomplete line is printed as soon as it is complete, old lines are not repeated
+    assert result.output.splitlines()[:5] == ['==> test-1/10.0.0.1 <==', 'boot 1', 'boot 2', 'boot 3', 'boot 4']
+    assert result.output.count('==>') == 1
 
 
 def test_status(monkeypatch):
-    def my_resource(rtype, *args):
-        if rtype == 'ec2':
-            ec2 = MagicMock()
-            instance = MagicMock()
-            instance.id = 'inst-123'
-            instance.public_ip_address = '8.8.8.8'
-            instance.private_ip_address = '10.0.0.1'
-            instance.state = {'Name': 'Test-instance'}
-            instance.tags = [{'Key': 'aws:cloudformation:stack-name', 'Value': 'test-1'},
-                             {'Key': 'aws:cloudformation:logical-id', 'Value': 'local-id-123'},
-                             {'Key': 'StackName', 'Value': 'test'},
-                             {'Key': 'StackVersion', 'Value': '1'}]
-            instance.launch_time = datetime.datetime.utcnow()
-            ec2.instances.filter.return_value = [instance]
-            return ec2
-        return MagicMock()
+    ec2 = mock_ec2_client(instance_values('inst-123', [{'Key': 'aws:cloudformation:stack-id', 'Value': 'test-1-id'},
+                                                       {'Key': 'aws:cloudformation:stack-name', 'Value': 'test-1'},
+                                                       {'Key': 'StackName', 'Value': 'test'},
+                                                       {'Key': 'StackVersion', 'Value': '1'}]),
+                          # terminated instance of a deleted stack with the same name
+                          instance_values('inst-456', [{'Key': 'aws:cloudformation:stack-id', 'Value': 'old-1-id'},
+                                                       {'Key': 'aws:cloudformation:stack-name', 'Value': 'test-1'}],
+                                          state='terminated'))
 
     def my_client(rtype, *args):
         if rtype == 'cloudformation':
             cf = MagicMock()
-            cf.list_stacks.return_value = {'StackSummaries': [{'StackName': 'test-1'}]}
+            cf.list_stacks.return_value = {'StackSummaries': [{'StackName': 'test-1', 'StackId': 'test-1-id',
+                                                               'StackStatus': 'CREATE_COMPLETE'}]}
             return cf
+        elif rtype == 'ec2':
+            return ec2
         return MagicMock()
 
-    monkeypatch.setattr('boto3.resource', my_resource)
     monkeypatch.setattr('boto3.client', my_client)
 
     runner = CliRunner()
@@ -731,6 +854,11 @@ def test_status(monkeypatch):
                                catch_exceptions=False)
 
     assert 'Running' in result.output
+    result = runner.invoke(cli, ['status', 'test', '--region=myregion', '-o', 'json'], catch_exceptions=False)
+    row = json.loads(result.output)[0]
+    assert (row['total_instances'], row['running_instances']) == (1, 1)
+    filters = ec2.get_paginator.return_value.paginate.call_args[1]['Filters']
+    assert filters == [{'Name': 'tag:aws:cloudformation:stack-id', 'Values': ['test-1-id']}]
 
 
 def test_resources(monkeypatch):
@@ -780,38 +908,42 @@ def test_resources(monkeypatch):
     assert 'Resource Type' in result.output
 
 
-def test_domains(monkeypatch):
-    senza.traffic.DNS_ZONE_CACHE = {}
-    senza.traffic.DNS_RR_CACHE = {}
+def test_dump_concurrency(monkeypatch):
+    cf = MagicMock()
+    cf.list_stacks.return_value = {'StackSummaries': [{'StackName': 'test-{}'.format(i)} for i in range(5)]}
+    cf.get_template.side_effect = lambda StackName: {'TemplateBody': {'Description': StackName}}
+    monkeypatch.setattr('boto3.client', MagicMock(return_value=cf))
+
+    runner = CliRunner()
+    result = runner.invoke(cli, ['dump', 'test', '--region=myregion', '--concurrency=3'], catch_exceptions=False)
+    # output order does not depend on the thread pool
+    positions = [result.output.index('"test-{}"'.format(i)) for i in range(5)]
+    assert positions == sorted(positions)
+
 
+def test_domains(monkeypatch, dns_caches):
     def my_resource(rtype, *args):
-        if rtype == 'cloudformation':
-            res = MagicMock()
-            res.resource_type = 'AWS::Route53::RecordSet'
-            res.physical_resource_id = 'test-1.example.org'
-            res.logical_id = 'VersionDomain'
-            res.last_updated_timestamp = datetime.datetime.now()
-            res2 = MagicMock()
-            res2.resource_type = 'AWS::Route53::RecordSet'
-            res2.physical_resource_id = 'mydomain.example.org'
-            res2.logical_id = 'MainDomain'
-            res2.last_updated_timestamp = datetime.datetime.now()
-            stack = MagicMock()
-            stack.resource_summaries.all.return_value = [res, res2]
-            cf = MagicMock()
-            cf.Stack.return_value = stack
-            return cf
         return MagicMock()
 
     def my_client(rtype, *args):
         if rtype == 'cloudformation':
             cf = MagicMock()
             cf.list_stacks.return_value = {'StackSummaries': [{'StackName': 'test-1'}]}
+            cf.get_paginator.return_value.paginate.return_value = [{'StackResourceSummaries': [
+                {'ResourceType': 'AWS::Route53::RecordSet',
+                 'PhysicalResourceId': 'test-1.example.org',
+                 'LogicalResourceId': 'VersionDomain',
+                 'LastUpdatedTimestamp': datetime.datetime.now()},
+                {'ResourceType': 'AWS::Route53::RecordSet',
+                 'PhysicalResourceId': 'mydomain.example.org',
+                 'LogicalResourceId': 'MainDomain',
+                 'LastUpdatedTimestamp': datetime.datetime.now()}]}]
             return cf
         elif rtype == 'route53':
             route53 = MagicMock()
             route53.list_hosted_zones.return_value = {'HostedZones': [{'Name': 'example.org.',
                                                                                'Id': '/hostedzone/123'}]}
+            route53.list_hosted_zones_by_name.return_value = route53.list_hosted_zones.return_value
             route53.list_resource_record_sets.return_value = {
                 'IsTruncated': False,
                 'MaxItems': '100',
@@ -899,6 +1031,64 @@ def test_events(monkeypatch):
     assert ' CloudFormation::Stack' in result.output
 
 
+def test_events_limit(monkeypatch):
+    cf = MagicMock()
+    cf.list_stacks.return_value = {'StackSummaries': [{'StackName': 'test-1', 'StackId': 'test-1-id'}]}
+    pages = {None: {'StackEvents': [], 'NextToken': 'a'}, 'a': {'StackEvents': [], 'NextToken': 'b'}}
+    for i in range(4):
+        status = 'UPDATE_COMPLETE' if i % 2 == 0 else 'UPDATE_IN_PROGRESS'
+        pages[None if i < 2 else 'a']['StackEvents'].append(
+            {'EventId': str(i), 'LogicalResourceId': 'test-1', 'ResourceStatus': status,
+             'ResourceType': 'AWS::CloudFormation::Stack', 'Timestamp': datetime.datetime(2016, 5, 10 - i)})
+    cf.describe_stack_events.side_effect = lambda StackName, NextToken=None: pages[NextToken]
+    monkeypatch.setattr('boto3.client', MagicMock(return_value=cf))
+
+    runner = CliRunner()
+    result = runner.invoke(cli, ['events', 'test', '1', '--region=myregion', '--limit=3', '-o', 'json'],
+                           catch_exceptions=False)
+    data = json.loads(result.output)
+    # oldest first
+    assert [row['event_time'] for row in data] == sorted(row['event_time'] for row in data)
+    assert [row['ResourceStatus'] for row in data] == ['UPDATE_COMPLETE', 'UPDATE_IN_PROGRESS', 'UPDATE_COMPLETE']
+    # the last page was not fetched
+    assert cf.describe_stack_events.call_count == 2
+
+    result = runner.invoke(cli, ['events', 'test', '1', '--region=myregion', '--since=2016-05-09', '-o', 'json'],
+                           catch_exceptions=False)
+    assert len(json.loads(result.output)) == 2
+
+    result = runner.invoke(cli, ['events', 'test', '1', '--region=myregion', '--since=yesterday'])
+    assert 'invalid time "yesterday"' in result.output
+
+
+def test_events_follow(monkeypatch):
+    cf = MagicMock()
+    cf.list_stacks.return_value = {'StackSummaries': [{'StackName': 'test-1', 'StackId': 'test-1-id'}]}
+
+    def event(event_id, status):
+        return {'EventId': event_id, 'LogicalResourceId': 'test-1', 'ResourceStatus': status,
+                'ResourceType': 'AWS::CloudFormation::Stack', 'Timestamp': datetime.datetime.utcnow()}
+    events = [event('1', 'CREATE_IN_PROGRESS')]
+    cf.describe_stack_events.side_effect = lambda StackName, **kwargs: {'StackEvents': events[::-1]}
+    monkeypatch.setattr('boto3.client', MagicMock(return_value=cf))
+
+    def sleep(seconds):
+        if len(events) == 3:
+            raise KeyboardInterrupt()
+        events.append(event(str(len(events) + 1), 'CREATE_COMPLETE'))
+    monkeypatch.setattr('time.sleep', sleep)
+
+    runner = CliRunner()
+    result = runner.invoke(cli, ['events', 'test', '1', '--region=myregion', '--follow'], catch_exceptions=False)
+    lines = result.output.splitlines()
+    assert len(lines) == 5
+    assert lines[0].endswith(' test 1 CloudFormation::Stack test-1 CREATE_IN_PROGRESS ')
+    assert lines[2].endswith(' test 1 CloudFormation::Stack test-1 CREATE_COMPLETE ')
+    assert lines[-1] == 'Aborted!'
+    # one small page per poll
+    assert cf.describe_stack_events.call_count == 3
+
+
 def test_list(monkeypatch):
     def my_resource(rtype, *args):
         return MagicMock()
@@ -927,41 +1117,99 @@ def test_list(monkeypatch):
     assert 'test-stack 1' in result.output
 
 
-def test_images(monkeypatch):
-    def my_resource(rtype, *args):
-        if rtype == 'ec2':
-            image = MagicMock()
-            image.id = 'ami-123'
-            image.meta.data.copy.return_value = {'Name': 'BrandNewImage',
-                                                 'ImageId': 'ami-123'}
-            image.creation_date = datetime.datetime.utcnow().isoformat('T') + 'Z'
-
-            old_image_still_used = MagicMock()
-            old_image_still_used.id = 'ami-456'
-            old_image_still_used.meta.data.copy.return_value = {'Name': 'OldImage',
-                                                                'ImageId': 'ami-456'}
-            old_image_still_used.creation_date = (datetime.datetime.utcnow() -
-                                                  datetime.timedelta(days=30)).isoformat('T') + 'Z'
-
-            instance = MagicMock()
-            instance.id = 'i-777'
-            instance.image_id = 'ami-456'
-            instance.tags = [{'Key': 'aws:cloudformation:stack-name', 'Value': 'mystack'}]
+def test_list_ndjson(monkeypatch):
+    cf = MagicMock()
+    cf.list_stacks.return_value = {'StackSummaries': [{'StackName': 'test-stack-{}'.format(i),
+                                                       'CreationTime': datetime.datetime.utcnow()}
+                                                      for i in range(3)]}
+    monkeypatch.setattr('boto3.client', MagicMock(return_value=cf))
+
+    runner = CliRunner()
+    result = runner.invoke(cli, ['list', 'test-stack', '--region=myregion,otherregion', '-o', 'ndjson'],
+                           catch_exceptions=False)
+    rows = [json.loads(line) for line in result.output.splitlines()]
+    assert len(rows) == 6
+    assert sorted(rows[0].keys()) == ['creation_time', 'description', 'region', 'stack_name', 'status', 'version']
+    assert {(row['region'], row['version']) for row in rows} == {(region, str(i)) for i in range(3)
+                                                                 for region in ('myregion', 'otherregion')}
 
+
+def test_list_multiple_regions(monkeypatch):
+    def my_client(rtype, region=None, *args):
+        if rtype == 'cloudformation':
+            cf = MagicMock()
+            cf.list_stacks.return_value = {'StackSummaries': [{'StackName': 'test-stack-1',
+                                                               'StackStatus': 'CREATE_{}'.format(region.upper()),
+                                                               'CreationTime': datetime.datetime.utcnow()}]}
+            return cf
+        elif rtype == 'ec2':
             ec2 = MagicMock()
-            ec2.images.filter.return_value = [image, old_image_still_used]
-            ec2.instances.all.return_value = [instance]
+            ec2.describe_regions.return_value = {'Regions': [{'RegionName': 'eu-west-1'},
+                                                             {'RegionName': 'eu-central-1'}]}
             return ec2
         return MagicMock()
 
-    def my_client(rtype, *args):
-        return MagicMock()
-
-    monkeypatch.setattr('boto3.resource', my_resource)
     monkeypatch.setattr('boto3.client', my_client)
 
     runner = CliRunner()
 
+    result = runner.invoke(cli, ['list', '--region=eu-west-1,eu-central-1'], catch_exceptions=False)
+    assert 'Region' in result.output
+    assert 'eu-central-1 test-stack 1    CREATE_EU-CENTRAL-1' in result.output
+    assert 'eu-west-1    test-stack 1    CREATE_EU-WEST-1' in result.output
+
+    result = runner.invoke(cli, ['list', '--region=all-enabled'], catch_exceptions=False)
+    assert 'CREATE_EU-CENTRAL-1' in result.output
+    assert 'CREATE_EU-WEST-1' in result.output
+
+    result = runner.invoke(cli, ['list', '--region=eu-west-1'], catch_exceptions=False)
+    assert 'Region' not in result.output
+
+
+def test_list_multiple_profiles(monkeypatch):
+    class StubSession:
+        def __init__(self, profile_name):
+            self.profile_name = profile_name
+
+        def client(self, service, region=None):
+            client = MagicMock()
+            client.list_stacks.return_value = {'StackSummaries': [
+                {'StackName': '{}-app-1'.format(self.profile_name),
+                 'StackStatus': 'CREATE_COMPLETE',
+                 'CreationTime': datetime.datetime.utcnow()}]}
+            return client
+
+    default_client = MagicMock()
+    monkeypatch.setattr('boto3.session.Session', StubSession)
+    monkeypatch.setattr('boto3.client', lambda *args: default_client)
+
+    runner = CliRunner()
+
+    result = runner.invoke(cli, ['list', '--region=myregion', '-P', 'team-a,team-b', '--profile', 'team-c'],
+                           catch_exceptions=False)
+    assert 'Account' in result.output
+    assert 'team-a  team-a-app 1' in result.output
+    assert 'team-b  team-b-app 1' in result.output
+    assert 'team-c  team-c-app 1' in result.output
+    assert not default_client.list_stacks.called
+
+
+def test_images(monkeypatch):
+    image = {'Name': 'BrandNewImage', 'ImageId': 'ami-123',
+             'CreationDate': datetime.datetime.utcnow().isoformat('T') + 'Z'}
+    old_image_still_used = {'Name': 'OldImage', 'ImageId': 'ami-456',
+                            'CreationDate': (datetime.datetime.utcnow() -
+                                             datetime.timedelta(days=30)).isoformat('T') + 'Z'}
+
+    ec2 = MagicMock()
+    ec2.get_paginator.return_value.paginate.return_value.search.return_value = [['i-777', 'ami-456', 'mystack-1'],
+                                                                                ['i-888', 'ami-456', None]]
+    ec2.describe_images.side_effect = lambda Filters: {
+        'Images': [old_image_still_used] if Filters[0]['Name'] == 'image-id' else [image]}
+    monkeypatch.setattr('boto3.client', MagicMock(return_value=ec2))
+
+    runner = CliRunner()
+
     with runner.isolated_filesystem():
         result = runner.invoke(cli, ['images', '--region=myregion'], catch_exceptions=False)
 
@@ -969,6 +1217,40 @@ def test_images(monkeypatch):
     assert 'ami-456' in result.output
     assert 'mystack' in result.output
 
+    result = runner.invoke(cli, ['images', 'mystack', '--region=myregion', '--show-instances', '-o', 'json'],
+                           catch_exceptions=False)
+    rows = json.loads(result.output)
+    assert [(row['ImageId'], row['stacks'], row['instances']) for row in rows] == [('ami-456', 'mystack-1', 'i-777')]
+    filters = ec2.get_paginator.return_value.paginate.call_args[1]['Filters']
+    assert filters[0] == {'Name': 'tag:aws:cloudformation:stack-name', 'Values': ['mystack-*']}
+
+
+def test_wait_rollback_reasons(monkeypatch):
+    created = datetime.datetime(2016, 1, 1, 12, 0)
+
+    def event(minutes, logical_id, status, reason):
+        return {'Timestamp': created + datetime.timedelta(minutes=minutes), 'LogicalResourceId': logical_id,
+                'ResourceStatus': status, 'ResourceStatusReason': reason}
+
+    cf = MagicMock()
+    cf.describe_stack_events.return_value = {'StackEvents': [
+        event(3, 'test-1', 'ROLLBACK_COMPLETE', None),
+        event(2, 'test-1', 'ROLLBACK_IN_PROGRESS', 'The following resource(s) failed to create: [AppServer].'),
+        event(1, 'AppServer', 'CREATE_FAILED', 'Instance limit exceeded'),
+        event(0, 'test-1', 'CREATE_IN_PROGRESS', 'User Initiated')]}
+    monkeypatch.setattr('boto3.client', MagicMock(return_value=cf))
+    # the rollback started (and set the DeletionTime) after the resource failed
+    stack = SenzaStackSummary({'StackName': 'test-1', 'StackId': 'test-1-id', 'StackStatus': 'ROLLBACK_COMPLETE',
+                               'CreationTime': created, 'DeletionTime': created + datetime.timedelta(minutes=2)})
+    monkeypatch.setattr('senza.cli.get_stacks', MagicMock(return_value=[stack]))
+
+    runner = CliRunner()
+    result = runner.invoke(cli, ['wait', 'test', '1', '--region=myregion'], catch_exceptions=False)
+    assert 'ERROR: AppServer CREATE_FAILED: Instance limit exceeded' in result.output
+    assert 'ERROR: test-1 ROLLBACK_IN_PROGRESS: The following resource(s) failed to create' in result.output
+    assert 'ERROR: Stack test-1 has status ROLLBACK_COMPLETE' in result.output
+    assert result.exit_code == 1
+
 
 def test_delete(monkeypatch):
 
@@ -1160,6 +1442,8 @@ def test_traffic(monkeypatch):
     def my_client(rtype, *args, **kwargs):
         if rtype == 'route53':
             return route53
+        elif rtype == 'ec2':
+            return mock_ec2_client()
         return MagicMock()
 
     monkeypatch.setattr('boto3.client', my_client)
@@ -1245,13 +1529,13 @@ def test_traffic(monkeypatch):
         assert weights() == [0, 0, 0, 0]
 
 
-def test_AccountArguments(monkeypatch):
-    senza.traffic.DNS_ZONE_CACHE = {}
+def test_AccountArguments(monkeypatch, dns_caches):
     senza_aws = MagicMock()
     senza_aws.get_account_alias.return_value = 'test-cli'
     senza_aws.get_account_id.return_value = '123456'
     boto3 = MagicMock()
     boto3.list_hosted_zones.return_value = {'HostedZones': [{'Name': 'test.example.net'}]}
+    boto3.list_hosted_zones_by_name.return_value = boto3.list_hosted_zones.return_value
     monkeypatch.setattr('boto3.client', MagicMock(return_value=boto3))
     monkeypatch.setattr('senza.cli.get_account_alias', MagicMock(return_value='test-cli'))
     monkeypatch.setattr('senza.cli.get_account_id', MagicMock(return_value='98741256325'))
@@ -1268,7 +1552,10 @@ def test_AccountArguments(monkeypatch):
 def test_patch(monkeypatch):
     boto3 = MagicMock()
     boto3.list_stacks.return_value = {'StackSummaries': [{'StackName': 'myapp-1'}]}
-    boto3.describe_stack_resources.return_value = {'StackResources': [{'ResourceType': 'AWS::AutoScaling::AutoScalingGroup', 'PhysicalResourceId': 'myasg'}]}
+    boto3.get_paginator.return_value.paginate.return_value = [{'ResourceTagMappingList': [
+        {'ResourceARN': 'arn:aws:autoscaling:myregion:123:autoScalingGroup:1a2b:autoScalingGroupName/myasg',
+         'Tags': [{'Key': 'aws:cloudformation:stack-name', 'Value': 'myapp-1'},
+                  {'Key': 'aws:cloudformation:logical-id', 'Value': 'AppServer'}]}]}]
     group = {'AutoScalingGroupName': 'myasg'}
     boto3.describe_auto_scaling_groups.return_value = {'AutoScalingGroups': [group]}
     image = MagicMock()
@@ -1304,7 +1591,17 @@ def test_respawn(monkeypatch):
 def test_scale(monkeypatch):
     boto3 = MagicMock()
     boto3.list_stacks.return_value = {'StackSummaries': [{'StackName': 'myapp-1'}]}
-    boto3.describe_stack_resources.return_value = {'StackResources': [{'ResourceType': 'AWS::AutoScaling::AutoScalingGroup', 'PhysicalResourceId': 'myasg'}]}
+    boto3.get_resources.side_effect = botocore.exceptions.ClientError({'Error': {'Code': 'AccessDeniedException'}}, 'GetResources')
+
+    def get_paginator(operation):
+        paginator = MagicMock()
+        if operation == 'get_resources':
+            paginator.paginate.side_effect = lambda **kwargs: [boto3.get_resources(**kwargs)]
+        else:
+            paginator.paginate.return_value = [{'StackResourceSummaries': [
+                {'ResourceType': 'AWS::AutoScaling::AutoScalingGroup', 'PhysicalResourceId': 'myasg'}]}]
+        return paginator
+    boto3.get_paginator = get_paginator
     # NOTE: we are using invalid MinSize (< capacity) here to get one more line covered ;-)
     group = {'AutoScalingGroupName': 'myasg', 'DesiredCapacity': 1, 'MinSize': 3, 'MaxSize': 1}
     boto3.describe_auto_scaling_groups.return_value = {'AutoScalingGroups': [group]}
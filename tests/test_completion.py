@@ -0,0 +1,71 @@
+import subprocess
+import sys
+import time
+from unittest.mock import MagicMock
+from senza.cli import cli
+from senza.completion import COMMANDS, VALUE_OPTIONS, complete, refresh_index, read_index, write_index
+
+
+def test_commands():
+    assert sorted(COMMANDS) == sorted(cli.commands.keys())
+
+
+def test_value_options():
+    commands = [cli] + list(cli.commands.values())
+    options = {opt for command in commands for param in command.params
+               if param.param_type_name == 'option' and not param.is_flag for opt in param.opts}
+    assert sorted(VALUE_OPTIONS) == sorted(options)
+
+
+def test_complete_from_index(monkeypatch, tmpdir, capsys):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir))
+    popen = MagicMock()
+    monkeypatch.setattr('subprocess.Popen', popen)
+    monkeypatch.setenv('COMP_WORDS', 'senza traffic --region=myregion myapp')
+    monkeypatch.setenv('COMP_CWORD', '4')
+
+    # first completion does not block: nothing cached yet, refresh runs in the background
+    complete()
+    out, err = capsys.readouterr()
+    assert out == ''
+    assert popen.call_args[0][0][-2:] == ['refresh', 'myregion']
+
+    # only one background refresh at a time
+    complete()
+    assert popen.call_count == 1
+
+    write_index('myregion', {'myapp': ['v1', 'v2'], 'other': ['1']})
+    complete()
+    out, err = capsys.readouterr()
+    assert out.split() == ['v1', 'v2', 'myapp', 'other']
+    assert popen.call_count == 1
+
+
+def test_complete_split_at_word_breaks(monkeypatch, tmpdir, capsys):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir))
+    monkeypatch.setattr('subprocess.Popen', MagicMock())
+    write_index('eu-west-1', {'myapp': ['v1', 'v2'], 'other': ['1']})
+    # bash splits "--region=eu-west-1" into "--region", "=" and "eu-west-1"
+    monkeypatch.setenv('COMP_WORDS', 'senza traffic --region = eu-west-1 -o json myapp')
+    monkeypatch.setenv('COMP_CWORD', '8')
+    complete()
+    out, err = capsys.readouterr()
+    assert out.split() == ['v1', 'v2', 'myapp', 'other']
+
+
+def test_refresh_index(monkeypatch, tmpdir):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir))
+    cf = MagicMock()
+    cf.list_stacks.return_value = {'StackSummaries': [{'StackName': 'myapp-v2'}, {'StackName': 'myapp-v1'},
+                                                      {'StackName': 'other-1'}]}
+    monkeypatch.setattr('boto3.client', lambda *args: cf)
+    refresh_index('myregion')
+    index = read_index('myregion')
+    assert index['stacks'] == {'myapp': ['v1', 'v2'], 'other': ['1']}
+    assert index['updated'] > time.time() - 60
+
+
+def test_completion_does_not_import_boto3():
+    code = ('import os, sys; os.environ.update(COMP_WORDS="senza li", COMP_CWORD="1"); '
+            'import senza.completion; senza.completion.complete(); assert "boto3" not in sys.modules')
+    assert subprocess.check_output([sys.executable, '-c', code]).decode().split() == ['list']
@@ -1,6 +1,7 @@
 import click
 import pytest
 from unittest.mock import MagicMock
+import senza.traffic
 from senza.cli import AccountArguments
 from senza.components import get_component
 from senza.components.iam_role import component_iam_role, get_merged_policies
@@ -12,7 +13,6 @@ from senza.components.redis_cluster import component_redis_cluster
 from senza.components.auto_scaling_group \
     import component_auto_scaling_group, normalize_network_threshold, to_iso8601_duration, normalize_asg_success
 from senza.components.taupage_auto_scaling_group import generate_user_data
-import senza.traffic
 
 
 def test_invalid_component():
@@ -158,9 +158,10 @@ def test_component_stups_auto_configuration(monkeypatch):
     sn3.availability_zone = 'az-1'
     ec2 = MagicMock()
     ec2.subnets.filter.return_value = [sn1, sn2, sn3]
-    image = MagicMock()
-    ec2.images.filter.return_value = [image]
     monkeypatch.setattr('boto3.resource', lambda x, y: ec2)
+    client = MagicMock()
+    client.describe_images.return_value = {'Images': [{'ImageId': 'ami-123', 'Name': 'Taupage-AMI-123'}]}
+    monkeypatch.setattr('boto3.client', lambda x, y: client)
 
     result = component_stups_auto_configuration({}, configuration, args, MagicMock(), False, MagicMock())
 
@@ -234,9 +235,7 @@ def test_component_redis_cluster(monkeypatch):
     assert 'SubnetIds' in result['Resources']['RedisSubnetGroup']['Properties']
 
 
-def test_weighted_dns_load_balancer(monkeypatch):
-    senza.traffic.DNS_ZONE_CACHE = {}
-
+def test_weighted_dns_load_balancer(monkeypatch, dns_caches):
     def my_client(rtype, *args):
         if rtype == 'route53':
             route53 = MagicMock()
@@ -245,6 +244,7 @@ def test_weighted_dns_load_balancer(monkeypatch):
                                                                        'ResourceRecordSetCount': 23}],
                                                       'IsTruncated': False,
                                                       'MaxItems': '100'}
+            route53.list_hosted_zones_by_name.return_value = route53.list_hosted_zones.return_value
             return route53
         return MagicMock()
 
@@ -278,9 +278,7 @@ def test_weighted_dns_load_balancer(monkeypatch):
     assert 'MainDomain' not in result["Resources"]["test_lb"]["Properties"]
 
 
-def test_weighted_dns_load_balancer_with_different_domains(monkeypatch):
-    senza.traffic.DNS_ZONE_CACHE = {}
-
+def test_weighted_dns_load_balancer_with_different_domains(monkeypatch, dns_caches):
     def my_client(rtype, *args):
         if rtype == 'route53':
             route53 = MagicMock()
@@ -292,6 +290,7 @@ def test_weighted_dns_load_balancer_with_different_domains(monkeypatch):
                                                                        'ResourceRecordSetCount': 23}],
                                                       'IsTruncated': False,
                                                       'MaxItems': '100'}
+            route53.list_hosted_zones_by_name.return_value = route53.list_hosted_zones.return_value
             return route53
         return MagicMock()
 
@@ -332,7 +331,7 @@ def test_weighted_dns_load_balancer_with_different_domains(monkeypatch):
         'MainDomain': 'this.does.not.exists.com',
         'VersionDomain': 'this.does.not.exists.com'
     }
-    senza.traffic.DNS_ZONE_CACHE = {}
+    senza.traffic.DNS_ZONES.invalidate()
     try:
         result = component_weighted_dns_elastic_load_balancer(definition,
                                                               configuration,
@@ -0,0 +1,45 @@
+from unittest.mock import MagicMock
+import senza.ec2
+from senza.ec2 import get_instance_index
+
+
+def instance(instance_id, stack_name=None):
+    tags = [{'Key': 'aws:cloudformation:stack-name', 'Value': stack_name}] if stack_name else None
+    return [instance_id, 'ami-123', 'running', None, None, None, tags]
+
+
+def test_get_instance_index():
+    ec2 = MagicMock()
+    pages = ec2.get_paginator.return_value.paginate.return_value
+    pages.search.side_effect = [[instance('i-1', 'stack-1'), instance('i-2', 'stack-2'), instance('i-3', 'stack-1')],
+                                [instance('i-4', 'stack-249'), instance('i-1', 'stack-1')]]
+    stack_names = ['stack-{}'.format(i) for i in range(250)]
+    index = get_instance_index(ec2, stack_names)
+    assert index.get_stack_names() == ['stack-1', 'stack-2', 'stack-249']
+    assert [i.id for i in index.get_stack_instances('stack-1')] == ['i-1', 'i-3']
+    assert index.get_tags('i-2') == {'aws:cloudformation:stack-name': 'stack-2'}
+    assert index.get('i-2').state == 'running'
+    assert index.get_tags('i-404') == {}
+    # one (paginated) call per 200 stacks
+    assert pages.search.call_count == 2
+    assert ec2.get_paginator.return_value.paginate.call_args[1]['Filters'][0]['Values'] == stack_names[200:]
+
+
+def test_get_instance_index_max_age(monkeypatch):
+    monkeypatch.setattr('senza.ec2.INSTANCE_INDEXES', {})
+    ec2 = MagicMock()
+    pages = ec2.get_paginator.return_value.paginate.return_value
+    pages.search.return_value = [instance('i-1', 'stack-1'), instance('i-2')]
+
+    index = get_instance_index(ec2, max_age=60)
+    assert index.get_stack_names() == ['stack-1']
+    assert [i.id for i in index.get_stack_instances(None)] == ['i-2']
+    assert get_instance_index(ec2, max_age=60) is index
+    assert get_instance_index(ec2) is not index
+    assert get_instance_index(ec2, ['stack-1'], max_age=60) is not index
+    assert pages.search.call_count == 3
+    # nothing to scan
+    assert get_instance_index(ec2, []).get_stack_names() == []
+    assert pages.search.call_count == 3
+    # scans without max_age are not kept
+    assert len(senza.ec2.INSTANCE_INDEXES) == 2
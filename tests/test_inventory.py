@@ -0,0 +1,91 @@
+import datetime
+import time
+from unittest.mock import MagicMock
+from senza.aws import get_stacks, StackReference, ACTIVE_STACK_STATUSES
+from senza.inventory import StackInventory, DELETED_MAX_AGE
+
+
+def summary(name, status='CREATE_COMPLETE', **kwargs):
+    data = {'StackId': 'arn:aws:cloudformation:myregion:123:stack/{}/1'.format(name),
+            'StackName': name,
+            'StackStatus': status,
+            'CreationTime': datetime.datetime(2015, 12, 1, tzinfo=datetime.timezone.utc)}
+    data.update(kwargs)
+    return data
+
+
+def test_incremental_refresh(monkeypatch, tmpdir):
+    cf = MagicMock()
+    cf.list_stacks.return_value = {'StackSummaries': [summary('myapp-1'), summary('myapp-2')]}
+    monkeypatch.setattr('boto3.client', lambda *args: cf)
+
+    inventory = StackInventory(str(tmpdir.join('inventory.sqlite')), 'myregion', ACTIVE_STACK_STATUSES)
+    stacks = inventory.get_stack_summaries(max_age=60)
+    assert [s['StackName'] for s in stacks] == ['myapp-1', 'myapp-2']
+    assert stacks[0]['CreationTime'] == datetime.datetime(2015, 12, 1, tzinfo=datetime.timezone.utc)
+    assert cf.list_stacks.call_count == 1
+
+    # fresh enough: no API call
+    inventory.get_stack_summaries(max_age=60)
+    assert cf.list_stacks.call_count == 1
+
+    # myapp-2 was deleted in the meantime
+    cf.list_stacks.return_value = {'StackSummaries': [summary('myapp-1', 'UPDATE_COMPLETE')]}
+    stacks = inventory.get_stack_summaries(max_age=0)
+    assert [(s['StackName'], s['StackStatus']) for s in stacks] == [('myapp-1', 'UPDATE_COMPLETE')]
+
+    # the deleted history is only listed again after DELETED_MAX_AGE
+    def list_stacks(StackStatusFilter, **kwargs):
+        if StackStatusFilter == ['DELETE_COMPLETE']:
+            return {'StackSummaries': [summary('myapp-0', 'DELETE_COMPLETE',
+                                               DeletionTime=datetime.datetime.now(datetime.timezone.utc))]}
+        return {'StackSummaries': [summary('myapp-1', 'UPDATE_COMPLETE')]}
+    cf.list_stacks.side_effect = list_stacks
+    stacks = inventory.get_stack_summaries(all=True, max_age=60)
+    assert [(s['StackName'], s['StackStatus']) for s in stacks] == [('myapp-0', 'DELETE_COMPLETE'),
+                                                                    ('myapp-1', 'UPDATE_COMPLETE'),
+                                                                    ('myapp-2', 'DELETE_COMPLETE')]
+    cf.list_stacks.assert_called_with(StackStatusFilter=['DELETE_COMPLETE'])
+    calls = cf.list_stacks.call_count
+    inventory.get_stack_summaries(all=True, max_age=60)
+    assert cf.list_stacks.call_count == calls
+
+    inventory.set_synced('deleted', time.time() - DELETED_MAX_AGE - 1)
+    inventory.get_stack_summaries(all=True, max_age=60)
+    cf.list_stacks.assert_called_with(StackStatusFilter=['DELETE_COMPLETE'])
+    calls = cf.list_stacks.call_count
+
+    inventory.invalidate()
+    inventory.get_stack_summaries(max_age=60)
+    assert cf.list_stacks.call_count == calls + 1
+
+
+def test_nested_datetimes(monkeypatch, tmpdir):
+    checked = datetime.datetime(2016, 1, 2, tzinfo=datetime.timezone.utc)
+    cf = MagicMock()
+    cf.list_stacks.return_value = {'StackSummaries': [summary('myapp-1', DriftInformation={
+        'StackDriftStatus': 'IN_SYNC', 'LastCheckTimestamp': checked})]}
+    monkeypatch.setattr('boto3.client', lambda *args: cf)
+
+    inventory = StackInventory(str(tmpdir.join('inventory.sqlite')), 'myregion', ACTIVE_STACK_STATUSES)
+    inventory.get_stack_summaries(max_age=60)
+    stack, = inventory.get_stack_summaries(max_age=60)
+    assert stack['DriftInformation'] == {'StackDriftStatus': 'IN_SYNC', 'LastCheckTimestamp': checked}
+    assert stack['CreationTime'] == datetime.datetime(2015, 12, 1, tzinfo=datetime.timezone.utc)
+
+
+def test_get_stacks_from_inventory(monkeypatch, tmpdir):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir))
+    monkeypatch.setattr('senza.inventory.MAX_AGE', 60)
+    monkeypatch.setattr('senza.aws.STACK_INVENTORIES', {})
+    monkeypatch.setattr('senza.aws.get_account_id', lambda session: '123')
+    cf = MagicMock()
+    cf.list_stacks.return_value = {'StackSummaries': [summary('myapp-1'), summary('other-1')]}
+    monkeypatch.setattr('boto3.client', lambda *args: cf)
+
+    stacks = list(get_stacks([StackReference('myapp', None)], 'myregion'))
+    assert [s.StackName for s in stacks] == ['myapp-1']
+    assert tmpdir.join('senza', 'inventory-123-myregion.sqlite').check()
+
+    list(get_stacks([], 'myregion'))
+    assert cf.list_stacks.call_count == 1
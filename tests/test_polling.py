@@ -0,0 +1,59 @@
+import pytest
+from unittest.mock import MagicMock
+from botocore.exceptions import ClientError
+import senza.polling
+from senza.cli import get_instance_health
+from senza.polling import PollingScheduler, record_throttling, call_with_backoff
+
+
+def test_polling_scheduler(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr('time.sleep', sleeps.append)
+    scheduler = PollingScheduler(2, 10, jitter=0)
+
+    for changed in (False, False, False, False, False):
+        scheduler.sleep(changed)
+    assert sleeps == [3, 4.5, 6.75, 10, 10]
+
+    scheduler.sleep(True)
+    assert scheduler.interval == 2
+
+    # throttling wins over changes
+    record_throttling()
+    scheduler.sleep(True)
+    assert scheduler.interval == 4
+    assert scheduler.describe().endswith(', throttled')
+
+    # unknown changes keep the interval
+    scheduler.sleep()
+    assert scheduler.interval == 4
+    assert scheduler.polls == 8
+
+    # never sleep past a deadline
+    scheduler.sleep(max_seconds=1.5)
+    assert sleeps[-1] == 1.5
+
+
+def test_instance_health_throttling(monkeypatch):
+    elb = MagicMock()
+    elb.describe_instance_health.side_effect = ClientError({'Error': {'Code': 'Throttling'}}, 'DescribeInstanceHealth')
+    throttled = senza.polling.THROTTLED_REQUESTS
+    assert get_instance_health(elb, 'myapp-1') == {}
+    assert senza.polling.THROTTLED_REQUESTS == throttled + 1
+
+
+def test_call_with_backoff(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr('time.sleep', sleeps.append)
+    func = MagicMock(side_effect=[ClientError({'Error': {'Code': 'Throttling'}}, 'DescribeStackResources'),
+                                  ClientError({'Error': {'Code': 'Throttling'}}, 'DescribeStackResources'),
+                                  'result'])
+    assert call_with_backoff(func, StackName='myapp-1') == 'result'
+    func.assert_called_with(StackName='myapp-1')
+    assert len(sleeps) == 2
+    assert sleeps[1] <= 1
+
+    func = MagicMock(side_effect=ClientError({'Error': {'Code': 'ValidationError'}}, 'DescribeStackResources'))
+    with pytest.raises(ClientError):
+        call_with_backoff(func)
+    assert len(sleeps) == 2
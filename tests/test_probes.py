@@ -0,0 +1,29 @@
+import time
+from unittest.mock import MagicMock
+from senza.probes import Prober, UNKNOWN
+
+
+def test_run_deadline():
+    def slow(name):
+        time.sleep(1)
+        return 'OK'
+
+    prober = Prober()
+    start = time.time()
+    assert prober.run([(slow, 'a'), (len, 'abc')], deadline=0.1) == [UNKNOWN, 3]
+    assert time.time() - start < 0.5
+
+
+def test_probes_reuse_clients():
+    prober = Prober()
+    prober.http = MagicMock()
+    prober.http.get.side_effect = [None, Exception('timeout')]
+    prober.resolver = MagicMock()
+    answer = MagicMock()
+    answer.target.to_text.return_value = 'myapp-1.example.org.'
+    prober.resolver.query.return_value = [answer]
+
+    assert prober.run([(prober.get_http_status, 'myapp-1.example.org'),
+                       (prober.get_cname_targets, 'myapp.example.org')]) == ['OK', ['myapp-1.example.org.']]
+    assert prober.get_http_status('myapp-1.example.org') == 'ERROR'
+    prober.http.get.assert_called_with('https://myapp-1.example.org/', timeout=2)
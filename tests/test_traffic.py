@@ -1,6 +1,8 @@
 from unittest.mock import MagicMock
+import senza.traffic
 from senza.aws import SenzaStackSummary
-from senza.traffic import get_stack_versions, StackVersion
+from senza.traffic import get_stack_versions, StackVersion, get_record_index, get_cname_records, invalidate_records, \
+    get_zone, ZoneIndex
 
 
 def test_get_stack_versions(monkeypatch):
@@ -25,14 +27,120 @@ def test_get_stack_versions(monkeypatch):
 
     stack = MagicMock(stack_name='my-stack-1')
     resource = [
-        MagicMock(resource_type='AWS::ElasticLoadBalancing::LoadBalancer'),
-        MagicMock(resource_type='AWS::Route53::RecordSet', physical_resource_id='myapp.example.org')
+        {'ResourceType': 'AWS::ElasticLoadBalancing::LoadBalancer', 'PhysicalResourceId': 'myapp-1',
+         'LogicalResourceId': 'AppLoadBalancer'},
+        {'ResourceType': 'AWS::Route53::RecordSet', 'PhysicalResourceId': 'myapp.example.org',
+         'LogicalResourceId': 'MainDomain'}
     ]
-    cf.Stack.return_value = MagicMock(tags=[{'Value': '1', 'Key': 'StackVersion'}], notification_arns=['some-arn'],
-                                      resource_summaries=MagicMock(all=MagicMock(return_value=resource)))
-    elb.describe_load_balancers.return_value = {'LoadBalancerDescriptions': [{'DNSName': 'elb-dns-name'}]}
+    cf.get_paginator.return_value.paginate.return_value = [{'StackResourceSummaries': resource}]
+    cf.describe_stacks.return_value = {'Stacks': [{'Tags': [{'Value': '1', 'Key': 'StackVersion'}],
+                                                   'NotificationARNs': ['some-arn']}]}
+    elb.describe_load_balancers.return_value = {'LoadBalancerDescriptions': [{'LoadBalancerName': 'myapp-1',
+                                                                              'DNSName': 'elb-dns-name'}]}
     monkeypatch.setattr('senza.traffic.get_stacks', MagicMock(
         return_value=[SenzaStackSummary(stack), SenzaStackSummary({'StackStatus': 'ROLLBACK_COMPLETE',
                                                                    'StackName': 'my-stack-1'})]))
     stack_version = list(get_stack_versions('my-stack', 'my-region'))
     assert stack_version == [StackVersion('my-stack', '1', ['myapp.example.org'], ['elb-dns-name'], ['some-arn'])]
+    elb.describe_load_balancers.assert_called_once_with(LoadBalancerNames=['myapp-1'])
+
+
+def test_get_stack_versions_batches_load_balancers(monkeypatch):
+    cf = MagicMock()
+    elb = MagicMock()
+    monkeypatch.setattr('boto3.client', lambda service, *args: cf if service == 'cloudformation' else elb)
+    stacks = [SenzaStackSummary({'StackName': 'my-stack-{}'.format(i), 'StackId': 'id-{}'.format(i),
+                                 'StackStatus': 'CREATE_COMPLETE'}) for i in range(25)]
+    monkeypatch.setattr('senza.traffic.get_stacks', MagicMock(return_value=stacks))
+    monkeypatch.setattr('senza.traffic.get_stack_resources', MagicMock(return_value={
+        stack.StackName: [{'ResourceType': 'AWS::ElasticLoadBalancing::LoadBalancer',
+                           'PhysicalResourceId': 'lb-{}'.format(stack.version), 'LogicalResourceId': 'AppLB'}]
+        for stack in stacks}))
+    cf.describe_stacks.side_effect = lambda StackName: {'Stacks': [{'Tags': [
+        {'Key': 'StackVersion', 'Value': StackName.split('-')[1]}]}]}
+    elb.describe_load_balancers.side_effect = lambda LoadBalancerNames: {'LoadBalancerDescriptions': [
+        {'LoadBalancerName': name, 'DNSName': '{}.elb'.format(name)} for name in LoadBalancerNames]}
+
+    versions = list(get_stack_versions('my-stack', 'my-region'))
+    assert [(v.version, v.lb_dns_name) for v in versions[:2]] == [('0', ['lb-0.elb']), ('1', ['lb-1.elb'])]
+    assert versions[24].notification_arns == []
+    # 25 load balancers are described in two calls
+    assert elb.describe_load_balancers.call_count == 2
+    assert cf.describe_stacks.call_count == 25
+
+
+def test_record_index(monkeypatch, dns_caches):
+    senza.traffic.DNS_ZONES.put((None, None), ZoneIndex([{'Name': 'example.org.', 'Id': '/hostedzone/123'}]))
+    route53 = MagicMock()
+    records = [{'Name': 'example.org.', 'Type': 'NS'},
+               {'Name': 'myapp.example.org.', 'Type': 'CNAME', 'SetIdentifier': 'myapp-v1'},
+               {'Name': 'myapp.example.org.', 'Type': 'CNAME', 'SetIdentifier': 'myapp-v2'},
+               {'Name': 'myapp-v1.example.org.', 'Type': 'CNAME'}]
+
+    def list_resource_record_sets(HostedZoneId, StartRecordName=None, StartRecordType=None):
+        start = [r['Name'] for r in records].index(StartRecordName) if StartRecordName else 0
+        return {'IsTruncated': False, 'ResourceRecordSets': records[start:]}
+    route53.list_resource_record_sets.side_effect = list_resource_record_sets
+    monkeypatch.setattr('boto3.client', MagicMock(return_value=route53))
+
+    index = get_record_index('example.org')
+    assert index['myapp-v1.example.org']['CNAME'][None]['Name'] == 'myapp-v1.example.org.'
+    assert [r['SetIdentifier'] for r in get_cname_records('myapp.example.org')] == ['myapp-v1', 'myapp-v2']
+    assert get_cname_records('other.example.org.') == []
+    assert len(get_cname_records('MyApp.example.org.')) == 2
+    # the zone is only listed once
+    assert route53.list_resource_record_sets.call_count == 1
+
+    assert senza.traffic.DNS_RECORD_INDEXES.stats() == {'hits': 3, 'misses': 1, 'size': 1}
+
+    # without the zone's index only the record sets of the name are listed
+    invalidate_records('/hostedzone/123')
+    assert [r['SetIdentifier'] for r in get_cname_records('myapp.example.org')] == ['myapp-v1', 'myapp-v2']
+    assert route53.list_resource_record_sets.call_count == 2
+    assert route53.list_resource_record_sets.call_args[1] == {'HostedZoneId': '/hostedzone/123',
+                                                              'StartRecordName': 'myapp.example.org.',
+                                                              'StartRecordType': 'CNAME'}
+
+
+def test_cname_records_of_name(monkeypatch, dns_caches):
+    senza.traffic.DNS_ZONES.put((None, None), ZoneIndex([{'Name': 'example.org.', 'Id': '/hostedzone/123'}]))
+    route53 = MagicMock()
+    route53.list_resource_record_sets.side_effect = [
+        {'IsTruncated': True, 'NextRecordName': 'myapp.example.org.', 'NextRecordType': 'CNAME',
+         'NextRecordIdentifier': 'myapp-v2',
+         'ResourceRecordSets': [{'Name': 'myapp.example.org.', 'Type': 'CNAME', 'SetIdentifier': 'myapp-v1'}]},
+        {'IsTruncated': True, 'NextRecordName': 'zzz.example.org.', 'NextRecordType': 'A',
+         'ResourceRecordSets': [{'Name': 'myapp.example.org.', 'Type': 'CNAME', 'SetIdentifier': 'myapp-v2'},
+                                {'Name': 'myapp-v1.example.org.', 'Type': 'CNAME'}]}]
+    monkeypatch.setattr('boto3.client', MagicMock(return_value=route53))
+
+    assert [r['SetIdentifier'] for r in get_cname_records('MyApp.example.org')] == ['myapp-v1', 'myapp-v2']
+    # the listing stops at the next name, the record sets are cached per name
+    assert get_cname_records('myapp.example.org.')[1]['SetIdentifier'] == 'myapp-v2'
+    assert route53.list_resource_record_sets.call_count == 2
+    assert route53.list_resource_record_sets.call_args[1]['StartRecordIdentifier'] == 'myapp-v2'
+
+
+def test_get_zone(monkeypatch, dns_caches):
+    zones = [{'Name': 'example.org.', 'Id': '/hostedzone/private', 'Config': {'PrivateZone': True}},
+             {'Name': 'example.org.', 'Id': '/hostedzone/public', 'Config': {'PrivateZone': False}},
+             {'Name': 'example.org.fake.', 'Id': '/hostedzone/fake'}]
+    route53 = MagicMock()
+    route53.list_hosted_zones_by_name.side_effect = lambda DNSName, MaxItems: {
+        'HostedZones': [zone for zone in zones if zone['Name'] >= DNSName]}
+    route53.list_hosted_zones.return_value = {'HostedZones': zones}
+    monkeypatch.setattr('boto3.client', MagicMock(return_value=route53))
+
+    assert get_zone('myapp.example.org')['Id'] == '/hostedzone/public'
+    assert get_zone('myapp.example.org', private=True)['Id'] == '/hostedzone/private'
+    # one lookup per suffix until a zone is found, cached per domain name
+    assert [c[1]['DNSName'] for c in route53.list_hosted_zones_by_name.call_args_list] == [
+        'myapp.example.org.', 'example.org.', 'myapp.example.org.', 'example.org.']
+    get_zone('myapp.example.org')
+    assert route53.list_hosted_zones_by_name.call_count == 4
+    assert not route53.list_hosted_zones.called
+
+    # once all zones are listed, they are looked up in the suffix trie
+    assert [zone['Id'] for zone in get_zone(None, all=True)] == ['/hostedzone/public', '/hostedzone/fake']
+    assert get_zone('other.example.org.', all=True) == [zones[1]]
+    assert route53.list_hosted_zones_by_name.call_count == 4
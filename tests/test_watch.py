@@ -0,0 +1,46 @@
+from unittest.mock import MagicMock
+from senza.aws import SenzaStackSummary
+from senza.watch import WatchScreen, StackResults, TerminalBuffer
+
+
+def test_watch_screen_redraws_changed_rows(monkeypatch):
+    out = TerminalBuffer()
+    monkeypatch.setattr('sys.stdout', out)
+    monkeypatch.setenv('LINES', '50')
+
+    screen = WatchScreen(True)
+    rows = [{'name': 'a', 'status': 'CREATE_IN_PROGRESS'}, {'name': 'b', 'status': 'CREATE_COMPLETE'}]
+    screen.print_table(['name', 'status'], rows, key=['name'])
+    first = out.getvalue()
+    assert 'CREATE_IN_PROGRESS' in first
+    assert 'CREATE_COMPLETE' in first
+
+    out.truncate(0)
+    out.seek(0)
+    rows = [{'name': 'a', 'status': 'CREATE_COMPLETE   '}, {'name': 'b', 'status': 'CREATE_COMPLETE'}]
+    screen.print_table(['name', 'status'], rows, key=['name'])
+    # only the first row (second line) was redrawn and is highlighted
+    assert out.getvalue().startswith('\x1b[2;1H\x1b[2K\x1b[7ma')
+    assert out.getvalue().count('CREATE_COMPLETE') == 1
+    assert '\x1b[2J' not in out.getvalue()
+
+    out.truncate(0)
+    out.seek(0)
+    rows.append({'name': 'c', 'status': 'CREATE_IN_PROGRESS'})
+    screen.print_table(['name', 'status'], rows, key=['name'])
+    # the table grew: full redraw
+    assert '\x1b[2J' in out.getvalue()
+
+
+def test_stack_results():
+    func = MagicMock(return_value=['resource'])
+    stack = SenzaStackSummary({'StackName': 'myapp-1', 'StackStatus': 'UPDATE_IN_PROGRESS'})
+    results = StackResults()
+    assert results.get(stack, func) == ['resource']
+    assert results.get(stack, func) == ['resource']
+    assert func.call_count == 2
+
+    stack = SenzaStackSummary({'StackName': 'myapp-1', 'StackStatus': 'UPDATE_COMPLETE'})
+    results.get(stack, func)
+    results.get(stack, func)
+    assert func.call_count == 3